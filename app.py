@@ -11,13 +11,20 @@ import re
 import sys
 import csv
 import struct
+import heapq
+import hashlib
+import weakref
 import simplefix
 import ssl
 import inspect
 import tcache
+import filock
+from fixparse import FixFramer, FixTable, FixRow, UTCTimestampCodec
+from mdbook import (OrderBook, TickSize, LADDER_ENTRY_TYPES,
+                    DESCENDING_ENTRY_TYPES, UNIT_TICK_SIZE)
 from bidict import bidict
 from sortedcontainers import SortedDict
-from simplefix import FixMessage, FixParser
+from simplefix import FixMessage
 from enum import IntEnum
 from numbers import Number
 from zmapi import fix
@@ -33,16 +40,18 @@ from zmapi.utils import (random_str, delayed, get_timestamp, makedirs,
 from zmapi.controller import RESTConnectorCTL, ConnectorCTL
 from zmapi.logging import setup_root_logger, disable_logger
 from zmapi.exceptions import *
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from uuid import uuid4
 
 
 ################################## CONSTANTS ##################################
 
 
+# ZMListCapabilities adds the capability of every pub encoding in
+# PUB_ENCODERS (PUB_ENCODING_JSON, PUB_ENCODING_STRUCT).
 CAPABILITIES = sorted([
     "SYNC_SNAPSHOT",
-    # "UNSYNC_SNAPSHOT",
+    "UNSYNC_SNAPSHOT",
     "GET_TICKER_FIELDS",
     "SUBSCRIBE",
     "LIST_DIRECTORY",
@@ -87,6 +96,16 @@ TICKER_FIELDS = [
 MODULE_NAME = "cts-fix-acmd"
 ENDPOINT_NAME = "cts"
 
+# paginated SecurityListRequest: seconds a continuation token stays valid,
+# entries built between event loop yields
+SEC_LIST_CURSOR_TTL = 300
+SEC_LIST_YIELD_EVERY = 200
+
+# how long SecurityDefinition responses are reused
+SECDEFS_TTL = timedelta(days=1)
+# how long past SECDEFS_TTL they are still served while being refreshed
+SECDEFS_MAX_STALE = timedelta(days=7)
+
 
 ################################ GLOBAL STATE #################################
 
@@ -108,10 +127,18 @@ g.startup_event = asyncio.Event()
 g.fix_seq_num_tx = 1
 g.fix_seq_num_rx = None
 
+# SendingTime encoding/decoding
+g.utc_timestamp = UTCTimestampCodec()
+
 g.cts_secid_to_insid = {}
 
 g.sub_locks = defaultdict(asyncio.Lock)
-g.sec_def_lock = asyncio.Lock()
+
+# set up in main() when --conflation-window is given
+g.conflator = None
+
+# SecurityID -> TickSize, registered from SecurityDefinition messages
+g.tick_sizes = {}
 
 def create_empty_subscription():
     return {
@@ -119,8 +146,10 @@ def create_empty_subscription():
         "initial_snapshot_completed": False,
         "last_snap_received": 0,
         "security_trading_status": None,
-        "prices": defaultdict(list),
+        "book": None,
         "tick_size": None,
+        # PUB_ENCODERS keys requested by the subscribers of the instrument
+        "pub_encodings": set(),
     }
 g.subscriptions = defaultdict(create_empty_subscription)
 
@@ -357,11 +386,117 @@ def market_to_insid(d):
         ])
 
 
-def conv_to_int_repr(val):
-    for i in range(1000):
-        x = val * (10 ** i)
-        if abs(x - int(x)) < 1e-12:
-            return int(x)
+def register_tick_size(msg):
+    sec_id = msg.gets(Fields.SecurityID)
+    tick_size = g.tick_sizes.get(sec_id)
+    if tick_size is None:
+        price_ratio = msg.gets(Fields.PriceRatio)
+        if not price_ratio:
+            return None
+        tick_size = TickSize.parse(
+                price_ratio, msg.gets(Fields.MinPriceIncrementAmount))
+        g.tick_sizes[sec_id] = tick_size
+    return tick_size
+
+
+def secdef_to_sec_list_entry(msg):
+    """SecListGrp entry of a SecurityDefinition, None if it is invalid."""
+
+    d = {}
+
+    d["SecurityType"] = msg.gets(Fields.SecurityType)
+    d["SecurityExchange"] = msg.gets(Fields.SecurityExchange)
+    d["Symbol"] = msg.gets(Fields.Symbol)
+    d["SecurityID"] = msg.gets(Fields.SecurityID)
+    # TODO: standardize OrdType (when writing AC specs)
+    d["MaturityMonthYear"] = msg.gets(Fields.MaturityMonthYear)
+    d["MaturityDate"] = "{}{}".format(d["MaturityMonthYear"],
+                                      msg.gets(Fields.MaturityDay))
+    min_trade_vol = msg.get(Fields.MinTradeVol)
+    if min_trade_vol:
+        d["MinTradeVol"] = float(min_trade_vol)
+    d["Currency"] = msg.gets(Fields.Currency)
+    # MinPriceIncrement always comes from the main PriceRatio: CTS quotes
+    # market data in main ratio ticks, so that is the scale of the published
+    # book prices. Named tables such as RTS(...) only apply to order entry
+    # and are passed on as ZMTickTables without changing the scale.
+    tick_size = register_tick_size(msg)
+    if tick_size:
+        d["MinPriceIncrement"] = tick_size.scale
+        if tick_size.amount is not None:
+            d["ContractMultiplier"] = float(tick_size.amount)
+        if tick_size.tables:
+            d["ZMTickTables"] = tables = []
+            for name, table in sorted(tick_size.tables.items()):
+                t = {"Name": name}
+                t["MinPriceIncrement"] = table.scale
+                if table.amount is not None:
+                    t["MinPriceIncrementAmount"] = float(table.amount)
+                tables.append(t)
+    d["SecurityDesc"] = msg.gets(Fields.SecurityDesc)
+    d["SecuritySubType"] = msg.gets(Fields.SecuritySubType)
+    strike = msg.get(Fields.StrikePrice)
+    if strike:
+        d["StrikePrice"] = float(strike)
+    d["PutOrCall"] = msg.geti(Fields.PutOrCall)
+    d = {k: v for k, v in d.items() if v is not None}
+
+    num_legs = msg.get(Fields.NoLegs)
+    if num_legs:
+        d["InstrmtLegSecListGrp"] = group2 = []
+        num_legs = int(num_legs)
+        # 1-based indexing
+        for i in range(1, num_legs + 1):
+            leg = {}
+            leg["Symbol"] = msg.gets(Fields.LegSymbol, i,
+                                     Fields.LegSymbol)
+            leg["RatioQty"] = msg.gets(Fields.LegRatioQty, i,
+                                       Fields.LegSymbol)
+            leg["LegSide"] = msg.gets(Fields.LegSide, i,
+                                      Fields.LegSymbol)
+            leg["SecurityType"] = msg.gets(Fields.LegSecurityType, i,
+                                           Fields.LegSymbol)
+            leg["SecurityID"] = msg.gets(Fields.LegSecurityID, i,
+                                         Fields.LegSymbol)
+            leg["SecurityExchange"] = \
+                    msg.gets(Fields.LegSecurityExchange, i,
+                             Fields.LegSymbol)
+            leg["SecurityDesc"] = msg.gets(Fields.LegSecurityDesc, i,
+                                           Fields.LegSymbol)
+            leg["Currency"] = msg.gets(Fields.LegCurrency, i,
+                                       Fields.LegSymbol)
+            leg["MaturityMonthYear"] = \
+                    msg.gets(Fields.LegMaturityMonthYear, i,
+                             Fields.LegSymbol)
+            strike = msg.get(Fields.LegStrikePrice, i,
+                             Fields.LegSymbol)
+            if strike:
+                leg["StrikePrice"] = float(strike)
+            leg["PutOrCall"] = msg.gets(Fields.LegPutOrCall, i,
+                                        Fields.LegSymbol)
+            leg = {k: v for k, v in leg.items() if v is not None}
+            group2.append(leg)
+
+    num_sec_alt_ids = msg.get(Fields.NoSecurityAltID)
+    if num_sec_alt_ids:
+        d["SecAltIDGrp"] = group2 = []
+        num_sec_alt_ids = int(num_sec_alt_ids)
+        # 1-based indexing
+        for i in range(1, num_sec_alt_ids + 1):
+            aid = {}
+            aid["SecurityAltID"] = msg.gets(Fields.SecurityAltID, i,
+                                            Fields.SecurityAltID)
+            aid["SecurityAltIDSource"] = \
+                    msg.gets(Fields.SecurityAltIDSource, i,
+                             Fields.SecurityAltID)
+            group2.append(aid)
+
+    try:
+        d["ZMInstrumentID"] = market_to_insid(d)
+    except:
+        L.debug("skipped invalid secdef:\n{}".format(pformat(d)))
+        return None
+    return d
 
 
 ###############################################################################
@@ -373,7 +508,10 @@ class MDController(ConnectorCTL):
 
     def __init__(self, sock_dn):
         super().__init__(sock_dn, "MD")
-        
+        # ZMContinuationToken -> (secdefs, next position, page size,
+        # time created)
+        self._sec_list_cursors = {}
+
 
     async def ZMGetStatus(self, ident, msg_raw, msg):
         res = {}
@@ -383,6 +521,15 @@ class MDController(ConnectorCTL):
         d["module_name"] = MODULE_NAME
         d["endpoint_name"] = ENDPOINT_NAME
         d["session_id"] = g.session_id
+        if g.conflator:
+            d["conflation"] = g.conflator.get_stats()
+        d["publisher"] = g.pub.get_stats()
+        d["secdef_index"] = g.secdef_index.get_stats()
+        d["secdefs_cache"] = g.secdefs.get_stats()
+        d["file_locks"] = filock.lock_stats.get_stats()
+        d["secdef_requests_coalesced"] = \
+                g.fix_client.secdef_requests_coalesced
+        d["secdef_scheduler"] = g.fix_client.secdef_scheduler.get_stats()
         res["Body"] = [d]
         return res
 
@@ -392,7 +539,8 @@ class MDController(ConnectorCTL):
         res["Header"] = header = {}
         header["MsgType"] = fix.MsgType.ZMListCapabilitiesResponse
         res["Body"] = body = {}
-        body["ZMCaps"] = CAPABILITIES
+        body["ZMCaps"] = sorted(CAPABILITIES + [
+                enc.capability for enc in PUB_ENCODERS.values()])
         return res
 
 
@@ -409,8 +557,32 @@ class MDController(ConnectorCTL):
         body = msg["Body"]
         data = {}
 
+        # Paging: with ZMPageSize at most that many definitions are turned
+        # into SecListGrp entries (invalid ones are skipped) and
+        # ZMContinuationToken is returned if there are more. The token is
+        # sent back alone to get the next page of the same size.
+        page_size = body.get("ZMPageSize")
+        if page_size is not None and (type(page_size) is not int
+                                      or page_size <= 0):
+            raise BusinessMessageRejectException(
+                    "ZMPageSize must be a positive integer")
+        token = body.get("ZMContinuationToken")
+        now = time()
+        for k, (_, _, _, ts) in list(self._sec_list_cursors.items()):
+            if now - ts > SEC_LIST_CURSOR_TTL:
+                del self._sec_list_cursors[k]
+        if token:
+            cursor = self._sec_list_cursors.pop(token, None)
+            if cursor is None:
+                raise BusinessMessageRejectException(
+                        "invalid or expired ZMContinuationToken")
+        else:
+            cursor = None
+
         ins_id = body.get("ZMInstrumentID")
-        if ins_id:
+        if cursor:
+            pass
+        elif ins_id:
             try:
                 data = insid_to_market(ins_id)
             except:
@@ -434,7 +606,11 @@ class MDController(ConnectorCTL):
             if "MaturityMonthYear" in body:
                 data["MaturityMonthYear"] = body["MaturityMonthYear"]
 
-        fix_msgs = await g.fix_client.security_definition_request(data)
+        if cursor:
+            fix_msgs, start, page_size, _ = cursor
+        else:
+            fix_msgs = await g.fix_client.security_definition_request(data)
+            start = 0
 
         if len(fix_msgs) == 1:
             if fix_msgs[0].get(Fields.TotNumReports) == b"0":
@@ -442,100 +618,29 @@ class MDController(ConnectorCTL):
                 err_msg = fix_msgs[0].gets(Fields.SecurityDesc)
                 raise BusinessMessageRejectException(err_msg)
 
+        end = len(fix_msgs)
+        if page_size:
+            end = min(end, start + page_size)
+
         res = {}
         res["Header"] = header = {}
         header["MsgType"] = fix.MsgType.SecurityList
         res["Body"] = body = {}
+        body["TotNoRelatedSym"] = len(fix_msgs)
         body["SecListGrp"] = group = []
 
-        for msg in fix_msgs:
-
-            d = {}
-            
-            d["SecurityType"] = msg.gets(Fields.SecurityType)
-            d["SecurityExchange"] = msg.gets(Fields.SecurityExchange)
-            d["Symbol"] = msg.gets(Fields.Symbol)
-            d["SecurityID"] = msg.gets(Fields.SecurityID)
-            # TODO: standardize OrdType (when writing AC specs)
-            d["MaturityMonthYear"] = msg.gets(Fields.MaturityMonthYear)
-            d["MaturityDate"] = "{}{}".format(d["MaturityMonthYear"],
-                                              msg.gets(Fields.MaturityDay))
-            min_trade_vol = msg.get(Fields.MinTradeVol)
-            if min_trade_vol:
-                d["MinTradeVol"] = float(min_trade_vol)
-            d["Currency"] = msg.gets(Fields.Currency)
-            # TODO: when to use RTS value?
-            # TODO: read and return variable tick size table
-            # example PriceRatio: 3125/100000 RTS(78125/10000000)
-            price_ratio = msg.gets(Fields.PriceRatio)
-            spl = price_ratio.split()[0].split("/")
-            num = float(spl[0])
-            denom = float(spl[1])
-            d["MinPriceIncrement"] = conv_to_int_repr(num / denom)
-            # example MinPriceIncrementAmount: 31.25 RTS(7.8125)
-            min_price_inc_amt = msg.gets(Fields.MinPriceIncrementAmount)
-            d["ContractMultiplier"] = float(min_price_inc_amt.split()[0])
-            d["SecurityDesc"] = msg.gets(Fields.SecurityDesc)
-            d["SecuritySubType"] = msg.gets(Fields.SecuritySubType)
-            strike = msg.get(Fields.StrikePrice)
-            if strike:
-                d["StrikePrice"] = float(strike)
-            d["PutOrCall"] = msg.geti(Fields.PutOrCall)
-            d = {k: v for k, v in d.items() if v is not None}
-
-            num_legs = msg.get(Fields.NoLegs)
-            if num_legs:
-                d["InstrmtLegSecListGrp"] = group2 = []
-                num_legs = int(num_legs)
-                # 1-based indexing
-                for i in range(1, num_legs + 1):
-                    leg = {}
-                    leg["Symbol"] = msg.gets(Fields.LegSymbol, i,
-                                             Fields.LegSymbol)
-                    leg["RatioQty"] = msg.gets(Fields.LegRatioQty, i,
-                                               Fields.LegSymbol)
-                    leg["LegSide"] = msg.gets(Fields.LegSide, i,
-                                              Fields.LegSymbol)
-                    leg["SecurityType"] = msg.gets(Fields.LegSecurityType, i,
-                                                   Fields.LegSymbol)
-                    leg["SecurityID"] = msg.gets(Fields.LegSecurityID, i,
-                                                 Fields.LegSymbol)
-                    leg["SecurityExchange"] = \
-                            msg.gets(Fields.LegSecurityExchange, i,
-                                     Fields.LegSymbol)
-                    leg["SecurityDesc"] = msg.gets(Fields.LegSecurityDesc, i,
-                                                   Fields.LegSymbol)
-                    leg["Currency"] = msg.gets(Fields.LegCurrency, i,
-                                               Fields.LegSymbol)
-                    leg["MaturityMonthYear"] = \
-                            msg.gets(Fields.LegMaturityMonthYear, i,
-                                     Fields.LegSymbol)
-                    strike = msg.get(Fields.LegStrikePrice, i,
-                                     Fields.LegSymbol)
-                    if strike:
-                        leg["StrikePrice"] = float(strike)
-                    leg["PutOrCall"] = msg.gets(Fields.LegPutOrCall, i,
-                                                Fields.LegSymbol)
-                    leg = {k: v for k, v in leg.items() if v is not None}
-                    group2.append(leg)
-
-            num_sec_alt_ids = msg.get(Fields.NoSecurityAltID)
-            if num_sec_alt_ids:
-                d["SecAltIDGrp"] = group2 = []
-                num_sec_alt_ids = int(num_sec_alt_ids)
-                for i in range(num_sec_alt_ids):
-                    aid = {}
-                    aid["SecurityAltID"] = msg.gets(Fields.SecurityAltID, i)
-                    aid["SecurityAltIDSource"] = \
-                            msg.gets(Fields.SecurityAltIDSource, i)
-                    group2.append(aid)
+        for i in range(start, end):
+            d = secdef_to_sec_list_entry(fix_msgs[i])
+            if d is not None:
+                group.append(d)
+            if (i - start) % SEC_LIST_YIELD_EVERY == SEC_LIST_YIELD_EVERY - 1:
+                # keep market data flowing while large listings are built
+                await asyncio.sleep(0)
 
-            try:
-                d["ZMInstrumentID"] = market_to_insid(d)
-            except:
-                L.debug("skipped invalid secdef:\n{}".format(pformat(d)))
-                continue
-            group.append(d)
+        if end < len(fix_msgs):
+            token = str(uuid4())
+            self._sec_list_cursors[token] = (fix_msgs, end, page_size, now)
+            body["ZMContinuationToken"] = token
 
         return res
 
@@ -698,6 +803,11 @@ class MDController(ConnectorCTL):
 
         ins_id = body["ZMInstrumentID"]
 
+        encoding = body.get("ZMPubEncoding", g.default_pub_encoding)
+        if encoding not in PUB_ENCODERS:
+            raise MarketDataRequestRejectException(
+                    "unsupported ZMPubEncoding")
+
         # await g.sub_locks[ins_id].acquire()
 
         try:
@@ -705,18 +815,27 @@ class MDController(ConnectorCTL):
         except:
             raise MarketDataRequestRejectException("invalid ZMInstrumentID")
 
-        g.cts_secid_to_insid[data["SecurityID"]] = ins_id
-        sub = g.subscriptions[data["SecurityID"]]
-
         res = {}
         res["Header"] = header = {}
         header["MsgType"] = fix.MsgType.ZMMarketDataRequestResponse
         res["Body"] = {}
 
-    
         if srt == "0":
-            raise BusinessMessageRejectException(
-                    "unsync snapshots not implemented yet")
+            # g.subscriptions is a defaultdict, do not create entries for
+            # instruments that are rejected
+            sub = g.subscriptions.get(data["SecurityID"])
+            if sub is None or not sub["initial_snapshot_completed"]:
+                raise BusinessMessageRejectException(
+                        "unsync snapshots are available only for "
+                        "subscribed instruments")
+            depth = body.get("MarketDepth", 0)
+            if "*" in ticks:
+                ticks = None
+            res["Body"] = self._book_snapshot(ins_id, sub, ticks, depth)
+            return res
+
+        g.cts_secid_to_insid[data["SecurityID"]] = ins_id
+        sub = g.subscriptions[data["SecurityID"]]
 
         if srt == "1":
             data["SubscriptionRequestType"] = "7"
@@ -735,10 +854,24 @@ class MDController(ConnectorCTL):
             s = ""
             for ctstick in data["MDReqGrp"]:
                 s += CTSTICK_TO_ZMTICK[ctstick]
+            sub["pub_encodings"].add(encoding)
+            if sub["initial_snapshot_completed"] \
+                    and set(s) <= set(sub["MDReqGrp"]) \
+                    and data["MarketDepth"] <= sub["max_levels"]:
+                # Already subscribed with enough depth and entry types,
+                # publish the snapshot from the local book instead of
+                # resubscribing.
+                g.fix_client.publish_book_snapshot(
+                        data["SecurityID"], s, body["MarketDepth"] or None,
+                        [encoding])
+                res["Body"]["Text"] = "success"
+                return res
             sub["MDReqGrp"] = s
+            sub["tick_size"] = await self._get_tick_size(data)
 
         elif srt == "2":
             data["SubscriptionRequestType"] = "2"
+            sub["pub_encodings"].clear()
             data["MarketDepth"] = 10
             data["MDReqGrp"] = "".join(sorted(CTSTICK_TO_ZMTICK.keys()))
 
@@ -746,21 +879,887 @@ class MDController(ConnectorCTL):
         return res
 
 
+    async def _get_tick_size(self, data):
+        sec_id = data["SecurityID"]
+        if sec_id not in g.tick_sizes:
+            await g.fix_client.security_definition_request({
+                "SecurityType": data["SecurityType"],
+                "SecurityExchange": data["SecurityExchange"],
+                "Symbol": data["Symbol"],
+                "SecurityID": sec_id,
+            })
+        tick_size = g.tick_sizes.get(sec_id)
+        if tick_size is None or tick_size.scale is None:
+            L.warning("{}: no decimal PriceRatio, prices are not scaled"
+                      .format(sec_id))
+            return UNIT_TICK_SIZE
+        return tick_size
+
+
+    def _book_snapshot(self, ins_id, sub, ticks, depth):
+        book = sub["book"]
+        res = {}
+        res["ZMTickerID"] = self.insid_to_tid.get(ins_id)
+        res["SendingTime"] = book.sending_time
+        if not depth:
+            depth = None
+        res["MDFullGrp"] = book.snapshot(ticks, depth)
+        zmts = CTSTS_TO_ZMTS.get(book.trading_status)
+        if zmts is not None:
+            res["SecurityTradingStatus"] = zmts
+        if book.price_limits:
+            res["PriceLimits"] = dict(book.price_limits)
+        return res
+
+
     # TODO: write TradingSessionStatusRequest
 
     
 ###############################################################################
 
 
-class FIXReader:
+# Collects outbound publications and sends them in one go, either when the
+# reader has dispatched a whole receive buffer or at the end of the current
+# event loop iteration. Sends go through a synchronous shadow of the PUB
+# socket, so no future is created per message. With envelopes enabled,
+# consecutive publications on the same topic are sent as a single multipart
+# message: [topic, payload1, payload2, ...].
+class PubBatcher:
+
+    def __init__(self, sock, envelopes=False):
+        self._sock = zmq.Socket.shadow(sock.underlying)
+        self._envelopes = envelopes
+        self._frames = []
+        self._flush_scheduled = False
+        self.num_batches = 0
+        self.num_messages = 0
+        self.num_sends = 0
+
+
+    def get_stats(self):
+        d = {}
+        d["envelopes"] = self._envelopes
+        d["batches"] = self.num_batches
+        d["messages"] = self.num_messages
+        d["sends"] = self.num_sends
+        return d
 
-    PUB_ADDR = "inproc://fix-pub"
 
-    def __init__(self, reader):
+    def send_multipart(self, parts):
+        self._frames.append(parts)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            g.loop.call_soon(self.flush)
+
+
+    def flush(self):
+        self._flush_scheduled = False
+        frames = self._frames
+        if not frames:
+            return
+        self._frames = []
+        self.num_batches += 1
+        self.num_messages += len(frames)
+        send = self._sock.send_multipart
+        if not self._envelopes:
+            for parts in frames:
+                send(parts, zmq.NOBLOCK)
+            self.num_sends += len(frames)
+            return
+        envelope = list(frames[0])
+        for parts in frames[1:]:
+            if parts[0] == envelope[0]:
+                envelope.extend(parts[1:])
+                continue
+            send(envelope, zmq.NOBLOCK)
+            self.num_sends += 1
+            envelope = list(parts)
+        send(envelope, zmq.NOBLOCK)
+        self.num_sends += 1
+
+
+###############################################################################
+
+
+# W/X payload encoders for the pub socket.
+#
+# Clients pick an encoding per subscription with ZMPubEncoding in the
+# MarketDataRequest (default: --pub-encoding). Every W/X message of an
+# instrument is published once per encoding its subscribers asked for, on
+# the message type topic prefixed with the encoder's topic_prefix, so JSON
+# keeps the plain "W"/"X" topics and struct payloads go to "struct.W" and
+# "struct.X".
+#
+# inc_builder(tid) returns a reusable per-ticker builder that serializes X
+# entries directly from parsed fields:
+#
+#   builder.begin(sending_time)
+#   builder.add(ua, et, px, size, level, agg)  # None leaves a field out
+#   if builder:
+#       builder.publish(seq_no, zm_sending_time)
+
+
+def sub_pub_encodings(sub):
+    return sub["pub_encodings"] or (g.default_pub_encoding,)
+
+
+def publish_md(sub, msg_type, d, encodings=None):
+    """Publish a W/X message dict in each encoding of the subscription."""
+    if encodings is None:
+        encodings = sub_pub_encodings(sub)
+    for name in encodings:
+        encoder = g.md_encoders[name]
+        g.pub.send_multipart([encoder.topics[msg_type],
+                              encoder.encode(msg_type, d)])
+
+
+def md_inc_builder(sub, tid):
+    encodings = sub_pub_encodings(sub)
+    if len(encodings) == 1:
+        for name in encodings:
+            return g.md_encoders[name].inc_builder(tid)
+    return IncBuilderFanout([g.md_encoders[name].inc_builder(tid)
+                             for name in sorted(encodings)])
+
+
+class IncBuilderFanout:
+
+    def __init__(self, builders):
+        self._builders = builders
+
+    def __len__(self):
+        return len(self._builders[0])
+
+    def begin(self, sending_time):
+        for builder in self._builders:
+            builder.begin(sending_time)
+
+    def add(self, ua, et, px=None, size=None, level=None, agg=None):
+        for builder in self._builders:
+            builder.add(ua, et, px, size, level, agg)
+
+    def publish(self, seq_no, zm_sending_time):
+        for builder in self._builders:
+            builder.publish(seq_no, zm_sending_time)
+
+
+class JSONPubEncoder:
+
+    capability = "PUB_ENCODING_JSON"
+    topic_prefix = b""
+
+    def __init__(self):
+        self.topics = {t: self.topic_prefix + t.encode() for t in "WX"}
+        self._inc_builders = {}
+
+    def encode(self, msg_type, d):
+        return (" " + json.dumps(d)).encode()
+
+    def inc_builder(self, tid):
+        builder = self._inc_builders.get(tid)
+        if builder is None:
+            builder = self._inc_builders[tid] = \
+                    JSONIncBuilder(tid, self.topics["X"])
+        return builder
+
+
+# Writes the same JSON text as json.dumps would for the equivalent dicts,
+# from fragments precomputed per ticker and per (MDUpdateAction,
+# MDEntryType) pair.
+class JSONIncBuilder:
+
+    def __init__(self, tid, topic=b"X"):
+        self.topic = topic
+        self._entry_suffix = ", \"ZMTickerID\": " + json.dumps(tid) + "}"
+        self._entry_prefixes = defaultdict(dict)
+        self._entries = []
+        self._sending_time = "null"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry_prefix(self, ua, et):
+        prefix = "{"
+        if ua is not None:
+            prefix += "\"MDUpdateAction\": " + json.dumps(ua) + ", "
+        prefix += "\"MDEntryType\": " + json.dumps(et)
+        self._entry_prefixes[ua][et] = prefix
+        return prefix
+
+    def begin(self, sending_time):
+        self._entries.clear()
+        self._sending_time = json.dumps(sending_time)
+
+    def add(self, ua, et, px=None, size=None, level=None, agg=None):
+        s = self._entry_prefixes[ua].get(et)
+        if s is None:
+            s = self._entry_prefix(ua, et)
+        if px is not None:
+            s += ", \"MDEntryPx\": " + repr(float(px))
+        if size is not None:
+            s += ", \"MDEntrySize\": " + repr(float(size))
+        if level is not None:
+            s += ", \"MDPriceLevel\": " + str(level)
+        if agg is not None:
+            s += ", \"AggressorSide\": " + json.dumps(agg)
+        self._entries.append(s + self._entry_suffix)
+
+    def finish(self, seq_no, zm_sending_time):
+        s = " {{\"Header\": {{\"MsgSeqNum\": {}, \"ZMSendingTime\": {}}}, " \
+            "\"Body\": {{\"SendingTime\": {}, \"MDIncGrp\": [{}]}}}}".format(
+                seq_no, zm_sending_time, self._sending_time,
+                ", ".join(self._entries))
+        self._entries.clear()
+        return s.encode()
+
+    def publish(self, seq_no, zm_sending_time):
+        g.pub.send_multipart([self.topic,
+                              self.finish(seq_no, zm_sending_time)])
+
+
+# Compact binary W/X encoding. Payload layout (little-endian):
+#
+#   header: msg_type     char    b"W" or b"X"
+#           version      uint8
+#           MsgSeqNum    uint64
+#           ZMSendingTime int64  ns
+#           SendingTime  int64   ns, 0 if unknown
+#           tid_len      uint16
+#           num_entries  uint16
+#   ZMTickerID           tid_len bytes of utf-8
+#   entries: MDUpdateAction char  b"\0" on W
+#            MDEntryType  char
+#            flags        uint8   1: MDEntryPx, 2: MDEntrySize,
+#                                 4: MDPriceLevel present,
+#                                 8: MDEntryPx is a double,
+#                                 16: MDEntrySize is a double
+#            AggressorSide int8   -1 if not present
+#            MDEntryPx    int64   integer price (CTS price times the
+#                                 instrument's MinPriceIncrement scale), or
+#                                 the bits of an IEEE double with flag 8 for
+#                                 prices that do not scale to an integer
+#            MDEntrySize  int64   integer size, or the bits of an IEEE
+#                                 double with flag 16 for fractional sizes
+#            MDPriceLevel int32
+
+DOUBLE = struct.Struct("<d")
+INT64 = struct.Struct("<q")
+
+def struct_px(px):
+    """MDEntryPx flags and int64 field of a struct entry, px not None."""
+    if type(px) is int:
+        return 1, px
+    if px.is_integer():
+        return 1, int(px)
+    return 9, INT64.unpack(DOUBLE.pack(px))[0]
+
+def struct_size(size):
+    """MDEntrySize flags and int64 field of a struct entry, size not None."""
+    if type(size) is int:
+        return 2, size
+    if size.is_integer():
+        return 2, int(size)
+    return 18, INT64.unpack(DOUBLE.pack(size))[0]
+
+
+class StructPubEncoder:
+
+    capability = "PUB_ENCODING_STRUCT"
+    topic_prefix = b"struct."
+    VERSION = 3
+    HEADER = struct.Struct("<cBQqqHH")
+    ENTRY = struct.Struct("<ccBbqqi")
+
+    def __init__(self):
+        self.topics = {t: self.topic_prefix + t.encode() for t in "WX"}
+        self._inc_builders = {}
+
+    def inc_builder(self, tid):
+        builder = self._inc_builders.get(tid)
+        if builder is None:
+            builder = self._inc_builders[tid] = StructIncBuilder(self, tid)
+        return builder
+
+    def encode(self, msg_type, d):
+        header = d["Header"]
+        body = d["Body"]
+        if msg_type == "W":
+            group = body["MDFullGrp"]
+            tid = body["ZMTickerID"]
+        else:
+            group = body["MDIncGrp"]
+            tid = group[0]["ZMTickerID"] if group else ""
+        tid = tid.encode()
+        entry_size = self.ENTRY.size
+        offset = self.HEADER.size + len(tid)
+        buf = bytearray(offset + len(group) * entry_size)
+        self.HEADER.pack_into(buf, 0,
+                              msg_type.encode(),
+                              self.VERSION,
+                              header["MsgSeqNum"],
+                              header["ZMSendingTime"],
+                              body.get("SendingTime") or 0,
+                              len(tid),
+                              len(group))
+        buf[self.HEADER.size:offset] = tid
+        pack_into = self.ENTRY.pack_into
+        for entry in group:
+            flags = 0
+            px = entry.get("MDEntryPx")
+            if px is not None:
+                flags, px = struct_px(px)
+            size = entry.get("MDEntrySize")
+            if size is not None:
+                size_flags, size = struct_size(size)
+                flags |= size_flags
+            lvl = entry.get("MDPriceLevel")
+            if lvl is not None:
+                flags |= 4
+            agg = entry.get("AggressorSide")
+            pack_into(buf, offset,
+                      (entry.get("MDUpdateAction") or "\0").encode(),
+                      entry["MDEntryType"].encode(),
+                      flags,
+                      -1 if agg is None else int(agg),
+                      px or 0,
+                      size or 0,
+                      lvl or 0)
+            offset += entry_size
+        return bytes(buf)
+
+
+class StructIncBuilder:
+
+    def __init__(self, encoder, tid):
+        self.topic = encoder.topics["X"]
+        self._header = encoder.HEADER
+        self._entry = encoder.ENTRY
+        self._version = encoder.VERSION
+        self._tid = tid.encode()
+        self._entries_offset = self._header.size + len(self._tid)
+        self._buf = bytearray(self._entries_offset + 16 * self._entry.size)
+        self._buf[self._header.size:self._entries_offset] = self._tid
+        self._num_entries = 0
+        self._sending_time = 0
+
+    def __len__(self):
+        return self._num_entries
+
+    def begin(self, sending_time):
+        self._num_entries = 0
+        self._sending_time = sending_time or 0
+
+    def add(self, ua, et, px=None, size=None, level=None, agg=None):
+        offset = self._entries_offset + self._num_entries * self._entry.size
+        if offset + self._entry.size > len(self._buf):
+            self._buf.extend(bytes(len(self._buf)))
+        flags = 0
+        if px is not None:
+            flags, px = struct_px(px)
+        if size is not None:
+            size_flags, size = struct_size(size)
+            flags |= size_flags
+        if level is not None:
+            flags |= 4
+        self._entry.pack_into(self._buf, offset,
+                              (ua or "\0").encode(),
+                              et.encode(),
+                              flags,
+                              -1 if agg is None else int(agg),
+                              px or 0,
+                              size or 0,
+                              level or 0)
+        self._num_entries += 1
+
+    def finish(self, seq_no, zm_sending_time):
+        self._header.pack_into(self._buf, 0,
+                               b"X",
+                               self._version,
+                               seq_no,
+                               zm_sending_time,
+                               self._sending_time,
+                               len(self._tid),
+                               self._num_entries)
+        end = self._entries_offset + self._num_entries * self._entry.size
+        self._num_entries = 0
+        return bytes(self._buf[:end])
+
+    def publish(self, seq_no, zm_sending_time):
+        g.pub.send_multipart([self.topic,
+                              self.finish(seq_no, zm_sending_time)])
+
+
+PUB_ENCODERS = {
+    "json": JSONPubEncoder,
+    "struct": StructPubEncoder,
+}
+
+
+###############################################################################
+
+
+# Coalesces order book updates per instrument and side within a time window
+# and publishes only the net level changes. Book updates are still applied to
+# the local ladders immediately; mark() records the state of a side before
+# its first change in the window and flush() diffs against it. Trades and
+# other non-level entries are never conflated, pending book changes of the
+# instrument are flushed before them to preserve ordering.
+class Conflator:
+
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}
+        self._timer = None
+        # X messages whose book updates were absorbed / conflated X messages
+        # published
+        self.messages_in = 0
+        self.messages_out = 0
+
+
+    def get_stats(self):
+        d = {}
+        d["window"] = self.window
+        d["messages_in"] = self.messages_in
+        d["messages_out"] = self.messages_out
+        d["messages_collapsed"] = self.messages_in - self.messages_out
+        return d
+
+
+    def mark(self, sec_id, zm_et, ladder):
+        sides = self._pending.get(sec_id)
+        if sides is None:
+            sides = self._pending[sec_id] = {}
+        if zm_et not in sides:
+            sides[zm_et] = ladder.copy_levels()
+        if self._timer is None:
+            self._timer = g.loop.call_later(self.window, self.flush_all)
+
+
+    def discard(self, sec_id):
+        self._pending.pop(sec_id, None)
+
+
+    def flush_all(self):
+        self._timer = None
+        for sec_id in list(self._pending):
+            self.flush(sec_id)
+
+
+    def flush(self, sec_id):
+        sides = self._pending.pop(sec_id, None)
+        if not sides:
+            return
+        sub = g.subscriptions[sec_id]
+        book = sub["book"]
+        ins_id = g.cts_secid_to_insid[sec_id]
+        tid = g.ctl.insid_to_tid[ins_id]
+        group = []
+        for zm_et, (prices, sizes) in sorted(sides.items()):
+            changes = book[zm_et].diff(prices, sizes,
+                                       zm_et in DESCENDING_ENTRY_TYPES)
+            for ua, pos, px, size in changes:
+                entry = {}
+                entry["MDUpdateAction"] = ua
+                entry["MDEntryType"] = zm_et
+                entry["MDEntryPx"] = float(px)
+                if ua != "2":
+                    entry["MDEntrySize"] = float(size)
+                entry["MDPriceLevel"] = pos
+                entry["ZMTickerID"] = tid
+                group.append(entry)
+        if not group:
+            return
+        d = {}
+        d["Header"] = header = {}
+        header["MsgSeqNum"] = g.seq_no
+        g.seq_no += 1
+        header["ZMSendingTime"] = get_timestamp()
+        d["Body"] = body = {}
+        body["SendingTime"] = book.sending_time
+        body["MDIncGrp"] = group
+        publish_md(sub, "X", d)
+        self.messages_out += 1
+
+
+###############################################################################
+
+
+# Inverted index over every SecurityDefinition received so far.
+#
+# CTS answers queries that name a Symbol with the complete list of matching
+# definitions, so such queries are remembered as covered for ttl seconds.
+# A query that only adds constraints to a covered one (say /FUT/CME/ES with
+# SecuritySubType after /FUT/CME/ES) is answered by intersecting the per
+# field posting sets instead of asking CTS again. Broader queries get one
+# summary definition per exchange or symbol back and never cover anything.
+#
+# At most max_definitions definitions are kept. Beyond that the least
+# recently received ones are dropped together with the covered queries they
+# belong to, so those queries go to the cache or CTS again instead of being
+# answered from an incomplete index.
+class SecdefIndex:
+
+    FIELDS = {
+        "SecurityType": Fields.SecurityType,
+        "SecurityExchange": Fields.SecurityExchange,
+        "Symbol": Fields.Symbol,
+        "SecuritySubType": Fields.SecuritySubType,
+        "PutOrCall": Fields.PutOrCall,
+        "MaturityMonthYear": Fields.MaturityMonthYear,
+        "SecurityID": Fields.SecurityID,
+    }
+
+    MAX_SOURCES = 1024
+
+    def __init__(self, ttl, max_definitions=100000):
+        self.ttl = ttl
+        self.max_definitions = max_definitions
+        self._next_row = 0
+        self._msgs = {}
+        self._rows = {}  # SecurityID -> row
+        self._postings = {name: defaultdict(set) for name in self.FIELDS}
+        # dict_to_key(query) -> (query, time covered)
+        self._covered = {}
+        # dict_to_key(query) -> (weak reference or None, digest) of the last
+        # response added for it, at most MAX_SOURCES of the most recent
+        # queries. The tcache LRU returns the same object again, a reload
+        # from the file an equal one.
+        self._sources = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+
+    def get_stats(self):
+        d = {}
+        d["definitions"] = len(self._msgs)
+        d["covered_queries"] = len(self._covered)
+        d["evicted"] = self.evicted
+        d["hits"] = self.hits
+        d["misses"] = self.misses
+        return d
+
+
+    def _constraints(self, query):
+        """Query as {field: str value}, None if it cannot be run locally."""
+        res = {}
+        for k, v in query.items():
+            if k == "SecurityRequestType":
+                # REQUEST_LIST_SECURITIES is the default
+                if str(v) != "3":
+                    return None
+                continue
+            if k not in self.FIELDS:
+                return None
+            # ZMListDirectory puts option sub types into PutOrCall
+            if k == "PutOrCall" and v not in PUT_OR_CALL:
+                return None
+            res[k] = str(v)
+        return res
+
+
+    def _match(self, constraints):
+        rows = None
+        for k, v in constraints.items():
+            posting = self._postings[k].get(v)
+            if not posting:
+                return set()
+            rows = set(posting) if rows is None else rows & posting
+        if rows is None:
+            return set(self._msgs)
+        return rows
+
+
+    def _remove(self, row):
+        msg = self._msgs.pop(row)
+        for k, tag in self.FIELDS.items():
+            v = msg.gets(tag)
+            if v is not None:
+                posting = self._postings[k][v]
+                posting.discard(row)
+                if not posting:
+                    del self._postings[k][v]
+        sec_id = msg.gets(Fields.SecurityID)
+        if self._rows.get(sec_id) == row:
+            del self._rows[sec_id]
+
+
+    def _insert(self, msg):
+        if isinstance(msg, FixRow):
+            # a row would keep its whole response table alive
+            msg = msg.view()
+        sec_id = msg.gets(Fields.SecurityID)
+        old = self._rows.get(sec_id)
+        if old is not None:
+            self._remove(old)
+        row = self._next_row
+        self._next_row += 1
+        self._msgs[row] = msg
+        self._rows[sec_id] = row
+        for k, tag in self.FIELDS.items():
+            v = msg.gets(tag)
+            if v is not None:
+                self._postings[k][v].add(row)
+        return row
+
+
+    def _evict(self):
+        row = next(iter(self._msgs))
+        msg = self._msgs[row]
+        self._remove(row)
+        self.evicted += 1
+        for key, (c, _) in list(self._covered.items()):
+            if all(msg.gets(self.FIELDS[k]) == v for k, v in c.items()):
+                del self._covered[key]
+
+
+    @staticmethod
+    def _digest(msgs):
+        h = hashlib.blake2b(digest_size=16)
+        if isinstance(msgs, FixTable):
+            # every other attribute is derived from these
+            h.update(msgs.tags)
+            h.update(msgs.values)
+            h.update(b"\x01".join(msgs.strings))
+        else:
+            for msg in msgs:
+                h.update(msg.encode())
+        return len(msgs), h.digest()
+
+
+    def add(self, query, msgs):
+        """Index a response, returns False if there was nothing new."""
+        key = dict_to_key(query)
+        prev = self._sources.get(key)
+        if prev is not None and prev[0] is not None and prev[0]() is msgs:
+            # the same object again, served from the tcache LRU
+            return False
+        digest = self._digest(msgs)
+        try:
+            ref = weakref.ref(msgs)
+        except TypeError:
+            # lists written by older versions
+            ref = None
+        if prev is not None and prev[1] == digest:
+            # the same response again, reloaded from the tcache file
+            self._sources[key] = (ref, digest)
+            return False
+        if not msgs or any(msg.gets(Fields.SecurityID) is None
+                           for msg in msgs):
+            # error responses carry no definitions
+            return False
+        self._sources.pop(key, None)
+        self._sources[key] = (ref, digest)
+        if len(self._sources) > self.MAX_SOURCES:
+            del self._sources[next(iter(self._sources))]
+        constraints = self._constraints(query)
+        covering = constraints is not None and "Symbol" in constraints
+        if covering:
+            # definitions that are no longer listed
+            stale = self._match(constraints)
+        rows = {self._insert(msg) for msg in msgs}
+        if covering:
+            for row in stale - rows:
+                if row in self._msgs:
+                    self._remove(row)
+            self._covered[dict_to_key(constraints)] = (constraints, time())
+        while len(self._msgs) > self.max_definitions:
+            self._evict()
+        return True
+
+
+    def lookup(self, query):
+        """Definitions matching query in arrival order, None if unknown."""
+        constraints = self._constraints(query)
+        if constraints is None:
+            self.misses += 1
+            return None
+        now = time()
+        covered = False
+        for key, (c, ts) in list(self._covered.items()):
+            if now - ts > self.ttl:
+                del self._covered[key]
+                continue
+            if all(constraints.get(k) == v for k, v in c.items()):
+                covered = True
+                break
+        rows = self._match(constraints) if covered else None
+        if not rows:
+            # let CTS produce its error response for empty results
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [self._msgs[row] for row in sorted(rows)]
+
+
+# Admits SecurityDefinitionRequests to CTS in priority order (lowest first,
+# FIFO within a priority), at most max_in_flight at a time and paced by a
+# token bucket that refills at rate requests per second up to burst. Waiters
+# that are cancelled while queued simply leave the queue. raise_priority()
+# queues a waiter again under a more urgent priority, the entry it leaves
+# behind is skipped once the waiter is admitted. Waiters at urgent_priority
+# or below may also use reserved further slots, so a single instrument
+# lookup does not wait for a bulk listing to complete.
+class SecdefScheduler:
+
+    def __init__(self, rate, burst, max_in_flight=1, reserved=1,
+                 urgent_priority=0):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.reserved = reserved
+        self.urgent_priority = urgent_priority
+        self._tokens = burst
+        self._refilled = g.loop.time()
+        self._queue = []
+        self._seq = 0
+        self._in_flight = 0
+        self._timer = None
+        self.admitted = 0
+        self.cancelled = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+
+    def get_stats(self):
+        d = {}
+        d["queue_depth"] = len({x[2] for x in self._queue if not x[2].done()})
+        d["in_flight"] = self._in_flight
+        d["tokens"] = self._tokens
+        d["admitted"] = self.admitted
+        d["cancelled"] = self.cancelled
+        if self.admitted:
+            d["avg_wait"] = self.total_wait / self.admitted
+        d["max_wait"] = self.max_wait
+        return d
+
+
+    async def acquire(self, priority, fut=None):
+        """Wait for admission, release() when done.
+
+        fut, a new future of the caller's, identifies the waiter to
+        raise_priority().
+        """
+        if fut is None:
+            fut = g.loop.create_future()
+        heapq.heappush(self._queue, (priority, self._seq, fut, g.loop.time()))
+        self._seq += 1
+        self._schedule()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # admitted right before the cancellation arrived
+                self.release()
+            else:
+                fut.cancel()
+                self.cancelled += 1
+            raise
+
+
+    def raise_priority(self, fut, priority):
+        """Move the waiter of fut to priority if that is more urgent."""
+        for p, _, f, queued in self._queue:
+            if f is fut:
+                break
+        else:
+            return
+        if fut.done() or priority >= p:
+            return
+        heapq.heappush(self._queue, (priority, self._seq, fut, queued))
+        self._seq += 1
+        self._schedule()
+
+
+    def release(self):
+        self._in_flight -= 1
+        self._schedule()
+
+
+    def _refill(self):
+        now = g.loop.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        return now
+
+
+    def _schedule(self):
+        self._timer = None
+        now = self._refill()
+        queue = self._queue
+        while queue:
+            if queue[0][2].done():
+                heapq.heappop(queue)
+                continue
+            limit = self.max_in_flight
+            if queue[0][0] <= self.urgent_priority:
+                limit += self.reserved
+            if self._in_flight >= limit:
+                return
+            if self._tokens < 1:
+                if self._timer is None:
+                    delay = (1 - self._tokens) / self.rate
+                    self._timer = g.loop.call_later(delay, self._schedule)
+                return
+            _, _, fut, queued = heapq.heappop(queue)
+            self._tokens -= 1
+            self._in_flight += 1
+            wait = now - queued
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            fut.set_result(None)
+
+
+# Single instrument lookups go ahead of symbol listings, which go ahead of
+# whole exchange or security type listings.
+def secdef_priority(data):
+    if "SecurityID" in data:
+        return 0
+    if "Symbol" in data:
+        return 1
+    return 2
+
+# refreshes and warm-up requests
+SECDEF_PRIORITY_BACKGROUND = 3
+
+
+###############################################################################
+
+
+# Collects parsed messages of the given MsgTypes for a waiting request until
+# term_pred returns True for one of them.
+class FIXListener:
+
+    def __init__(self, topics, term_pred):
+        self.topics = topics
+        self.term_pred = term_pred
+        self.messages = []
+        self.future = g.loop.create_future()
+
+
+    def push(self, msg):
+        if self.future.done():
+            return
+        # kept after the receive buffer is reused
+        msg = msg.detach()
+        self.messages.append(msg)
+        try:
+            done = self.term_pred(msg)
+        except Exception as err:
+            self.future.set_exception(err)
+            return
+        if done:
+            self.future.set_result(self.messages)
+
+
+class FIXReader:
+
+    def __init__(self, reader=None):
         self._reader = reader
-        self._parser = FixParser()
-        self._sock_pub = g.ctx.socket(zmq.PUB)
-        self._sock_pub.bind(self.PUB_ADDR)
+        self._framer = FixFramer()
+        self._listeners = defaultdict(list)
         self.connected = False
 
 
@@ -769,23 +1768,44 @@ class FIXReader:
         while True:
             data = await self._reader.read(1024)
             if not data:
-                L.critical("FIXReader: disconnected")
-                self.connected = False
+                self.disconnected()
                 break
             # L.debug("got {} bytes".format(len(data)))
-            self._parser.append_buffer(data)
-            while True:
-                msg = self._parser.get_message()
-                if not msg:
-                    break
-                L.debug("< {}".format(msg))
-                try:
-                    await self._handle_msg(msg)
-                except Exception as err:
-                    L.exception("error handling fix message:")
+            self._framer.feed(data)
+            self.dispatch_messages()
+
 
+    def get_buffer(self, size):
+        return self._framer.get_buffer(size)
 
-    async def _handle_msg(self, msg):
+
+    def buffer_updated(self, nbytes):
+        self._framer.buffer_updated(nbytes)
+        self.dispatch_messages()
+
+
+    def disconnected(self):
+        L.critical("FIXReader: disconnected")
+        self.connected = False
+
+
+    def dispatch_messages(self):
+        # Messages reference the framer's buffer and stay valid only
+        # until the next feed.
+        while True:
+            msg = self._framer.get_message()
+            if not msg:
+                break
+            L.debug("< {}".format(msg))
+            try:
+                self._handle_msg(msg)
+            except Exception as err:
+                L.exception("error handling fix message:")
+        # everything published from this buffer goes out at once
+        g.pub.flush()
+
+
+    def _handle_msg(self, msg):
         seq_num = int(msg.get(Fields.MsgSeqNum))
         if g.fix_seq_num_rx is not None and seq_num - g.fix_seq_num_rx != 1:
             # TODO: restore connection by ResendRequest or SequenceReset
@@ -796,12 +1816,11 @@ class FIXReader:
         msg_type = msg.gets(Fields.MsgType)
         handler = self.HANDLERS.get(msg_type)
         if handler:
-            if inspect.iscoroutinefunction(handler):
-                await handler(self, msg)
-            else:
-                handler(self, msg)
-        # some performance lost here ...
-        await self._sock_pub.send_multipart([msg_type.encode(), msg.encode()])
+            handler(self, msg)
+        listeners = self._listeners.get(msg_type)
+        if listeners:
+            for listener in listeners[:]:
+                listener.push(msg)
 
 
     def handle_test_request(self, msg):
@@ -819,32 +1838,31 @@ class FIXReader:
         g.startup_event.set()
         self.connected = True
         create_task(g.fix_client.pinger())
+        create_task(g.fix_client.warm_up_secdefs())
+        create_task(g.fix_client.secdef_refresher())
 
 
     def handle_security_definition(self, msg):
-        pass
-        # sec_id = msg.gets(Fields.SecurityID)
-        # sub = g.subscriptions[sec_id]
-        # price_ratio = msg.gets(Fields.PriceRatio)
-        # spl = price_ratio.split()[0].split("/")
-        # numerator = float(spl[0])
-        # denominator = float(spl[1])
-        # sub["tick_size"] = round(numerator / denominator)
+        register_tick_size(msg)
 
 
-    async def _emit_security_status(self, sec_id, sub, data):
-        data = deepcopy(data)
+    def _emit_security_status(self, sec_id, sub, data):
+        # Called for every X message, so an unchanged status returns
+        # before anything is built.
+        body = {}
         sts = data.get("SecurityTradingStatus")
-        zmts = CTSTS_TO_ZMTS.get(sts)
-        if zmts is not None:
-            data["SecurityTradingStatus"] = zmts
-        else:
-            data.pop("SecurityTradingStatus", None)
-        prev_sts = sub["security_trading_status"]
-        if zmts == prev_sts:
-            data.pop("SecurityTradingStatus", None)
-        if sts is not None and zmts is None:
-            L.warning("Unknown CTSTS on {}: {}".format(sec_id, sts))
+        if sts is not None:
+            zmts = CTSTS_TO_ZMTS.get(sts)
+            if zmts is None:
+                L.warning("Unknown CTSTS on {}: {}".format(sec_id, sts))
+                return
+            if zmts != sub["security_trading_status"]:
+                sub["security_trading_status"] = zmts
+                body["SecurityTradingStatus"] = zmts
+        pl = data.get("PriceLimits")
+        if pl:
+            body["PriceLimits"] = dict(pl)
+        if not body:
             return
         seq_no = g.seq_no
         g.seq_no += 1
@@ -852,17 +1870,13 @@ class FIXReader:
         d["Header"] = header = {}
         header["MsgSeqNum"] = seq_no
         header["ZMSendingTime"] = get_timestamp()
-        d["Body"] = body = data
+        d["Body"] = body
         ins_id = g.cts_secid_to_insid[sec_id]
         body["ZMTickerID"] = g.ctl.insid_to_tid[ins_id]
-        data = " " + json.dumps(d)
-        data = [b"h", data.encode()]
-        # # TODO: send only SecurityStatus messages when requested with
-        # # SecurityStatus message
-        # # await g.sock_pub.send_multipart(data)
+        g.pub.send_multipart([b"h", (" " + json.dumps(d)).encode()])
 
 
-    async def _flush_snap_buffer(self, sub):
+    def _flush_snap_buffer(self, sub):
 
         if sub["initial_snapshot_completed"]:
             return
@@ -873,6 +1887,7 @@ class FIXReader:
 
         sec_id = snaps[0].gets(Fields.SecurityID)
         ins_id = g.cts_secid_to_insid[sec_id]
+        tick_size = sub["tick_size"] or UNIT_TICK_SIZE
 
         sts = None
         last_trade = None  # include only latest trade
@@ -888,8 +1903,8 @@ class FIXReader:
                     if et == "4":  # Trade
                         d = {}
                         d["MDEntryType"] = fix.MDEntryType.Trade
-                        d["MDEntryPx"] = snap.getf(
-                                Fields.MDEntryPx, i, Fields.MDEntryType)
+                        d["MDEntryPx"] = float(tick_size.price(snap.get(
+                                Fields.MDEntryPx, i, Fields.MDEntryType)))
                         d["MDEntrySize"] = snap.getf(
                                 Fields.MDEntrySize, i, Fields.MDEntryType)
                         agg = snap.gets(Fields.TickDirection)
@@ -900,12 +1915,12 @@ class FIXReader:
                     if et not in "KL":
                         continue
                     if et == "L":
-                        lo_lim = snap.geti(
-                                Fields.MDEntryPx, i, Fields.MDEntryType)
+                        lo_lim = tick_size.price(snap.get(
+                                Fields.MDEntryPx, i, Fields.MDEntryType))
                         continue
                     if et == "K":
-                        hi_lim = snap.geti(
-                                Fields.MDEntryPx, i, Fields.MDEntryType)
+                        hi_lim = tick_size.price(snap.get(
+                                Fields.MDEntryPx, i, Fields.MDEntryType))
             if sts is not None and last_trade \
                     and hi_lim is not None \
                     and lo_lim is not None:
@@ -925,7 +1940,7 @@ class FIXReader:
         if pl:
             ss_data["PriceLimits"] = pl
         if ss_data:
-            await self._emit_security_status(sec_id, sub, data)
+            self._emit_security_status(sec_id, sub, ss_data)
 
         seq_no = g.seq_no
         g.seq_no += 1
@@ -934,9 +1949,7 @@ class FIXReader:
         header["MsgSeqNum"] = seq_no
         header["ZMSendingTime"] = get_timestamp()
         d["Body"] = body = {}
-        ttime = snaps[0].gets(Fields.SendingTime)
-        ttime = datetime.strptime(ttime, "%Y%m%d-%H:%M:%S.%f")
-        ttime = int(ttime.timestamp() * 1e9)
+        ttime = g.utc_timestamp.decode_ns(snaps[0].get(Fields.SendingTime))
         body["SendingTime"] = ttime
         body["ZMTickerID"] = g.ctl.insid_to_tid[ins_id]
         body["MDFullGrp"] = group = []
@@ -958,7 +1971,7 @@ class FIXReader:
                 entry["MDEntryType"] = et
                 entry_px = snap.get(Fields.MDEntryPx, i, Fields.MDEntryType)
                 if entry_px is not None:
-                    entry["MDEntryPx"] = float(entry_px)
+                    entry["MDEntryPx"] = float(tick_size.price(entry_px))
                 entry_size = snap.get(Fields.MDEntrySize, i, Fields.MDEntryType)
                 if entry_size is not None:
                     entry["MDEntrySize"] = float(entry_size)
@@ -971,33 +1984,32 @@ class FIXReader:
         else:
             L.warning("{}: last_trade not found in snaps".format(sec_id))
 
-        sub["prices"].clear()
-
-        lvls = [x for x in group if x["MDEntryType"] == "0"]
-        lvls = sorted(lvls, key=lambda x: x["MDEntryPx"])[::-1]
-        for entry in lvls:
-            sub["prices"][entry["MDEntryType"]].append(int(entry["MDEntryPx"]))
-
-        lvls = [x for x in group if x["MDEntryType"] == "E"]
-        lvls = sorted(lvls, key=lambda x: x["MDEntryPx"])[::-1]
-        for entry in lvls:
-            sub["prices"][entry["MDEntryType"]].append(int(entry["MDEntryPx"]))
-
-        lvls = [x for x in group if x["MDEntryType"] == "1"]
-        lvls = sorted(lvls, key=lambda x: x["MDEntryPx"])
-        for entry in lvls:
-            sub["prices"][entry["MDEntryType"]].append(int(entry["MDEntryPx"]))
-
-        lvls = [x for x in group if x["MDEntryType"] == "F"]
-        lvls = sorted(lvls, key=lambda x: x["MDEntryPx"])
-        for entry in lvls:
-            sub["prices"][entry["MDEntryType"]].append(int(entry["MDEntryPx"]))
-
-        L.debug("prices after W: {}".format(sub["prices"]))
-
-        data = " " + json.dumps(d)
-        data = [b"W", data.encode()]
-        await g.sock_pub.send_multipart(data)
+        book = sub["book"]
+        book.clear()
+        book.sending_time = ttime
+        book.trading_status = sts
+        book.price_limits.update(pl)
+        book.last_trade = last_trade
+        for entry in group:
+            if entry["MDEntryType"] not in LADDER_ENTRY_TYPES \
+                    and entry is not last_trade:
+                book.set_stat(entry)
+
+        # bids are sorted from highest to lowest, offers the other way round
+        for zm_et in LADDER_ENTRY_TYPES:
+            ladder = book[zm_et]
+            lvls = [x for x in group if x["MDEntryType"] == zm_et]
+            lvls = sorted(lvls, key=lambda x: x["MDEntryPx"],
+                          reverse=zm_et in DESCENDING_ENTRY_TYPES)
+            for entry in lvls:
+                ladder.append(int(entry["MDEntryPx"]),
+                              int(entry.get("MDEntrySize", 0)))
+
+        L.debug("book after W: {}".format(book))
+        if g.conflator:
+            g.conflator.discard(sec_id)
+
+        publish_md(sub, "W", d)
 
         sub["initial_snapshot_completed"] = True
         sub["snapshot_buffer"].clear()
@@ -1005,6 +2017,25 @@ class FIXReader:
         # g.sub_locks[ins_id].release()
 
 
+    def publish_book_snapshot(self, sec_id, sub, ticks=None, depth=None,
+                              encodings=None):
+        book = sub["book"]
+        if g.conflator:
+            g.conflator.discard(sec_id)
+        seq_no = g.seq_no
+        g.seq_no += 1
+        d = {}
+        d["Header"] = header = {}
+        header["MsgSeqNum"] = seq_no
+        header["ZMSendingTime"] = get_timestamp()
+        d["Body"] = body = {}
+        body["SendingTime"] = book.sending_time
+        ins_id = g.cts_secid_to_insid[sec_id]
+        body["ZMTickerID"] = g.ctl.insid_to_tid[ins_id]
+        body["MDFullGrp"] = book.snapshot(ticks, depth)
+        publish_md(sub, "W", d, encodings)
+
+
     async def _snapshot_timeout_timer(self, sub):
         timeout = 0.1
         while True:
@@ -1013,10 +2044,10 @@ class FIXReader:
                 break
             await asyncio.sleep(timeout - elapsed)
         L.debug("snapshot timeout elapsed ...")
-        await self._flush_snap_buffer(sub)
+        self._flush_snap_buffer(sub)
 
 
-    async def handle_md_snap_full_refresh(self, msg):
+    def handle_md_snap_full_refresh(self, msg):
 
         sec_id = msg.gets(Fields.SecurityID)
         if sec_id not in g.cts_secid_to_insid:
@@ -1026,26 +2057,20 @@ class FIXReader:
         if not sub["initial_snapshot_completed"]:
             if not sub["snapshot_buffer"]:
                 create_task(self._snapshot_timeout_timer(sub))
-            sub["snapshot_buffer"].append(msg)
+            sub["snapshot_buffer"].append(msg.detach())
             sub["last_snap_received"] = time()
             return
 
         # trades and hi/lo limits are reported as W messages for some reason...
-        seq_no = g.seq_no
-        g.seq_no += 1
-        d = {}
-        d["Header"] = header = {}
-        header["MsgSeqNum"] = seq_no
-        header["ZMSendingTime"] = get_timestamp()
-        d["Body"] = body = {}
-        ttime = msg.gets(Fields.SendingTime)
-        ttime = datetime.strptime(ttime, "%Y%m%d-%H:%M:%S.%f")
-        ttime = int(ttime.timestamp() * 1e9)
-        body["SendingTime"] = ttime
+        ttime = g.utc_timestamp.decode_ns(msg.get(Fields.SendingTime))
         ins_id = g.cts_secid_to_insid[sec_id]
         tid = g.ctl.insid_to_tid[ins_id]
-        body["MDIncGrp"] = group = []
+        builder = md_inc_builder(sub, tid)
+        builder.begin(ttime)
         num_entries = int(msg.get(Fields.NoMDEntries))
+        book = sub["book"]
+        book.sending_time = ttime
+        tick_size = sub["tick_size"] or UNIT_TICK_SIZE
 
         pl = {}
 
@@ -1056,48 +2081,54 @@ class FIXReader:
                           .format(sec_id, et))
                 L.warning("msg: {}".format(msg))
                 continue
+            entry_px = tick_size.price(
+                    msg.get(Fields.MDEntryPx, i, Fields.MDEntryType))
+            if entry_px is not None:
+                entry_px = float(entry_px)
             if et == "K":
-                pl["HighLimitPrice"] = snap.getf(
-                        Fields.MDEntryPx, i, Fields.MDEntryType)
+                pl["HighLimitPrice"] = entry_px
                 continue
             if et == "L":
-                pl["LowLimitPrice"] = snap.getf(
-                        Fields.MDEntryPx, i, Fields.MDEntryType)
+                pl["LowLimitPrice"] = entry_px
                 continue
             zm_et = CTSTICK_TO_ZMTICK[et]
-            if zm_et not in sub["MDReqGrp"]:
-                continue
-            d = {}
-            d["MDEntryType"] = zm_et
-            d["MDEntryPx"] = msg.getf(
-                    Fields.MDEntryPx, i, Fields.MDEntryType)
-            d["MDEntrySize"] = msg.getf(
+            entry = {}
+            entry["MDEntryType"] = zm_et
+            entry["MDEntryPx"] = entry_px
+            entry["MDEntrySize"] = msg.getf(
                     Fields.MDEntrySize, i, Fields.MDEntryType)
             agg = msg.gets(Fields.TickDirection, i, Fields.MDEntryType)
-            d["AggressorSide"] = CTSAGG_TO_ZMAGG.get(agg)
-            d["ZMTickerID"] = tid
-            d = {k: v for k, v in d.items() if v is not None}
+            entry["AggressorSide"] = CTSAGG_TO_ZMAGG.get(agg)
+            entry = {k: v for k, v in entry.items() if v is not None}
+            book.last_trade = entry
+            if zm_et not in sub["MDReqGrp"]:
+                continue
             # TradeTime is very inaccurate (can be in future) so it is skipped
             # TODO: emit extra optional fields that appear sometimes ...
-            group.append(d)
-
+            builder.add(None, zm_et, entry.get("MDEntryPx"),
+                        entry.get("MDEntrySize"), None,
+                        entry.get("AggressorSide"))
+
+        volume = msg.getf(Fields.TotalVolumeTraded)
+        if volume is not None:
+            entry = {}
+            entry["MDEntryType"] = fix.MDEntryType.TradeVolume
+            entry["MDEntrySize"] = volume
+            book.set_stat(entry)
         if fix.MDEntryType.TradeVolume in sub["MDReqGrp"]:
-            d = {}
-            d["MDEntryType"] = fix.MDEntryType.TradeVolume
-            d["MDEntrySize"] = msg.getf(Fields.TotalVolumeTraded)
-            d["ZMTickerID"] = tid
-            group.append(d)
+            builder.add(None, fix.MDEntryType.TradeVolume, None, volume)
 
-        data = " " + json.dumps(d)
-        data = [b"X", data.encode()]
-        await g.sock_pub.send_multipart(data)
+        if builder:
+            builder.publish(g.seq_no, get_timestamp())
+            g.seq_no += 1
 
         if pl:
+            book.price_limits.update(pl)
             data = {"PriceLimits": pl}
-            await self._emit_security_status(sec_id, sub, data)
+            self._emit_security_status(sec_id, sub, data)
 
 
-    async def handle_md_inc_refresh(self, msg):
+    def handle_md_inc_refresh(self, msg):
 
         sec_id = msg.gets(Fields.SecurityID)
         if sec_id not in g.cts_secid_to_insid:
@@ -1113,36 +2144,36 @@ class FIXReader:
 
         sub = g.subscriptions[sec_id]
 
-        await self._flush_snap_buffer(sub)
+        self._flush_snap_buffer(sub)
 
+        book = sub["book"]
         sec_id = msg.gets(Fields.SecurityID)
         sts = int(msg.get(Fields.SecurityTradingStatus))
-        await self._emit_trading_session(sec_id, sub, sts)
+        book.trading_status = sts
+        self._emit_security_status(sec_id, sub,
+                                   {"SecurityTradingStatus": sts})
 
         num_entries = msg.get(Fields.NoMDEntries)
         if not num_entries:
             return
         num_entries = int(num_entries)
 
-        seq_no = g.seq_no
-        g.seq_no += 1
-        d = {}
-        d["Header"] = header = {}
-        header["MsgSeqNum"] = seq_no
-        header["ZMSendingTime"] = get_timestamp()
-        d["Body"] = body = {}
-        ttime = msg.gets(Fields.SendingTime)
-        ttime = datetime.strptime(ttime, "%Y%m%d-%H:%M:%S.%f")
-        ttime = int(ttime.timestamp() * 1e9)
+        ttime = g.utc_timestamp.decode_ns(msg.get(Fields.SendingTime))
+        book.sending_time = ttime
         ins_id = g.cts_secid_to_insid[sec_id]
         tid = g.ctl.insid_to_tid[ins_id]
-        body["SendingTime"] = ttime
-        body["MDIncGrp"] = group = []
+        builder = md_inc_builder(sub, tid)
+        builder.begin(ttime)
+        tick_size = sub["tick_size"] or UNIT_TICK_SIZE
+        scale = tick_size.scale
+        debug = L.isEnabledFor(logging.DEBUG)
+        conflator = g.conflator
+        conflated = False
 
         try:
             for i in range(1, num_entries + 1):
 
-                post_entries = []
+                overflow_px = None
 
                 et = msg.gets(Fields.MDEntryType, i, Fields.MDUpdateAction)
                 zm_et = CTSTICK_TO_ZMTICK.get(et)
@@ -1150,6 +2181,9 @@ class FIXReader:
                     L.error("{}: unknown MDEntryType '{}'".format(sec_id, et))
                     continue
 
+                entry_size = msg.get(Fields.MDEntrySize, i,
+                                     Fields.MDUpdateAction)
+
                 if zm_et in "01EF":
                     ua = msg.gets(Fields.MDUpdateAction, i,
                                   Fields.MDUpdateAction)
@@ -1158,33 +2192,27 @@ class FIXReader:
                     entry_px = msg.get(Fields.MDEntryPx, i,
                                        Fields.MDUpdateAction)
                     if entry_px:
-                        entry_px = int(entry_px)
-                    prices = sub["prices"][zm_et]
-                    L.debug("et: {}, ua: {}, pos: {}, entry_px: {}, prices: {}"
-                            .format(zm_et, ua, pos, entry_px, prices))
+                        entry_px = int(entry_px) * scale
+                    size = int(entry_size) if entry_size else None
+                    prices = sub["book"][zm_et]
+                    if conflator:
+                        conflator.mark(sec_id, zm_et, prices)
+                    if debug:
+                        L.debug("et: {}, ua: {}, pos: {}, entry_px: {}, "
+                                "prices: {}".format(
+                                    zm_et, ua, pos, entry_px, prices))
                     if ua == "0":
                         if entry_px is None:
                             L.error("{}: MDEntryPx not provided for insert"
                                     .format(sec_id))
                             continue
-                        prices.insert(pos, entry_px)
-                        for i2 in range(sub["max_levels"],
-                                        len(sub["prices"][zm_et])):
-                            entry2 = {}
-                            entry2["MDUpdateAction"] = "2"
-                            entry2["MDEntryType"] = et
-                            entry2["MDPriceLevel"] = i2 + 1
-                            entry2["MDEntryPx"] = sub["prices"][zm_et][i2]
-                            entry2["ZMTickerID"] = tid
-                            post_entries.append(entry2)
-                        sub["prices"][zm_et] = \
-                                sub["prices"][zm_et][:sub["max_levels"]]
+                        overflow_px = prices.insert(pos, entry_px, size or 0)
                     elif ua == "1":
                         if entry_px is not None:
                             L.warning("{}: MDEntryPx provided for change"
                                       .format(sec_id))
                         try:
-                            entry_px = prices[pos]
+                            entry_px = prices.update(pos, size)
                         except IndexError:
                             L.error("{}: Tried to update non-existing pos"
                                     .format(sec_id))
@@ -1194,8 +2222,7 @@ class FIXReader:
                             L.warning("{}: MDEntryPx provided for remove"
                                       .format(sec_id))
                         try:
-                            entry_px = prices[pos]
-                            del prices[pos]
+                            entry_px = prices.delete(pos)
                         except IndexError:
                             L.error("{}: Tried to delete non-existing pos"
                                     .format(sec_id))
@@ -1204,62 +2231,94 @@ class FIXReader:
                         L.warning("{}: unknown MDUpdateAction '{}'"
                                   .format(sec_id, ua))
                         continue
-                    L.debug("entry_px: {}".format(entry_px))
+                    if debug:
+                        L.debug("entry_px: {}".format(entry_px))
+                    if conflator:
+                        conflated = True
+                        continue
+                    builder.add(ua, zm_et, entry_px, size, pos)
+                    if overflow_px is not None:
+                        if debug:
+                            L.debug("level pushed out: {}".format(overflow_px))
+                        builder.add("2", zm_et, overflow_px, None,
+                                    prices.capacity + 1)
+                else:
+                    if conflator:
+                        # publish pending book changes before the trade
+                        conflator.flush(sec_id)
+                    ua = msg.gets(Fields.MDUpdateAction, i,
+                                  Fields.MDUpdateAction)
+                    entry_px = msg.get(Fields.MDEntryPx, i,
+                                       Fields.MDUpdateAction)
+                    stat = {}
+                    stat["MDEntryType"] = zm_et
+                    if entry_px is not None:
+                        entry_px = stat["MDEntryPx"] = \
+                                float(tick_size.price(entry_px))
+                    if entry_size is not None:
+                        entry_size = stat["MDEntrySize"] = float(entry_size)
+                    if zm_et == fix.MDEntryType.Trade:
+                        book.last_trade = stat if ua != "2" else None
+                    else:
+                        book.set_stat(stat, ua)
+                    builder.add(ua, zm_et, entry_px, entry_size)
 
-                entry = {}
-                entry["MDUpdateAction"] = ua
-                entry["MDEntryType"] = zm_et
-                if entry_px is not None:
-                    entry["MDEntryPx"] = float(entry_px)
-                entry_size = msg.get(Fields.MDEntrySize, i,
-                                     Fields.MDUpdateAction)
-                if entry_size is not None:
-                    entry["MDEntrySize"] = float(entry_size)
-                if pos is not None:
-                    entry["MDPriceLevel"] = pos
-                entry["ZMTickerID"] = tid
+        except:
+            sys.exit(1)
 
-                group.append(entry)
+        if conflated:
+            conflator.messages_in += 1
+        if not builder:
+            return
 
-                if post_entries:
-                    L.debug("{} post entries".format(len(post_entries)))
-                    group += post_entries
+        builder.publish(g.seq_no, get_timestamp())
+        g.seq_no += 1
 
-        except:
-            sys.exit(1)
 
-        data = " " + json.dumps(d)
-        data = [b"X", data.encode()]
-        await g.sock_pub.send_multipart(data)
-
-
-    async def listen_topics_until(self, topics, term_pred, timeout=-1):
-        sock = g.ctx.socket(zmq.SUB)
-        sock.connect(self.PUB_ADDR)
-        for topic in topics:
-            sock.subscribe(topic)
-        poller = zmq.asyncio.Poller()
-        poller.register(sock, zmq.POLLIN)
-        parser = FixParser()
-        tic = time()
-        res = []
-        while True:
+    def add_listener(self, listener):
+        for topic in listener.topics:
+            self._listeners[topic].append(listener)
+
+
+    def remove_listener(self, listener):
+        for topic in listener.topics:
+            listeners = self._listeners[topic]
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                del self._listeners[topic]
+
+
+    async def listen_topics_until(self, topics, term_pred, timeout=-1,
+                                  idle_timeout=-1):
+        """Collect messages of topics until term_pred returns True.
+
+        After timeout milliseconds the messages received so far are
+        returned. With idle_timeout instead, asyncio.TimeoutError is raised
+        once no message has arrived for that many milliseconds.
+        """
+        listener = FIXListener(topics, term_pred)
+        self.add_listener(listener)
+        try:
             if timeout >= 0:
-                remaining = timeout - ((time() - tic) * 1000)
-                if remaining <= 0:
-                    break
-                evs = await poller.poll(remaining)
-                if not evs:
-                    break
-            msg_parts = await sock.recv_multipart()
-            msg_type = msg_parts[0]
-            parser.append_buffer(msg_parts[1])
-            msg = parser.get_message()
-            res.append(msg)
-            if term_pred(msg):
-                break
-        sock.close()
-        return res
+                await asyncio.wait([listener.future], timeout=timeout / 1000)
+                if listener.future.done():
+                    listener.future.result()
+            elif idle_timeout >= 0:
+                while True:
+                    received = len(listener.messages)
+                    await asyncio.wait([listener.future],
+                                       timeout=idle_timeout / 1000)
+                    if listener.future.done():
+                        listener.future.result()
+                        break
+                    if len(listener.messages) == received:
+                        raise asyncio.TimeoutError()
+            else:
+                await listener.future
+        finally:
+            self.remove_listener(listener)
+        return listener.messages
 
 
     HANDLERS = {
@@ -1274,6 +2333,43 @@ class FIXReader:
 ###############################################################################
 
 
+# Reads straight into FIXReader's receive buffer. The read size is doubled
+# whenever a read fills the whole buffer and halved when reads stay small, so
+# bursts are drained with few syscalls and coroutine switches.
+class FIXProtocol(asyncio.BufferedProtocol):
+
+    MIN_READ_SIZE = 4096
+    MAX_READ_SIZE = 1024 * 1024
+
+    def __init__(self, fix_reader):
+        self._fix_reader = fix_reader
+        self._read_size = self.MIN_READ_SIZE
+
+
+    def get_buffer(self, sizehint):
+        return self._fix_reader.get_buffer(self._read_size)
+
+
+    def buffer_updated(self, nbytes):
+        if nbytes >= self._read_size:
+            self._read_size = min(self._read_size * 2, self.MAX_READ_SIZE)
+        elif nbytes < self._read_size // 4:
+            self._read_size = max(self._read_size // 2, self.MIN_READ_SIZE)
+        self._fix_reader.buffer_updated(nbytes)
+
+
+    def eof_received(self):
+        self._fix_reader.disconnected()
+
+
+    def connection_lost(self, exc):
+        if self._fix_reader.connected:
+            self._fix_reader.disconnected()
+
+
+###############################################################################
+
+
 class FIXClient:
 
 
@@ -1284,6 +2380,26 @@ class FIXClient:
         self._sec_req_id = 0
         self._test_req_id = 0
         self._md_req_id = 0
+        # dict_to_key(data) -> [task of the SecurityDefinitionRequest in
+        # flight, number of waiters, scheduler priority, scheduler admission
+        # future]
+        self._secdef_requests = {}
+        self.secdef_requests_coalesced = 0
+        # Queries refreshed in the background: the SecdefWarmup ones and
+        # the most recently requested ones that reached the cache, least
+        # recently requested first.
+        self._secdef_warmup = {dict_to_key(data): data for data
+                               in settings.get("SecdefWarmup", [])}
+        self._secdef_queries = OrderedDict()
+        self._secdef_queries_max = settings.get("SecdefRefreshMaxQueries",
+                                                256)
+        self._secdef_last_request = 0
+        self.secdef_scheduler = SecdefScheduler(
+                settings.get("SecdefRequestRate", 2.0),
+                settings.get("SecdefRequestBurst", 4),
+                settings.get("SecdefMaxInFlight", 1),
+                # slots only single instrument lookups may use
+                settings.get("SecdefReservedInFlight", 1))
 
 
     def create_fix_msg(self, msg_type):
@@ -1302,7 +2418,7 @@ class FIXClient:
         seq_num = g.fix_seq_num_tx
         g.fix_seq_num_tx += 1
         msg.append_pair(Fields.MsgSeqNum, seq_num)
-        sending_time = datetime.utcnow().strftime("%Y%m%d-%H:%M:%S.%f")[:-3]
+        sending_time = g.utc_timestamp.encode()
         msg.append_pair(Fields.SendingTime, sending_time)
         L.debug("> {}".format(msg))
         self._writer.write(msg.encode())
@@ -1315,10 +2431,18 @@ class FIXClient:
         sslctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
         sslctx.verify_mode = ssl.CERT_REQUIRED
         sslctx.load_default_certs()
-        reader, self._writer = await asyncio.open_connection(
-                self._settings["IP"], self._settings["Port"], ssl=sslctx)
-        self._reader = FIXReader(reader)
-        create_task(self._reader.read_forever())
+        # "stream" (default) or "protocol"
+        transport = self._settings.get("Transport", "stream")
+        if transport == "protocol":
+            self._reader = FIXReader()
+            self._writer, _ = await g.loop.create_connection(
+                    lambda: FIXProtocol(self._reader),
+                    self._settings["IP"], self._settings["Port"], ssl=sslctx)
+        else:
+            reader, self._writer = await asyncio.open_connection(
+                    self._settings["IP"], self._settings["Port"], ssl=sslctx)
+            self._reader = FIXReader(reader)
+            create_task(self._reader.read_forever())
 
         L.debug("FIXClient: sending Logon ...")
         msg = self.create_fix_msg(fix.MsgType.Logon)
@@ -1369,14 +2493,189 @@ class FIXClient:
             await asyncio.sleep(20)
 
 
-    async def security_definition_request(self, data):
+    async def security_definition_request(self, data, priority=None):
 
-        with tcache.open(g.secdefs_cache, "r", timedelta(days=1)) as c:
-            key = dict_to_key(data)
-            res = c.get(key)
-            if res:
-                L.debug("cache hit: {} results".format(len(res)))
-                return res
+        res = g.secdef_index.lookup(data)
+        if res:
+            L.debug("index hit: {} results".format(len(res)))
+            return res
+
+        key = dict_to_key(data)
+        self._remember_secdef_query(key, data)
+        self._secdef_last_request = g.loop.time()
+        # The cache file lock is waited for asynchronously, so another
+        # process writing the cache does not stall the event loop. A busy
+        # cache is treated as a miss. One lookup tells fresh, stale and
+        # missing responses apart.
+        holder = await self._cached_secdefs(key)
+        res = stale = None
+        if holder and tcache.is_fresh(holder, SECDEFS_TTL):
+            res = holder["data"]
+        elif holder and tcache.is_fresh(holder,
+                                        SECDEFS_TTL + SECDEFS_MAX_STALE):
+            stale = holder["data"]
+        if res:
+            L.debug("cache hit: {} results".format(len(res)))
+            if g.secdef_index.add(data, res):
+                for msg in res:
+                    register_tick_size(msg)
+            return res
+
+        # Stale-while-revalidate: an expired response is served as is
+        # while a background request refreshes it.
+        res = stale
+        if res:
+            L.debug("stale cache hit: {} results, refreshing"
+                    .format(len(res)))
+            for msg in res:
+                register_tick_size(msg)
+            self._refresh_security_definitions(data, key)
+            return res
+
+        # Identical concurrent requests share one upstream request. The
+        # shield keeps a cancelled waiter from cancelling it for the others,
+        # the request itself is cancelled when its last waiter goes away.
+        entry = self._secdef_request(data, key, priority)
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done():
+                task.cancel()
+
+
+    async def _cached_secdefs(self, key):
+        try:
+            return await g.secdefs.get_holder_async(
+                    key, timeout=g.secdefs_lock_timeout)
+        except filock.LockTimeout:
+            L.warning("secdefs cache busy: {}".format(key))
+            return None
+
+
+    def _remember_secdef_query(self, key, data):
+        if key in self._secdef_warmup:
+            return
+        queries = self._secdef_queries
+        queries[key] = data
+        queries.move_to_end(key)
+        while len(queries) > self._secdef_queries_max:
+            queries.popitem(last=False)
+
+
+    def _secdef_request(self, data, key, priority=None):
+        if priority is None:
+            priority = secdef_priority(data)
+        entry = self._secdef_requests.get(key)
+        if entry is None:
+            entry = [None, 0, priority, g.loop.create_future()]
+            task = create_task(
+                    self._fetch_security_definitions(data, key, entry))
+            entry[0] = task
+            self._secdef_requests[key] = entry
+            def done(task):
+                if self._secdef_requests.get(key) is entry:
+                    del self._secdef_requests[key]
+                if not task.cancelled():
+                    # retrieved even if every waiter is gone
+                    task.exception()
+            task.add_done_callback(done)
+        else:
+            self.secdef_requests_coalesced += 1
+            L.debug("joining in-flight secdef request: {}".format(key))
+            if priority < entry[2]:
+                # a user request joining a background refresh
+                entry[2] = priority
+                self.secdef_scheduler.raise_priority(entry[3], priority)
+        return entry
+
+
+    def _refresh_security_definitions(self, data, key):
+        """Start a background refresh of one cached query."""
+        entry = self._secdef_request(data, key, SECDEF_PRIORITY_BACKGROUND)
+        if entry[1] == 0:
+            # holds a waiter slot of its own, so it is not cancelled when the
+            # waiters of a coalesced user request go away
+            entry[1] += 1
+        return entry[0]
+
+
+    def _secdefs_quiet(self):
+        idle = self._settings.get("SecdefRefreshIdle", 30)
+        if g.loop.time() - self._secdef_last_request < idle:
+            return False
+        stats = self.secdef_scheduler.get_stats()
+        return not stats["queue_depth"] and not stats["in_flight"]
+
+
+    async def secdef_refresher(self):
+        """Refresh cached queries that approach expiry in quiet periods."""
+        interval = self._settings.get("SecdefRefreshInterval", 60)
+        ahead = timedelta(seconds=self._settings.get("SecdefRefreshAhead",
+                                                     2 * 3600))
+        while self._reader.connected:
+            await asyncio.sleep(interval)
+            queries = list(self._secdef_warmup.items()) \
+                    + list(self._secdef_queries.items())
+            for key, data in queries:
+                if not self._secdefs_quiet():
+                    break
+                if key in self._secdef_requests:
+                    continue
+                try:
+                    holder = await g.secdefs.get_holder_async(
+                            key, timeout=g.secdefs_lock_timeout)
+                except filock.LockTimeout:
+                    continue
+                if holder and tcache.is_fresh(holder, SECDEFS_TTL - ahead):
+                    continue
+                if not holder or not holder["data"] or not tcache.is_fresh(
+                        holder, SECDEFS_TTL + SECDEFS_MAX_STALE):
+                    # failed or long expired requests are not retried in the
+                    # background, drop them until they are requested again
+                    self._secdef_queries.pop(key, None)
+                    continue
+                L.debug("refreshing secdefs: {}".format(key))
+                try:
+                    await asyncio.shield(
+                            self._refresh_security_definitions(data, key))
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    L.exception("secdef refresh failed: {}".format(key))
+
+
+    async def warm_up_secdefs(self):
+        """Fetch the profile's SecdefWarmup queries unless cached."""
+        for data in self._secdef_warmup.values():
+            try:
+                await self.security_definition_request(
+                        data, SECDEF_PRIORITY_BACKGROUND)
+            except Exception:
+                L.exception("secdef warm-up failed: {}".format(data))
+
+
+    async def _fetch_security_definitions(self, data, key, entry):
+        # Multiple simulateous ongoing SecurityDefinitionRequests may result
+        # in forced disconnection ... the scheduler admits one at a time.
+        # The priority is read here, it may have been raised since the
+        # request was created.
+        scheduler = self.secdef_scheduler
+        await scheduler.acquire(entry[2], entry[3])
+        # Once sent, the request runs to completion even if every waiter is
+        # gone, so CTS is not asked again while it is still answering.
+        task = create_task(self._request_security_definitions(data, key))
+        def done(task):
+            scheduler.release()
+            if not task.cancelled():
+                task.exception()
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
+
+
+    async def _request_security_definitions(self, data, key):
 
         msg = self.create_fix_msg(fix.MsgType.SecurityDefinitionRequest)
         msg.append_pair(Fields.SecurityType, data["SecurityType"])
@@ -1405,43 +2704,63 @@ class FIXClient:
         msg.append_pair(Fields.SecurityReqID, sec_req_id)
         sec_req_id_bytes = msg.get(Fields.SecurityReqID)
 
-        # Multiple simulateous ongoing SecurityDefinitionRequests may result
-        # in forced disconnection ...
-        async with g.sec_def_lock:
-
-            self._send_fix_msg(msg)
+        self._send_fix_msg(msg)
 
-            topics = [fix.MsgType.SecurityDefinition]
-            term_state = {
-                "count": 0
-            }
-            def term_pred(msg):
-                max_count = int(msg.get(Fields.TotNumReports))
-                if msg.get(Fields.SecurityReqID) == sec_req_id_bytes:
-                    term_state["count"] += 1
-                    # L.debug("count: {}".format(term_state["count"]))
-                if term_state["count"] >= max_count:
-                    L.debug("{} SecurityDefinition messages received"
-                            .format(term_state["count"]))
-                    return True
-                return False
-            res = await self._reader.listen_topics_until(topics, term_pred)
-            res = [x for x in res
-                   if x.get(Fields.SecurityReqID) == sec_req_id_bytes]
+        topics = [fix.MsgType.SecurityDefinition]
+        term_state = {
+            "count": 0
+        }
+        def term_pred(msg):
+            max_count = int(msg.get(Fields.TotNumReports))
+            if msg.get(Fields.SecurityReqID) == sec_req_id_bytes:
+                term_state["count"] += 1
+                # L.debug("count: {}".format(term_state["count"]))
+            if term_state["count"] >= max_count:
+                L.debug("{} SecurityDefinition messages received"
+                        .format(term_state["count"]))
+                return True
+            return False
+        # Without an answer the request would hold the scheduler slot
+        # forever. Failing the task releases it and fails its waiters.
+        idle = self._settings.get("SecdefRequestTimeout", 30)
+        try:
+            res = await self._reader.listen_topics_until(
+                    topics, term_pred, idle_timeout=idle * 1000)
+        except asyncio.TimeoutError:
+            L.warning("no SecurityDefinition received for {} s: {}"
+                      .format(idle, key))
+            raise BusinessMessageRejectException(
+                    "SecurityDefinitionRequest timed out")
+        res = [x for x in res
+               if x.get(Fields.SecurityReqID) == sec_req_id_bytes]
+
+        if len(res) == 1 \
+                and res[0].gets(Fields.SecurityResponseType) == "5":
+            # Reject Security Proposal
+            err_msg = res[0].gets(Fields.SecurityDesc)
+            raise BusinessMessageRejectException("Rejected: " + err_msg)
+
+        # Stored column-wise, a cache hit loads a few arrays instead of
+        # unpickling every message. Lists written by older versions are
+        # still returned as they are.
+        table = FixTable(res)
+        try:
+            await g.secdefs.set_async(key, table,
+                                      timeout=g.secdefs_lock_timeout)
+        except filock.LockTimeout:
+            L.warning("secdefs cache busy, not cached: {}".format(key))
 
-            if len(res) == 1 \
-                    and res[0].gets(Fields.SecurityResponseType) == "5":
-                # Reject Security Proposal
-                err_msg = res[0].gets(Fields.SecurityDesc)
-                raise BusinessMessageRejectException("Rejected: " + err_msg)
+        # the table, so that cache hits of it are recognized by the index
+        g.secdef_index.add(data, table)
+        return res
 
-            with tcache.open(g.secdefs_cache, "w", timedelta(days=1)) as c:
-                key = dict_to_key(data)
-                c[key] = res
+    
+    def publish_book_snapshot(self, sec_id, ticks=None, depth=None,
+                              encodings=None):
+        self._reader.publish_book_snapshot(sec_id, g.subscriptions[sec_id],
+                                           ticks, depth, encodings)
 
-            return res
 
-    
     async def send_market_data_request(self, data):
 
         msg = self.create_fix_msg(fix.MsgType.MarketDataRequest)
@@ -1489,6 +2808,7 @@ class FIXClient:
             sub["initial_snapshot_completed"] = False
             sub["last_snap_received"] = 0
             sub["max_levels"] = data["MarketDepth"]
+            sub["book"] = OrderBook(sub["max_levels"])
 
             topics = [
                 fix.MsgType.MarketDataRequestReject,
@@ -1533,6 +2853,16 @@ def parse_args():
     parser.add_argument("md_pub_addr",
                         help="address to bind to for MD pub socket")
     parser.add_argument("--log-level", default="INFO", help="logging level")
+    parser.add_argument("--conflation-window", type=float, default=0,
+                        help="coalesce book updates per ticker and side "
+                             "within this many milliseconds (0 = disabled)")
+    parser.add_argument("--pub-envelopes", action="store_true",
+                        help="publish consecutive updates with the same "
+                             "topic as one multipart message")
+    parser.add_argument("--pub-encoding", default="json",
+                        choices=sorted(PUB_ENCODERS),
+                        help="wire encoding of W/X messages for subscriptions "
+                             "that do not set ZMPubEncoding")
     args = parser.parse_args()
     try:
         args.log_level = int(args.log_level)
@@ -1552,7 +2882,6 @@ def get_working_dirs(args):
     g.cache_dir = os.path.join(g.profile_dir, "cache")
     makedirs(g.cache_dir)
     g.secdefs_cache = os.path.join(g.cache_dir, "secdefs.cache")
-    tcache.ensure_exists(g.secdefs_cache)
 
 
 def load_settings():
@@ -1561,11 +2890,39 @@ def load_settings():
         return json.load(f)
 
 
+def open_secdefs_cache(settings):
+    # In snapshot mode lookups never wait for a writer. Each publish copies
+    # the cache file, so writes are batched, and it suits profiles shared by
+    # several processes. A cache written without snapshots is taken over.
+    snapshots = settings.get("SecdefsCacheSnapshots", False)
+    # secdef lists repeat the same strings on every row and compress well
+    compression = settings.get("SecdefsCacheCompression", "zlib")
+    # seconds a secdef request waits for the cache file lock
+    g.secdefs_lock_timeout = settings.get("SecdefsCacheLockTimeout", 1.0)
+    tcache.ensure_exists(g.secdefs_cache, snapshots)
+    # once for caches written by older versions, writes are refused until
+    # their index is rebuilt
+    if tcache.migrate(g.secdefs_cache, snapshots):
+        L.info("secdefs cache index rebuilt: {}".format(g.secdefs_cache))
+    g.secdefs = tcache.open_handle(
+            g.secdefs_cache, SECDEFS_TTL,
+            snapshots=snapshots,
+            compression=compression,
+            max_bytes=settings.get("SecdefsCacheMaxBytes"),
+            eviction=settings.get("SecdefsCacheEviction", "lru"),
+            # seconds and number of writes a snapshot is held back for
+            publish_interval=settings.get("SecdefsCachePublishInterval", 1.0),
+            publish_batch=settings.get("SecdefsCachePublishBatch", 64))
+
+
 def init_zmq_sockets(args):
     g.sock_ctl = g.ctx.socket(zmq.ROUTER)
     g.sock_ctl.bind(args.md_ctl_addr)
     g.sock_pub = g.ctx.socket(zmq.PUB)
     g.sock_pub.bind(args.md_pub_addr)
+    g.pub = PubBatcher(g.sock_pub, args.pub_envelopes)
+    g.md_encoders = {name: cls() for name, cls in PUB_ENCODERS.items()}
+    g.default_pub_encoding = args.pub_encoding
 
 
 def patch_simplefix():
@@ -1619,7 +2976,13 @@ def main():
     patch_simplefix()
     get_working_dirs(args)
     settings = load_settings()
+    open_secdefs_cache(settings)
     init_zmq_sockets(args)
+    if args.conflation_window > 0:
+        g.conflator = Conflator(args.conflation_window / 1000)
+    g.secdef_index = SecdefIndex(
+            SECDEFS_TTL.total_seconds(),
+            settings.get("SecdefIndexMaxDefinitions", 100000))
     g.ctl = MDController(g.sock_ctl)
     g.fix_client = FIXClient(settings)
     L.debug("starting event loop ...")
@@ -1631,6 +2994,8 @@ def main():
         g.loop.run_until_complete(asyncio.gather(*tasks))
     except KeyboardInterrupt:
         pass
+    # publishes the secdefs still queued
+    g.secdefs.close()
     L.debug("destroying zmq context ...")
     g.ctx.destroy()
 
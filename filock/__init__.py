@@ -1 +1,3 @@
 from .core import open_with_lock as open
+from .core import open_with_lock_async as open_async
+from .core import LockTimeout, LockStats, lock_stats
@@ -1,6 +1,9 @@
 import fcntl
 import sys
 import struct
+import asyncio
+import errno
+from time import monotonic
 
 # fcntl(2) - Linux man page:
 # struct flock {
@@ -48,6 +51,136 @@ def open_with_lock(fn, mode="r", **kwargs):
     fcntl_lock(f, cmd, lock_type, W_SEEK_SET, 0, 0)
     return f
 
+class LockTimeout(TimeoutError):
+    pass
+
+class LockStats:
+    """Counters of the lock waits of open_with_lock_async()."""
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, acquired=True):
+        if acquired:
+            self.acquired += 1
+        else:
+            self.timeouts += 1
+        if wait:
+            self.contended += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def get_stats(self):
+        d = {}
+        d["acquired"] = self.acquired
+        d["contended"] = self.contended
+        d["timeouts"] = self.timeouts
+        d["wait_time"] = self.wait_time
+        d["max_wait"] = self.max_wait
+        return d
+
+lock_stats = LockStats()
+
+def _try_lock(f, lock_type):
+    try:
+        fcntl_lock(f, fcntl.F_SETLK, lock_type, W_SEEK_SET, 0, 0)
+    except OSError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+def _lock_type(mode):
+    if "w" in mode or "a" in mode:
+        return fcntl.F_WRLCK
+    return fcntl.F_RDLCK
+
+async def open_with_lock_async(fn, mode="r", timeout=None, thread=False,
+                               min_delay=0.001, max_delay=0.05, loop=None,
+                               **kwargs):
+    """Open fn and lock the whole file without blocking the event loop.
+
+    F_SETLK is tried first, so an uncontended lock costs one syscall and
+    no suspension. On contention the coroutine retries with exponential
+    backoff between min_delay and max_delay seconds or, with thread=True
+    and no timeout, waits in F_SETLKW on an executor thread. Raises
+    LockTimeout if the lock is not acquired within timeout seconds. Waits
+    are counted in lock_stats.
+
+    fcntl locks belong to the process: they do not exclude other
+    coroutines or threads of the same process, and closing any descriptor
+    of the file releases all of them. Do not await while holding the lock.
+    A waiting thread cannot be interrupted, so a timeout always backs off.
+    If the coroutine is cancelled while a thread waits, the thread closes
+    its descriptor when it wakes, which releases any other lock this
+    process then holds on the file: do not cancel thread=True waits on
+    files the process locks elsewhere.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    lock_type = _lock_type(mode)
+    f = open(fn, mode, **kwargs)
+    try:
+        if _try_lock(f, lock_type):
+            lock_stats.record(0)
+            return f
+    except BaseException:
+        f.close()
+        raise
+    t0 = monotonic()
+    try:
+        if thread and timeout is None:
+            # closes f itself on failure
+            await _wait_in_thread(f, lock_type, loop)
+        else:
+            try:
+                await _wait_with_backoff(f, lock_type, timeout, t0,
+                                         min_delay, max_delay)
+            except BaseException:
+                f.close()
+                raise
+    except LockTimeout:
+        lock_stats.record(monotonic() - t0, acquired=False)
+        raise
+    lock_stats.record(monotonic() - t0)
+    return f
+
+async def _wait_with_backoff(f, lock_type, timeout, t0, min_delay, max_delay):
+    delay = min_delay
+    while True:
+        if timeout is not None:
+            remaining = timeout - (monotonic() - t0)
+            if remaining <= 0:
+                raise LockTimeout(f.name)
+            delay = min(delay, remaining)
+        await asyncio.sleep(delay)
+        if _try_lock(f, lock_type):
+            return
+        delay = min(delay * 2, max_delay)
+
+def _lock_in_thread(f, lock_type, abandoned):
+    fcntl_lock(f, fcntl.F_SETLKW, lock_type, W_SEEK_SET, 0, 0)
+    if abandoned:
+        # release the lock at once instead of after a loop iteration
+        f.close()
+
+async def _wait_in_thread(f, lock_type, loop):
+    abandoned = []
+    fut = loop.run_in_executor(None, _lock_in_thread, f, lock_type,
+                               abandoned)
+    try:
+        await asyncio.shield(fut)
+    except BaseException:
+        # The blocked thread cannot be interrupted, it closes f once it
+        # returns.
+        abandoned.append(True)
+        fut.add_done_callback(lambda _: f.close())
+        raise
+
 # def lock(fn, lock_type, blocking=True):
 #     if blocking:
 #         cmd = fcntl.F_SETLKW
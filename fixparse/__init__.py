@@ -0,0 +1,3 @@
+from .core import FixMessageView, FixFramer, GROUP_TAGS
+from .table import FixTable, FixRow
+from .utctime import UTCTimestampCodec
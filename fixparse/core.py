@@ -0,0 +1,307 @@
+# Zero-copy FIX framing and indexed message views.
+#
+# FixFramer frames messages straight out of one reusable receive buffer by
+# reading BodyLength, and hands them out as FixMessageView objects that
+# reference the buffer by offsets instead of copying message bytes.
+#
+# FixMessageView builds a tag -> position index and a repeating group index
+# in one pass over the fields, so that field and group member lookups do not
+# need to walk the whole message like FixMessage.get does.
+#
+# A view returned by FixFramer is only valid until the framer receives more
+# data. Call detach() on messages that need to be kept around.
+
+# Repeating groups that get an instance index, keyed by their NoXXX tag:
+# NoMDEntries, NoLegs, NoSecurityAltID.
+GROUP_TAGS = frozenset([268, 555, 454])
+
+SOH = b"\x01"
+
+# length of the "10=XXX\x01" trailer
+CHECKSUM_LEN = 7
+
+# larger BodyLength values are taken for garbage rather than waited for
+MAX_BODY_LEN = 1 << 24
+
+
+class FixMessageView:
+
+    def __init__(self, buf, start=0, end=None, group_tags=GROUP_TAGS):
+        if end is None:
+            end = len(buf)
+        self._buf = buf
+        self._base = start
+        self._len = end - start
+        self._build_index(group_tags)
+
+    def _build_index(self, group_tags):
+        buf = self._buf
+        find = buf.find
+        base = self._base
+        end = base + self._len
+        tags = []
+        voffs = []
+        first = {}
+        repeats = {}
+        groups = {}
+        instances = None
+        delim = None
+        cur = None
+        pos = 0
+        i = base
+        while i < end:
+            eq = find(b"=", i, end)
+            if eq < 0:
+                break
+            tag = int(buf[i:eq])
+            tags.append(tag)
+            voffs.append(eq + 1 - base)
+            i = find(SOH, eq, end)
+            if i < 0:
+                i = end
+            i += 1
+            if tag in first:
+                positions = repeats.get(tag)
+                if positions is None:
+                    repeats[tag] = [first[tag], pos]
+                else:
+                    positions.append(pos)
+            else:
+                first[tag] = pos
+            if tag in group_tags:
+                instances = []
+                delim = None
+            elif instances is not None:
+                # first field of a repeating group is its delimiter
+                if delim is None:
+                    delim = tag
+                    groups[delim] = instances
+                if tag == delim:
+                    cur = {}
+                    instances.append(cur)
+                if tag not in cur:
+                    cur[tag] = pos
+            pos += 1
+        self._tags = tags
+        self._voffs = voffs
+        self._first = first
+        self._repeats = repeats
+        self._groups = groups
+
+    def _value(self, pos):
+        # Values are returned as bytes whatever the buffer type, so they are
+        # hashable and decode like the values of FixMessage. Only the value
+        # is copied, never the message.
+        buf = self._buf
+        start = self._base + self._voffs[pos]
+        end = buf.find(SOH, start, self._base + self._len)
+        if end < 0:
+            end = self._base + self._len
+        if type(buf) is bytes:
+            return buf[start:end]
+        return bytes(memoryview(buf)[start:end])
+
+    def _scan(self, tag, nth, sep):
+        # same semantics as the patched FixMessage.get, used for separators
+        # that are not indexed group delimiters
+        for pos, t in enumerate(self._tags):
+            if t == sep:
+                nth -= 1
+            if t == tag and nth == 0:
+                return pos
+        return None
+
+    def _pos(self, tag, nth, sep):
+        if type(tag) is not int:
+            tag = int(tag)
+        if sep is None:
+            if nth == 1:
+                return self._first.get(tag)
+            positions = self._repeats.get(tag)
+            if positions is None:
+                return self._first.get(tag) if nth < 1 else None
+            if nth < 1:
+                return positions[0]
+            if nth > len(positions):
+                return None
+            return positions[nth - 1]
+        if type(sep) is not int:
+            sep = int(sep)
+        instances = self._groups.get(sep)
+        if instances is None:
+            return self._scan(tag, nth, sep)
+        if nth < 1 or nth > len(instances):
+            return None
+        return instances[nth - 1].get(tag)
+
+    def get(self, tag, nth=1, sep=None, default=None):
+        pos = self._pos(tag, nth, sep)
+        if pos is None:
+            return default
+        return self._value(pos)
+
+    def gets(self, tag, nth=1, sep=None, default=None):
+        res = self.get(tag, nth=nth, sep=sep, default=default)
+        if res:
+            return res.decode()
+        return res
+
+    def geti(self, tag, nth=1, sep=None, default=None):
+        res = self.get(tag, nth=nth, sep=sep, default=default)
+        if res:
+            return int(res)
+        return res
+
+    def getf(self, tag, nth=1, sep=None, default=None):
+        res = self.get(tag, nth=nth, sep=sep, default=default)
+        if res:
+            return float(res)
+        return res
+
+    def get_raw(self, tag, nth=1):
+        return self.get(tag, nth=nth)
+
+    def group_size(self, sep):
+        instances = self._groups.get(int(sep))
+        if instances is None:
+            return 0
+        return len(instances)
+
+    @property
+    def pairs(self):
+        return [(str(tag).encode(), self._value(pos))
+                for pos, tag in enumerate(self._tags)]
+
+    def detach(self):
+        # copy message bytes out of a shared receive buffer
+        if type(self._buf) is not bytes or self._base or \
+                self._len != len(self._buf):
+            self._buf = bytes(self.raw)
+            self._base = 0
+        return self
+
+    @property
+    def raw(self):
+        return memoryview(self._buf)[self._base:self._base + self._len]
+
+    def encode(self):
+        return bytes(self.raw)
+
+    def __getstate__(self):
+        self.detach()
+        return self.__dict__
+
+    def __str__(self):
+        s = "FixMessage ({})\n".format(self.gets(35))
+        for pos, tag in enumerate(self._tags):
+            if tag == 35:
+                continue
+            s += "  {}={}\n".format(tag, self._value(pos).decode())
+        s = s[:-1]
+        return s
+
+
+class FixFramer:
+
+    def __init__(self, capacity=65536):
+        self._buf = bytearray(capacity)
+        self._rpos = 0
+        self._wpos = 0
+
+    def __len__(self):
+        return self._wpos - self._rpos
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    def _reserve(self, size):
+        # Make room for at least size bytes after the write position. Moves
+        # the unconsumed tail to the front of the buffer, which invalidates
+        # views handed out earlier. Grows by allocating a new buffer rather
+        # than resizing, so lingering memoryviews never block it.
+        buf = self._buf
+        if len(buf) - self._wpos >= size:
+            return
+        pending = self._wpos - self._rpos
+        if pending + size <= len(buf):
+            if pending:
+                buf[:pending] = buf[self._rpos:self._wpos]
+        else:
+            capacity = len(buf)
+            while capacity < pending + size:
+                capacity *= 2
+            new_buf = bytearray(capacity)
+            new_buf[:pending] = buf[self._rpos:self._wpos]
+            self._buf = new_buf
+        self._rpos = 0
+        self._wpos = pending
+
+    def get_buffer(self, size=4096):
+        self._reserve(size)
+        return memoryview(self._buf)[self._wpos:self._wpos + size]
+
+    def buffer_updated(self, nbytes):
+        self._wpos += nbytes
+
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        self._buf[self._wpos:self._wpos + n] = data
+        self._wpos += n
+
+    def _frame_end(self):
+        buf = self._buf
+        find = buf.find
+        wpos = self._wpos
+        # Anything that does not frame as a message is garbage: skip past
+        # its BeginString and resync on the next one.
+        while True:
+            rpos = self._rpos
+            start = find(b"8=", rpos, wpos)
+            if start < 0:
+                self._rpos = max(rpos, wpos - 1)
+                return None
+            self._rpos = start
+            soh = find(SOH, start, wpos)
+            if soh < 0 or soh + 3 > wpos:
+                return None
+            if buf[soh + 1:soh + 3] != b"9=":
+                self._rpos = start + 2
+                continue
+            soh2 = find(SOH, soh + 3, wpos)
+            if soh2 < 0:
+                return None
+            body_len = buf[soh + 3:soh2]
+            if not body_len.isdigit() or int(body_len) > MAX_BODY_LEN:
+                self._rpos = start + 2
+                continue
+            end = soh2 + 1 + int(body_len) + CHECKSUM_LEN
+            if end > wpos:
+                return None
+            if buf[end - CHECKSUM_LEN:end - CHECKSUM_LEN + 3] != b"10=":
+                # BodyLength does not match the message
+                self._rpos = start + 2
+                continue
+            return end
+
+    def get_message(self):
+        while True:
+            end = self._frame_end()
+            if end is None:
+                return None
+            try:
+                msg = FixMessageView(self._buf, self._rpos, end)
+            except ValueError:
+                # a tag that is not a number
+                self._rpos += 2
+                continue
+            self._rpos = end
+            return msg
+
+    def __iter__(self):
+        while True:
+            msg = self.get_message()
+            if msg is None:
+                return
+            yield msg
@@ -0,0 +1,274 @@
+# Column-oriented storage for lists of FIX messages.
+#
+# FixTable interns every field value into one string pool and keeps, per
+# tag, an array with the value id of its first occurrence in each message.
+# Tags that occur more than once in a message get per-message offsets into
+# one array of the value ids of all their occurrences. Every repeating group
+# gets per-message instance offsets plus one array per member tag, indexed
+# the same way FixMessageView indexes groups. The field
+# order of each message is kept in flat tag/value arrays for encode() and
+# for separators that are not group delimiters.
+#
+# A pickled table is a handful of arrays and the string pool, so loading it
+# does not construct an object per message. FixRow objects are created on
+# indexing and offer the lookup API of FixMessageView.
+
+from array import array
+
+from .core import FixMessageView, GROUP_TAGS, SOH
+
+MISSING = -1
+
+
+def _missing(n):
+    return array("i", [MISSING]) * n
+
+
+class FixTable:
+
+    def __init__(self, msgs=(), group_tags=GROUP_TAGS):
+        self.group_tags = group_tags
+        self.strings = []
+        # tag -> value id per message, may be shorter than the table
+        self.columns = {}
+        # repeated tag -> (offsets per message, value ids of all occurrences)
+        self.repeats = {}
+        # delimiter tag -> (instance offsets per message, {tag: value ids})
+        self.groups = {}
+        self.tags = array("i")
+        self.values = array("i")
+        self.offsets = array("i", [0])
+        self._ids = {}
+        self.extend(msgs)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [FixRow(self, row) for row in range(len(self))[idx]]
+        n = len(self)
+        if idx < 0:
+            idx += n
+        if idx < 0 or idx >= n:
+            raise IndexError(idx)
+        return FixRow(self, idx)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield FixRow(self, row)
+
+    def __eq__(self, other):
+        # every other attribute is derived from these
+        if not isinstance(other, FixTable):
+            return NotImplemented
+        return (self.tags == other.tags and self.values == other.values
+                and self.strings == other.strings
+                and self.group_tags == other.group_tags)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        del d["_ids"]
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._ids = None
+        if self.repeats and isinstance(next(iter(self.repeats)), tuple):
+            self._convert_repeats()
+
+    def _convert_repeats(self):
+        # pickled by versions that kept an array per (row, repeated tag)
+        old = self.repeats
+        self.repeats = {}
+        for row, tag in sorted(old, key=lambda k: (k[1], k[0])):
+            self._add_repeats(row, tag, old[(row, tag)])
+
+    def _add_repeats(self, row, tag, ids):
+        rep = self.repeats.get(tag)
+        if rep is None:
+            rep = self.repeats[tag] = (array("i", [0]) * (row + 1),
+                                       array("i"))
+        offsets, values = rep
+        if len(offsets) < row + 1:
+            offsets.extend(array("i", [offsets[-1]])
+                           * (row + 1 - len(offsets)))
+        values.extend(ids)
+        offsets.append(len(values))
+
+    def _intern(self, value):
+        ids = self._ids
+        if ids is None:
+            ids = self._ids = {s: i for i, s in enumerate(self.strings)}
+        i = ids.get(value)
+        if i is None:
+            i = ids[value] = len(self.strings)
+            self.strings.append(value)
+        return i
+
+    def extend(self, msgs):
+        for msg in msgs:
+            self.append(msg)
+
+    def append(self, msg):
+        if not isinstance(msg, FixMessageView):
+            msg = FixMessageView(msg.encode(), group_tags=self.group_tags)
+        row = len(self)
+        ids = [self._intern(msg._value(pos))
+               for pos in range(len(msg._tags))]
+        self.tags.extend(msg._tags)
+        self.values.extend(ids)
+        self.offsets.append(len(self.tags))
+
+        for tag, pos in msg._first.items():
+            col = self.columns.get(tag)
+            if col is None:
+                col = self.columns[tag] = _missing(row)
+            elif len(col) < row:
+                col.extend(_missing(row - len(col)))
+            col.append(ids[pos])
+
+        for tag, positions in msg._repeats.items():
+            self._add_repeats(row, tag, [ids[p] for p in positions])
+
+        for delim, instances in msg._groups.items():
+            grp = self.groups.get(delim)
+            if grp is None:
+                grp = self.groups[delim] = (array("i", [0]) * (row + 1), {})
+            offsets, cols = grp
+            if len(offsets) < row + 1:
+                offsets.extend(array("i", [offsets[-1]])
+                               * (row + 1 - len(offsets)))
+            start = offsets[-1]
+            for k, inst in enumerate(instances):
+                for tag, pos in inst.items():
+                    col = cols.get(tag)
+                    if col is None:
+                        col = cols[tag] = _missing(start + k)
+                    elif len(col) < start + k:
+                        col.extend(_missing(start + k - len(col)))
+                    col.append(ids[pos])
+            offsets.append(start + len(instances))
+
+
+class FixRow:
+
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def _instances(self, sep):
+        grp = self._table.groups.get(sep)
+        if grp is None:
+            return None, None, 0
+        offsets, cols = grp
+        row = self._row
+        if row + 1 >= len(offsets):
+            return cols, 0, 0
+        return cols, offsets[row], offsets[row + 1] - offsets[row]
+
+    def _scan(self, tag, nth, sep):
+        t = self._table
+        tags = t.tags
+        for i in range(t.offsets[self._row], t.offsets[self._row + 1]):
+            if tags[i] == sep:
+                nth -= 1
+            if tags[i] == tag and nth == 0:
+                return t.values[i]
+        return MISSING
+
+    def _id(self, tag, nth, sep):
+        t = self._table
+        row = self._row
+        if type(tag) is not int:
+            tag = int(tag)
+        if sep is None:
+            if nth > 1:
+                rep = t.repeats.get(tag)
+                if rep is None:
+                    return MISSING
+                offsets, values = rep
+                if row + 1 >= len(offsets):
+                    return MISSING
+                i = offsets[row] + nth - 1
+                if i >= offsets[row + 1]:
+                    return MISSING
+                return values[i]
+            col = t.columns.get(tag)
+            if col is None or row >= len(col):
+                return MISSING
+            return col[row]
+        if type(sep) is not int:
+            sep = int(sep)
+        cols, start, count = self._instances(sep)
+        if not count:
+            return self._scan(tag, nth, sep)
+        if nth < 1 or nth > count:
+            return MISSING
+        col = cols.get(tag)
+        i = start + nth - 1
+        if col is None or i >= len(col):
+            return MISSING
+        return col[i]
+
+    def get(self, tag, nth=1, sep=None, default=None):
+        i = self._id(tag, nth, sep)
+        if i == MISSING:
+            return default
+        return self._table.strings[i]
+
+    def gets(self, tag, nth=1, sep=None, default=None):
+        res = self.get(tag, nth=nth, sep=sep, default=default)
+        if res:
+            return res.decode()
+        return res
+
+    def geti(self, tag, nth=1, sep=None, default=None):
+        res = self.get(tag, nth=nth, sep=sep, default=default)
+        if res:
+            return int(res)
+        return res
+
+    def getf(self, tag, nth=1, sep=None, default=None):
+        res = self.get(tag, nth=nth, sep=sep, default=default)
+        if res:
+            return float(res)
+        return res
+
+    def get_raw(self, tag, nth=1):
+        return self.get(tag, nth=nth)
+
+    def group_size(self, sep):
+        return self._instances(int(sep))[2]
+
+    @property
+    def pairs(self):
+        t = self._table
+        start = t.offsets[self._row]
+        end = t.offsets[self._row + 1]
+        return [(str(tag).encode(), t.strings[i])
+                for tag, i in zip(t.tags[start:end], t.values[start:end])]
+
+    def detach(self):
+        return self
+
+    def encode(self):
+        return b"".join(tag + b"=" + value + SOH for tag, value in self.pairs)
+
+    @property
+    def raw(self):
+        return memoryview(self.encode())
+
+    def view(self):
+        return FixMessageView(self.encode(), group_tags=self._table.group_tags)
+
+    def __reduce__(self):
+        # pickled on its own, a row becomes a standalone message
+        return (FixMessageView, (self.encode(),))
+
+    def __str__(self):
+        return str(self.view())
@@ -0,0 +1,59 @@
+# FIX UTCTimestamp ("YYYYMMDD-HH:MM:SS[.sss...]") codec.
+#
+# Consecutive timestamps almost always share their date and second, so the
+# epoch of the last seen date and second prefixes is cached and only the
+# changing suffix is parsed arithmetically.
+
+import calendar
+import time
+
+SECOND_PREFIX_LEN = 17  # YYYYMMDD-HH:MM:SS
+DATE_PREFIX_LEN = 8  # YYYYMMDD
+
+FRAC_SCALE = [10 ** (9 - i) for i in range(10)]
+MILLIS = [".{:03d}".format(i) for i in range(1000)]
+
+
+class UTCTimestampCodec:
+
+    def __init__(self):
+        self._date_prefix = None
+        self._date_epoch = 0
+        self._second_prefix = None
+        self._second_epoch_ns = 0
+        self._enc_second = None
+        self._enc_prefix = None
+
+    def _second_epoch(self, s):
+        if not s.startswith(self._date_prefix or "\0"):
+            self._date_prefix = s[:DATE_PREFIX_LEN]
+            self._date_epoch = calendar.timegm(
+                    (int(s[0:4]), int(s[4:6]), int(s[6:8]), 0, 0, 0))
+        return self._date_epoch \
+                + int(s[9:11]) * 3600 + int(s[12:14]) * 60 + int(s[15:17])
+
+    def decode_ns(self, s):
+        if s is None:
+            return None
+        if type(s) is not str:
+            s = s.decode()
+        if not s.startswith(self._second_prefix or "\0"):
+            self._second_epoch_ns = self._second_epoch(s) * 1000000000
+            self._second_prefix = s[:SECOND_PREFIX_LEN]
+        ns = self._second_epoch_ns
+        if len(s) > SECOND_PREFIX_LEN + 1:
+            # digits beyond nanoseconds are dropped
+            frac = s[SECOND_PREFIX_LEN + 1:SECOND_PREFIX_LEN + 10]
+            ns += int(frac) * FRAC_SCALE[len(frac)]
+        return ns
+
+    def encode(self, t=None):
+        # millisecond precision, like datetime.strftime(...)[:-3]
+        if t is None:
+            t = time.time()
+        second, ms = divmod(int(t * 1000), 1000)
+        if second != self._enc_second:
+            self._enc_prefix = time.strftime("%Y%m%d-%H:%M:%S",
+                                             time.gmtime(second))
+            self._enc_second = second
+        return self._enc_prefix + MILLIS[ms]
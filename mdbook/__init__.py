@@ -0,0 +1,3 @@
+from .core import (Ladder, OrderBook, LADDER_ENTRY_TYPES,
+                   DESCENDING_ENTRY_TYPES)
+from .ticks import TickSize, TickTable, UNIT_TICK_SIZE
@@ -0,0 +1,193 @@
+from array import array
+
+# One side of a price level book with a fixed number of levels.
+#
+# Prices and sizes live in preallocated array("q") buffers. Inserts and
+# deletes shift the levels in place through memoryviews, so no lists are
+# allocated or resliced per update. Positions are 0-based.
+
+class Ladder:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.prices = array("q", [0]) * capacity
+        self.sizes = array("q", [0]) * capacity
+        self._pv = memoryview(self.prices)
+        self._sv = memoryview(self.sizes)
+        self.depth = 0
+
+    def __len__(self):
+        return self.depth
+
+    def __repr__(self):
+        return "Ladder({})".format(list(zip(self.prices[:self.depth],
+                                            self.sizes[:self.depth])))
+
+    def clear(self):
+        self.depth = 0
+
+    def price(self, pos):
+        if pos < 0 or pos >= self.depth:
+            raise IndexError(pos)
+        return self.prices[pos]
+
+    def size(self, pos):
+        if pos < 0 or pos >= self.depth:
+            raise IndexError(pos)
+        return self.sizes[pos]
+
+    def append(self, price, size=0):
+        n = self.depth
+        if n >= self.capacity:
+            return False
+        self.prices[n] = price
+        self.sizes[n] = size
+        self.depth = n + 1
+        return True
+
+    def insert(self, pos, price, size=0):
+        # Returns the price of the level pushed out of the ladder, or None.
+        if pos < 0:
+            raise IndexError(pos)
+        n = self.depth
+        if pos > n:
+            pos = n
+        if pos >= self.capacity:
+            return price
+        overflow = None
+        if n == self.capacity:
+            overflow = self.prices[n - 1]
+            n -= 1
+        else:
+            self.depth = n + 1
+        if pos < n:
+            self._pv[pos + 1:n + 1] = self._pv[pos:n]
+            self._sv[pos + 1:n + 1] = self._sv[pos:n]
+        self.prices[pos] = price
+        self.sizes[pos] = size
+        return overflow
+
+    def update(self, pos, size=None):
+        # Returns the price at pos.
+        if pos < 0 or pos >= self.depth:
+            raise IndexError(pos)
+        if size is not None:
+            self.sizes[pos] = size
+        return self.prices[pos]
+
+    def copy_levels(self):
+        return self.prices[:self.depth], self.sizes[:self.depth]
+
+    def diff(self, prices, sizes, descending):
+        # Positional (MDUpdateAction, pos, price, size) changes that turn
+        # the levels (prices, sizes) into the current ladder when applied in
+        # order. Both sides must be sorted, descending for bids.
+        res = []
+        i = 0
+        j = 0
+        pos = 0
+        n_old = len(prices)
+        n_new = self.depth
+        while i < n_old and j < n_new:
+            old_px = prices[i]
+            new_px = self.prices[j]
+            if old_px == new_px:
+                if sizes[i] != self.sizes[j]:
+                    res.append(("1", pos, new_px, self.sizes[j]))
+                i += 1
+                j += 1
+                pos += 1
+            elif (new_px > old_px) == descending:
+                res.append(("0", pos, new_px, self.sizes[j]))
+                j += 1
+                pos += 1
+            else:
+                res.append(("2", pos, old_px, sizes[i]))
+                i += 1
+        while i < n_old:
+            res.append(("2", pos, prices[i], sizes[i]))
+            i += 1
+        while j < n_new:
+            res.append(("0", pos, self.prices[j], self.sizes[j]))
+            j += 1
+            pos += 1
+        return res
+
+    def delete(self, pos):
+        # Returns the price of the removed level.
+        n = self.depth
+        if pos < 0 or pos >= n:
+            raise IndexError(pos)
+        price = self.prices[pos]
+        if pos < n - 1:
+            self._pv[pos:n - 1] = self._pv[pos + 1:n]
+            self._sv[pos:n - 1] = self._sv[pos + 1:n]
+        self.depth = n - 1
+        return price
+
+
+# ZM MDEntryTypes kept as price ladders: bid, offer, simulated sell price
+# and simulated buy price. Bids are ordered from the highest price down.
+LADDER_ENTRY_TYPES = "01EF"
+DESCENDING_ENTRY_TYPES = "0E"
+
+# Full book of one instrument: price ladders with sizes and levels, the last
+# trade, price limits, trading status and the latest value of any other
+# entry type (opening/settlement price, session high/low, ...).
+
+class OrderBook:
+
+    def __init__(self, max_levels):
+        self.max_levels = max_levels
+        self.ladders = {et: Ladder(max_levels) for et in LADDER_ENTRY_TYPES}
+        self.stats = {}
+        self.last_trade = None
+        self.price_limits = {}
+        self.trading_status = None
+        self.sending_time = None
+
+    def __getitem__(self, entry_type):
+        return self.ladders[entry_type]
+
+    def __repr__(self):
+        return "OrderBook({})".format(self.ladders)
+
+    def clear(self):
+        for ladder in self.ladders.values():
+            ladder.clear()
+        self.stats.clear()
+        self.last_trade = None
+        self.price_limits.clear()
+        self.trading_status = None
+
+    def set_stat(self, entry, action=None):
+        # MDUpdateAction "2" (delete) removes the entry type from the book
+        if action == "2":
+            self.stats.pop(entry["MDEntryType"], None)
+        else:
+            self.stats[entry["MDEntryType"]] = entry
+
+    def snapshot(self, entry_types=None, depth=None):
+        # MDFullGrp entries, MDPriceLevel is 1-based
+        if depth is None or depth > self.max_levels:
+            depth = self.max_levels
+        group = []
+        for et in LADDER_ENTRY_TYPES:
+            if entry_types is not None and et not in entry_types:
+                continue
+            ladder = self.ladders[et]
+            for pos in range(min(depth, ladder.depth)):
+                entry = {}
+                entry["MDEntryType"] = et
+                entry["MDEntryPx"] = float(ladder.prices[pos])
+                entry["MDEntrySize"] = float(ladder.sizes[pos])
+                entry["MDPriceLevel"] = pos + 1
+                group.append(entry)
+        for et, entry in sorted(self.stats.items()):
+            if entry_types is None or et in entry_types:
+                group.append(dict(entry))
+        if self.last_trade:
+            if entry_types is None or self.last_trade["MDEntryType"] \
+                    in entry_types:
+                group.append(dict(self.last_trade))
+        return group
@@ -0,0 +1,108 @@
+import re
+from fractions import Fraction
+
+# Tick sizes of CTS instruments.
+#
+# CTS prices are integers; PriceRatio converts them to real prices and
+# MinPriceIncrementAmount is the value of one tick. Both may carry extra
+# named tables for variable tick sizes, for example:
+#
+#   PriceRatio:              3125/100000 RTS(78125/10000000)
+#   MinPriceIncrementAmount: 31.25 RTS(7.8125)
+#
+# Everything is parsed into Fractions, so no precision is lost. A ratio
+# with a finite decimal expansion has an integer representation: the ratio
+# times the smallest power of ten that makes it whole (3125 for 1/32). That
+# integer is the MinPriceIncrement of the table and the scale that turns a
+# CTS price into the same representation with a single multiply.
+
+_TABLE_RE = re.compile(r"(\w+)\(([^)]*)\)")
+
+
+def parse_tick_field(s):
+    """Parse a PriceRatio or MinPriceIncrementAmount value.
+
+    Returns the main value and a dict of the named tables that follow it.
+    """
+    head, _, tail = s.strip().partition(" ")
+    tables = {name: Fraction(value.strip())
+              for name, value in _TABLE_RE.findall(tail)}
+    return Fraction(head), tables
+
+
+def decimal_exponent(x):
+    """Smallest k for which x * 10**k is an integer, None if there is none."""
+    d = x.denominator
+    k2 = k5 = 0
+    while d % 2 == 0:
+        d //= 2
+        k2 += 1
+    while d % 5 == 0:
+        d //= 5
+        k5 += 1
+    if d != 1:
+        return None
+    return max(k2, k5)
+
+
+class TickTable:
+
+    __slots__ = ("ratio", "amount", "exponent", "scale")
+
+    def __init__(self, ratio, amount=None):
+        self.ratio = ratio
+        self.amount = amount
+        self.exponent = decimal_exponent(ratio)
+        if self.exponent is None:
+            self.scale = None
+        else:
+            self.scale = int(ratio * 10 ** self.exponent)
+
+    def __repr__(self):
+        return "TickTable({}, {})".format(self.ratio, self.amount)
+
+
+class TickSize(TickTable):
+
+    __slots__ = ("tables",)
+
+    def __init__(self, ratio, amount=None, tables=None):
+        super().__init__(ratio, amount)
+        self.tables = tables or {}
+
+    def __repr__(self):
+        return "TickSize({}, {}, {})".format(self.ratio, self.amount,
+                                             self.tables)
+
+    @classmethod
+    def parse(cls, price_ratio, min_price_inc_amt=None):
+        ratio, ratios = parse_tick_field(price_ratio)
+        amount, amounts = None, {}
+        if min_price_inc_amt:
+            amount, amounts = parse_tick_field(min_price_inc_amt)
+        tables = {name: TickTable(r, amounts.get(name))
+                  for name, r in ratios.items()}
+        return cls(ratio, amount, tables)
+
+    def price(self, raw):
+        """Convert a CTS price (str or bytes) to the integer representation.
+
+        Integral prices take one int() and one multiply. A price with a
+        fractional part is scaled exactly and returned as a float if the
+        result is still not whole. None is passed through.
+        """
+        if raw is None:
+            return None
+        scale = self.scale or 1
+        try:
+            return int(raw) * scale
+        except ValueError:
+            if isinstance(raw, (bytes, bytearray, memoryview)):
+                raw = bytes(raw).decode()
+            x = Fraction(raw) * scale
+            return int(x) if x.denominator == 1 else float(x)
+
+
+# Used for instruments whose PriceRatio is not known: prices pass through
+# unscaled.
+UNIT_TICK_SIZE = TickSize(Fraction(1))
@@ -1,10 +1,24 @@
-from .core import Cache
+from .core import (Cache, CacheHandle, open_cache_async, is_fresh, migrate,
+                   MigrationRequired)
 
-def open(fn, mode="c", max_timedelta=None):
-    return Cache(fn, mode, max_timedelta)
+def open(fn, mode="c", max_timedelta=None, snapshots=False, compression=None,
+         max_bytes=None, eviction="lru"):
+    return Cache(fn, mode, max_timedelta, snapshots=snapshots,
+                 compression=compression, max_bytes=max_bytes,
+                 eviction=eviction)
 
-def ensure_exists(fn):
+async def open_async(fn, mode="c", max_timedelta=None, timeout=None, **kwargs):
+    return await open_cache_async(fn, mode, timeout,
+                                  max_timedelta=max_timedelta, **kwargs)
+
+def open_handle(fn, max_timedelta=None, lru_size=1024, snapshots=False,
+                compression=None, max_bytes=None, eviction="lru",
+                publish_interval=None, publish_batch=64):
+    return CacheHandle(fn, max_timedelta, lru_size, snapshots, compression,
+                       max_bytes, eviction, publish_interval, publish_batch)
+
+def ensure_exists(fn, snapshots=False):
     try:
-        Cache(fn, "r").close()
+        Cache(fn, "r", snapshots=snapshots).close()
     except FileNotFoundError:
-        Cache(fn, "c").close()
+        Cache(fn, "c", snapshots=snapshots).close()
@@ -1,34 +1,451 @@
 import shelve
+import dbm
+import bisect
+import asyncio
 import filock
 import trace
 import collections
+import collections.abc
+import contextlib
+import logging
 import os
+import mmap
+import struct
+import shutil
+import pickle
+import zlib
+import lzma
+from array import array
+from time import perf_counter, time, monotonic
 from datetime import datetime, timedelta
 
+L = logging.getLogger(__name__)
+
 class ExpirationException(Exception):
     pass
 
-class Cache(collections.MutableMapping):
+class MigrationRequired(Exception):
+    """The cache was written by an older version, see migrate()."""
+
+# The generation file next to a cache holds a little-endian uint64 that
+# writers increment whenever they close a modified cache.
+GENERATION = struct.Struct("<Q")
+
+def generation_path(path):
+    return path + ".gen"
+
+def open_generation(path):
+    """Return a read-only mmap of the generation counter of a cache."""
+    fd = os.open(generation_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < GENERATION.size:
+            # never shrinks the file, so a concurrent bump is not lost
+            os.ftruncate(fd, GENERATION.size)
+        return mmap.mmap(fd, GENERATION.size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+def bump_generation(path):
+    fd = os.open(generation_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        data = os.pread(fd, GENERATION.size, 0)
+        gen = GENERATION.unpack(data)[0] if len(data) == GENERATION.size \
+                else 0
+        os.pwrite(fd, GENERATION.pack(gen + 1), 0)
+    finally:
+        os.close(fd)
+    return gen + 1
+
+# The index next to a cache maps every key to its holder's timestamp and
+# frozen flag, the size of the pickled holder and when and how often the
+# entry was read. clear_expired() and evict() work from it without
+# unpickling any holder. Meta entries start with a NUL byte.
+#
+# Unfrozen keys are also filed in expiry buckets of EXPIRY_BUCKET seconds by
+# timestamp: b"\0t<n>" holds the number of slots of bucket n, b"\0t<n>:<i>"
+# the key in slot i and b"\0buckets" the sorted numbers of all buckets as
+# int64s, so clear_expired() only reads the buckets up to the cutoff. Filing
+# a key adds one record, existing ones are not rewritten. Keys rewritten or
+# deleted since they were filed are skipped by checking their entry.
+ENTRY = struct.Struct("<d?Qdq")
+EPOCH = datetime(1970, 1, 1)
+INDEX_VERSION_KEY = b"\0version"
+INDEX_DELETED_KEY = b"\0deleted"
+INDEX_BYTES_KEY = b"\0bytes"
+INDEX_ENTRIES_KEY = b"\0entries"
+INDEX_BUCKETS_KEY = b"\0buckets"
+INDEX_VERSION = b"4"
+EXPIRY_BUCKET = 3600
+
+def bucket_of(ts):
+    return int(ts // EXPIRY_BUCKET)
+
+def bucket_key(n):
+    return b"\0t%d" % n
+
+def slot_key(n, i):
+    return b"\0t%d:%d" % (n, i)
+
+EVICTION_POLICIES = ("lru", "lfu")
+# access log record: last read, reads, key length, followed by the key
+ACCESS = struct.Struct("<dIH")
+# distinct keys a handle counts reads of before logging them
+MAX_PENDING_ACCESSES = 1024
+
+def index_path(path):
+    return path + ".exp"
+
+def access_log_path(path):
+    return path + ".access"
+
+def log_accesses(path, accesses):
+    """Append a dict of key -> [last read, reads] to the access log.
+
+    Read-only opens take no write lock, so they record their reads here
+    for the next writer to fold into the index. Each call is one append
+    and needs no lock.
+    """
+    parts = []
+    for key, (seconds, count) in accesses.items():
+        k = key.encode()
+        parts.append(ACCESS.pack(seconds, count, len(k)))
+        parts.append(k)
+    fd = os.open(access_log_path(path),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, b"".join(parts))
+    finally:
+        os.close(fd)
+
+def take_accesses(path):
+    """Remove the access log and return its reads, call under the write
+    lock. Reads appended by an open that still had the old log open are
+    lost.
+    """
+    log = access_log_path(path)
+    fold = log + ".fold"
+    try:
+        os.replace(log, fold)
+    except FileNotFoundError:
+        return {}
+    with open(fold, "rb") as f:
+        data = f.read()
+    os.remove(fold)
+    res = {}
+    pos = 0
+    # a truncated record ends the log
+    while pos + ACCESS.size <= len(data):
+        seconds, count, n = ACCESS.unpack_from(data, pos)
+        pos += ACCESS.size
+        if pos + n > len(data):
+            break
+        key = data[pos:pos + n].decode()
+        pos += n
+        rec = res.get(key)
+        if rec is None:
+            res[key] = [seconds, count]
+        else:
+            rec[0] = max(rec[0], seconds)
+            rec[1] += count
+    return res
+
+def to_seconds(ts):
+    return (ts - EPOCH) / timedelta(seconds=1)
+
+# Compaction copies the live entries to <db>.compact and moves its files over
+# the cache's once it is complete, see Cache.compact().
+DBM_SUFFIXES = ("", ".db", ".dat", ".dir", ".bak", ".pag")
+
+def compact_path(path):
+    return path + ".compact"
+
+def replace_dbm(src, dst):
+    for suffix in DBM_SUFFIXES:
+        if os.path.exists(src + suffix):
+            os.replace(src + suffix, dst + suffix)
+        elif os.path.exists(dst + suffix):
+            os.remove(dst + suffix)
+
+def move_dbm(src, dst):
+    """Move the files of the dbm src, returns False if there are none."""
+    if dbm.whichdb(src) is None:
+        return False
+    replace_dbm(src, dst)
+    return True
+
+# Snapshot mode: the cache is a series of immutable dbm snapshots named
+# <path>.<n>, and the symlink <path>.cur names the current one. Readers
+# resolve the link and open that snapshot without taking any lock. A writer
+# takes the write lock (which only other writers wait for), copies the
+# current snapshot to the next number, modifies the copy and swaps the link
+# atomically on close. The previous snapshot is kept for readers that
+# resolved the link just before the swap, older ones are removed. A cache
+# written without snapshots becomes the first snapshot.
+
+def current_path(path):
+    return path + ".cur"
+
+def snapshot_files(base):
+    """Files of the dbm (and its expiry index) with the given base name."""
+    dirname = os.path.dirname(base) or "."
+    name = os.path.basename(base)
+    return [os.path.join(dirname, fn) for fn in os.listdir(dirname)
+            if fn == name or fn.startswith(name + ".")]
 
-    def __init__(self, path, mode="c", max_timedelta=None, delete_expired=True):
+def read_snapshot(path):
+    """Base name of the current snapshot and its number, None if none."""
+    try:
+        name = os.readlink(current_path(path))
+    except FileNotFoundError:
+        return None, 0
+    base = os.path.join(os.path.dirname(path), name)
+    return base, int(name.rsplit(".", 1)[1])
+
+def publish_snapshot(path, base):
+    tmp = current_path(path) + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.basename(base), tmp)
+    os.replace(tmp, current_path(path))
+
+def remove_snapshots(path, keep_from):
+    """Remove snapshots numbered below keep_from."""
+    dirname = os.path.dirname(path) or "."
+    prefix = os.path.basename(path) + "."
+    for fn in os.listdir(dirname):
+        if not fn.startswith(prefix):
+            continue
+        num = fn[len(prefix):].split(".", 1)[0]
+        if num.isdigit() and int(num) < keep_from:
+            os.remove(os.path.join(dirname, fn))
+
+# Values of a compressed cache are pickled and compressed before the holder
+# is stored; the holder names the codec, so entries written with another
+# codec or none at all stay readable.
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+class CodecStats:
+
+    def __init__(self):
+        self.compressed_values = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.decompressed_values = 0
+        self.decompress_time = 0.0
+
+    def add(self, other):
+        self.compressed_values += other.compressed_values
+        self.raw_bytes += other.raw_bytes
+        self.compressed_bytes += other.compressed_bytes
+        self.decompressed_values += other.decompressed_values
+        self.decompress_time += other.decompress_time
+
+    def get_stats(self):
+        d = {}
+        d["compressed_values"] = self.compressed_values
+        d["raw_bytes"] = self.raw_bytes
+        d["compressed_bytes"] = self.compressed_bytes
+        if self.compressed_bytes:
+            d["compression_ratio"] = self.raw_bytes / self.compressed_bytes
+        else:
+            d["compression_ratio"] = None
+        d["decompressed_values"] = self.decompressed_values
+        d["decompress_time"] = self.decompress_time
+        return d
+
+def lock_path(path):
+    return path + "~"
+
+async def lock_cache_async(path, mode="c", snapshots=False, timeout=None):
+    """Acquire the file lock Cache(path, mode) would take, asynchronously.
+
+    Returns None for snapshot readers, which take no lock.
+    """
+    if mode == "r":
+        if snapshots:
+            return None
+        return await filock.open_async(lock_path(path), "r", timeout=timeout)
+    return await filock.open_async(lock_path(path), "w", timeout=timeout)
+
+async def open_cache_async(path, mode="c", timeout=None, **kwargs):
+    """Open a Cache without blocking the event loop on the file lock.
+
+    Raises filock.LockTimeout if the lock is not acquired within timeout
+    seconds. Only the lock is waited for asynchronously, so the cache must
+    be closed before the next await.
+    """
+    lock = await lock_cache_async(path, mode, kwargs.get("snapshots", False),
+                                  timeout)
+    try:
+        return Cache(path, mode, lock=lock, **kwargs)
+    except BaseException:
+        if lock is not None:
+            lock.close()
+        raise
+
+def migrate(path, snapshots=False):
+    """Bring the index of a cache written by an older version up to date.
+
+    Writers refuse such caches with MigrationRequired until this has run.
+    Indexing a cache written without an index unpickles every entry under
+    the write lock, so run it at startup or from a maintenance script.
+    The version is checked with a read-only open first, so an up to date
+    snapshot cache is not copied. Returns True if the index was rebuilt.
+    """
+    try:
+        with Cache(path, "r", snapshots=snapshots) as c:
+            if not c.needs_migration():
+                return False
+    except FileNotFoundError:
+        pass
+    with Cache(path, "c", snapshots=snapshots) as c:
+        return c.migrate()
+
+def is_fresh(holder, max_timedelta, now=None):
+    if holder["frozen"]:
+        return True
+    if now is None:
+        now = datetime.utcnow()
+    return now - holder["timestamp"] <= max_timedelta
+
+class Cache(collections.abc.MutableMapping):
+
+    def __init__(self, path, mode="c", max_timedelta=None, delete_expired=True,
+                 compact_ratio=0.5, snapshots=False, compression=None,
+                 max_bytes=None, eviction="lru", evict_ratio=0.9, lock=None,
+                 compact_chunk=1000):
         if max_timedelta is None:
             max_timedelta = timedelta.max
+        if compression is not None and compression not in CODECS:
+            raise ValueError("unknown compression: {}".format(compression))
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("unknown eviction policy: {}".format(eviction))
+        # Byte budget of the pickled holders. A writer that leaves the cache
+        # above it evicts unfrozen entries on close until evict_ratio of the
+        # budget is used, least recently or least frequently read first.
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.evict_ratio = evict_ratio
+        self.evicted = []
+        self.writable = mode != "r"
+        # key -> [last read, reads] since open, folded into the index on
+        # close by writers and appended to the access log by readers
+        self._accesses = {}
+        self._total_bytes = None
+        self._total_entries = None
+        # codec for values written through this cache, None stores them as is
+        self.compression = compression
+        self.codec_stats = CodecStats()
         self.max_timedelta = max_timedelta
         self.delete_expired = delete_expired
-        lock_fn = path + "~" 
+        # clear_expired() compacts once this many entries per live entry
+        # have been deleted since the last compaction, copying at most
+        # compact_chunk entries per call
+        self.compact_ratio = compact_ratio
+        self.compact_chunk = compact_chunk
+        # dbm of a compaction in progress, False until looked for
+        self._side = False
+        self.path = path
+        self.snapshots = snapshots
+        self.dirty = False
+        self._index = None
+        lock_fn = lock_path(path)
+        # a lock acquired by the caller, see open_cache_async()
+        if lock is not None:
+            self.lock = lock
+        if snapshots:
+            # sets db_path to the snapshot in use
+            self._open_snapshot(mode, lock_fn)
+            return
+        self.db_path = path
         if mode == "r":
-            self.lock = filock.open(lock_fn, "r")
-            if not os.path.isfile(path):
+            if lock is None:
+                self.lock = filock.open(lock_fn, "r")
+            # dbm.dumb keeps <path>.dat and <path>.dir instead of <path>
+            if dbm.whichdb(path) is None:
                 raise FileNotFoundError(path)
-        else:
+        elif lock is None:
             self.lock = filock.open(lock_fn, "w")
         self.shelve = shelve.open(path, mode)
 
+    def _open_snapshot(self, mode, lock_fn):
+        if mode == "r":
+            # A writer may remove the snapshot between resolving the link
+            # and opening it only after publishing two newer ones.
+            for _ in range(3):
+                base, _ = read_snapshot(self.path)
+                if base is None:
+                    raise FileNotFoundError(current_path(self.path))
+                try:
+                    self.shelve = shelve.open(base, "r")
+                except Exception:
+                    if os.readlink(current_path(self.path)) \
+                            != os.path.basename(base):
+                        continue
+                    raise
+                self.db_path = base
+                return
+            raise FileNotFoundError(base)
+        if not hasattr(self, "lock"):
+            self.lock = filock.open(lock_fn, "w")
+        base, num = read_snapshot(self.path)
+        self._prev_num = num
+        self.db_path = "{}.{}".format(self.path, num + 1)
+        # leftovers of a writer that died before publishing
+        for fn in snapshot_files(self.db_path):
+            os.remove(fn)
+        if base is not None and mode != "n":
+            for fn in snapshot_files(base):
+                shutil.copyfile(fn, self.db_path + fn[len(base):])
+        elif base is None and mode != "n":
+            # non-snapshot readers take the same lock, so none of them has
+            # the files open
+            if move_dbm(self.path, self.db_path):
+                move_dbm(index_path(self.path), index_path(self.db_path))
+        self.shelve = shelve.open(self.db_path, "c")
+        if base is None:
+            # publish even if nothing is written, so readers find the cache
+            self.dirty = True
+
     def close(self):
+        if getattr(self, "writable", False) and hasattr(self, "shelve"):
+            self._flush_accesses()
+            if self.dirty and self.max_bytes is not None:
+                self.evict()
+        if getattr(self, "_index", None) is not None:
+            if self._total_bytes is not None:
+                self._index[INDEX_BYTES_KEY] = str(self._total_bytes).encode()
+                self._index[INDEX_ENTRIES_KEY] = \
+                        str(self._total_entries).encode()
+            self._index.close()
+            self._index = None
+        if getattr(self, "_side", None):
+            self._side.close()
+            self._side = False
         if hasattr(self, "shelve"):
             self.shelve.close()
+            del self.shelve
+            if self.snapshots and hasattr(self, "lock"):
+                if self.dirty:
+                    publish_snapshot(self.path, self.db_path)
+                    remove_snapshots(self.path, self._prev_num)
+                else:
+                    for fn in snapshot_files(self.db_path):
+                        os.remove(fn)
+            if self.dirty:
+                # still under the write lock
+                bump_generation(self.path)
+                self.dirty = False
+        if getattr(self, "_accesses", None):
+            # read-only
+            log_accesses(self.path, self._accesses)
+            self._accesses = {}
         if hasattr(self, "lock"):
             self.lock.close()
+            del self.lock
 
     def __del__(self):
         self.close()
@@ -49,7 +466,12 @@ class Cache(collections.MutableMapping):
         return value
 
     def __delitem__(self, key):
+        # before any change, a new cache is recognized by its empty dbm
+        self._get_index()
         del self.shelve[key]
+        self._unside(key)
+        self._unindex(key)
+        self.dirty = True
 
     def __len__(self):
         return len(self.shelve)
@@ -58,23 +480,100 @@ class Cache(collections.MutableMapping):
         return self.shelve.__iter__()
 
     def __setitem__(self, key, value):
+        holder = self._make_holder(value, datetime.utcnow())
+        self._put(key, holder)
+        self.dirty = True
+
+    def _put(self, key, holder):
+        self._get_index()
+        # pickled here rather than by the shelf to learn the size
+        data = pickle.dumps(holder, pickle.DEFAULT_PROTOCOL)
+        k = key.encode(self.shelve.keyencoding)
+        self.shelve.dict[k] = data
+        side = self._compaction()
+        if side is not None:
+            side[k] = data
+        self._reindex(key, holder, len(data))
+
+    def _make_holder(self, value, timestamp):
         holder = {
             "data": value,
-            "timestamp": datetime.utcnow(),
+            "timestamp": timestamp,
             "frozen": False,
         }
-        self.shelve[key] = holder
+        if self.compression is not None:
+            compress = CODECS[self.compression][0]
+            raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            data = compress(raw)
+            stats = self.codec_stats
+            stats.compressed_values += 1
+            stats.raw_bytes += len(raw)
+            stats.compressed_bytes += len(data)
+            holder["data"] = data
+            holder["codec"] = self.compression
+        return holder
+
+    def _decode(self, holder):
+        """Return holder with its value decompressed."""
+        codec = holder.get("codec")
+        if codec is None:
+            return holder
+        t0 = perf_counter()
+        value = pickle.loads(CODECS[codec][1](holder["data"]))
+        stats = self.codec_stats
+        stats.decompressed_values += 1
+        stats.decompress_time += perf_counter() - t0
+        holder = dict(holder, data=value)
+        del holder["codec"]
+        return holder
+
+    def get_holder(self, key):
+        holder = self.shelve.get(key)
+        if holder:
+            holder = self._decode(holder)
+        return holder
+
+    def touch(self, key, seconds=None, count=1):
+        """Record reads of key, written to the index when a writer closes
+        or to the access log when a reader does.
+        """
+        if seconds is None:
+            seconds = to_seconds(datetime.utcnow())
+        rec = self._accesses.get(key)
+        if rec is None:
+            self._accesses[key] = [seconds, count]
+        else:
+            rec[0] = max(rec[0], seconds)
+            rec[1] += count
+
+    def touch_many(self, accesses):
+        """Merge a dict of key -> [last read, reads] into the buffer."""
+        for key, (seconds, count) in accesses.items():
+            self.touch(key, seconds, count)
+
+    def _flush_accesses(self):
+        # reads logged by read-only opens
+        self.touch_many(take_accesses(self.path))
+        if not self._accesses:
+            return
+        index = self._get_index()
+        for key, (seconds, count) in self._accesses.items():
+            k = key.encode()
+            rec = index.get(k)
+            if rec is None:
+                continue
+            ts, frozen, size, last_access, hits = ENTRY.unpack(rec)
+            index[k] = ENTRY.pack(ts, frozen, size,
+                                  max(last_access, seconds), hits + count)
+        self._accesses = {}
 
     def get(self, key, default=None, max_timedelta=None):
         holder = self.shelve.get(key)
         if not holder:
             return default
-        if holder["frozen"]:
-            return holder["data"]
         if max_timedelta is None:
             max_timedelta = self.max_timedelta
-        now = datetime.utcnow()
-        if now - holder["timestamp"] > max_timedelta:
+        if not is_fresh(holder, max_timedelta):
             # if self.delete_expired:
             #     try:
             #         del self[key]
@@ -82,35 +581,972 @@ class Cache(collections.MutableMapping):
             #         # read-only access
             #         pass
             return default
-        return holder["data"]
+        if self.max_bytes is not None:
+            self.touch(key)
+        return self._decode(holder)["data"]
+
+    def get_many(self, keys, default=None, max_timedelta=None):
+        """Return a dict of the values of keys, default for missing ones.
+
+        Duplicate keys are looked up once and freshness is checked against
+        a single clock reading.
+        """
+        if max_timedelta is None:
+            max_timedelta = self.max_timedelta
+        now = datetime.utcnow()
+        seconds = to_seconds(now)
+        touch = self.max_bytes is not None
+        get = self.shelve.get
+        res = {}
+        for key in keys:
+            if key in res:
+                continue
+            holder = get(key)
+            if not holder or not is_fresh(holder, max_timedelta, now):
+                res[key] = default
+            else:
+                if touch:
+                    self.touch(key, seconds)
+                res[key] = self._decode(holder)["data"]
+        return res
+
+    def set_many(self, items, timestamp=None):
+        """Store all (key, value) pairs of items with one shared timestamp.
+
+        items is a mapping or an iterable of pairs. Returns the number of
+        entries written.
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        n = 0
+        for key, value in items:
+            self._put(key, self._make_holder(value, timestamp))
+            n += 1
+        if n:
+            self.dirty = True
+        return n
+
+    def delete_many(self, keys):
+        """Delete the keys that exist, return the number deleted."""
+        shelf = self.shelve
+        index = self._get_index()
+        n = 0
+        for key in set(keys):
+            if key not in shelf:
+                continue
+            del shelf[key]
+            self._unside(key)
+            self._drop(index, key.encode())
+            n += 1
+        if n:
+            deleted = int(index.get(INDEX_DELETED_KEY, b"0")) + n
+            index[INDEX_DELETED_KEY] = str(deleted).encode()
+            self.dirty = True
+        return n
 
     def update(self, d):
-        for k, v in d.items():
-            self[k] = v
+        self.set_many(d)
 
     def freeze(self, key):
         holder = self.shelve[key]
         holder["frozen"] = True
-        self.shelve[key] = holder 
+        self._put(key, holder)
+        self.dirty = True
 
     def unfreeze(self, key):
         holder = self.shelve[key]
         holder["frozen"] = False
-        self.shelve[key] = holder 
+        self._put(key, holder)
+        self.dirty = True
+
+    def _open_index(self):
+        if self._index is None:
+            self._index = dbm.open(index_path(self.db_path), "c")
+        return self._index
+
+    def _get_index(self):
+        # only opened by writers
+        if self._index is None:
+            index = self._open_index()
+            version = index.get(INDEX_VERSION_KEY)
+            if version != INDEX_VERSION:
+                if version is None and not len(self.shelve.dict):
+                    # a new cache
+                    index[INDEX_VERSION_KEY] = INDEX_VERSION
+                else:
+                    index.close()
+                    self._index = None
+                    raise MigrationRequired(
+                            "{}: index version {}, run tcache.migrate()"
+                            .format(self.path, version))
+            self._load_totals()
+        return self._index
 
-    def clear_expired(self, max_timedelta=None):
+    def _load_totals(self):
+        index = self._index
+        self._total_bytes = int(index.get(INDEX_BYTES_KEY, b"0"))
+        self._total_entries = int(index.get(INDEX_ENTRIES_KEY, b"0"))
+
+    def needs_migration(self):
+        """Whether writers refuse the cache until migrate() has run."""
+        path = index_path(self.db_path)
+        version = None
+        if dbm.whichdb(path) is not None:
+            with dbm.open(path, "r") as index:
+                version = index.get(INDEX_VERSION_KEY)
+        if version == INDEX_VERSION:
+            return False
+        # a new cache gets its index with the first write
+        return version is not None or len(self.shelve.dict) > 0
+
+    def migrate(self):
+        """Rebuild an index written by an older version, see migrate()."""
+        index = self._open_index()
+        version = index.get(INDEX_VERSION_KEY)
+        if version == INDEX_VERSION:
+            self._load_totals()
+            return False
+        if version in (b"2", b"3"):
+            # entries are up to date, the buckets are refiled
+            records = list(self._index_records())
+            if version == b"3":
+                # buckets held their keys in one value
+                for n in self._buckets(index):
+                    index.pop(bucket_key(n), None)
+                index.pop(INDEX_BUCKETS_KEY, None)
+            self._file_buckets(records)
+            index[INDEX_ENTRIES_KEY] = str(len(records)).encode()
+            index[INDEX_VERSION_KEY] = INDEX_VERSION
+            self._load_totals()
+        else:
+            self.rebuild_index()
+        # snapshot writers only publish modified copies
+        self.dirty = True
+        return True
+
+    def _index_records(self):
+        index = self._index
+        for k in index.keys():
+            if not k.startswith(b"\0"):
+                ts, frozen = ENTRY.unpack(index[k])[:2]
+                yield k, ts, frozen
+
+    def _buckets(self, index):
+        buckets = array("q")
+        buckets.frombytes(index.get(INDEX_BUCKETS_KEY, b""))
+        return buckets
+
+    def _file(self, index, k, ts):
+        n = bucket_of(ts)
+        bk = bucket_key(n)
+        slots = index.get(bk)
+        if slots is None:
+            buckets = self._buckets(index)
+            bisect.insort(buckets, n)
+            index[INDEX_BUCKETS_KEY] = buckets.tobytes()
+            slots = 0
+        else:
+            slots = int(slots)
+        index[slot_key(n, slots)] = k
+        index[bk] = str(slots + 1).encode()
+
+    def _bucket_keys(self, index, n):
+        keys = []
+        for i in range(int(index.get(bucket_key(n), b"0"))):
+            k = index.get(slot_key(n, i))
+            if k is not None:
+                keys.append(k)
+        return keys
+
+    def _set_bucket(self, index, n, keys):
+        """Replace the slots of bucket n, removing it if keys is empty."""
+        bk = bucket_key(n)
+        for i in range(int(index.get(bk, b"0"))):
+            index.pop(slot_key(n, i), None)
+        for i, k in enumerate(keys):
+            index[slot_key(n, i)] = k
+        if keys:
+            index[bk] = str(len(keys)).encode()
+        else:
+            index.pop(bk, None)
+
+    def _file_buckets(self, records):
+        """Replace all expiry buckets with ones holding records."""
+        index = self._index
+        for n in self._buckets(index):
+            self._set_bucket(index, n, [])
+        buckets = collections.defaultdict(list)
+        for k, ts, frozen in records:
+            if not frozen:
+                buckets[bucket_of(ts)].append(k)
+        for n, keys in buckets.items():
+            self._set_bucket(index, n, keys)
+        index[INDEX_BUCKETS_KEY] = array("q", sorted(buckets)).tobytes()
+
+    def _reindex(self, key, holder, size):
+        index = self._get_index()
+        k = key.encode()
+        ts = to_seconds(holder["timestamp"])
+        frozen = holder["frozen"]
+        rec = index.get(k)
+        if rec is None:
+            # the write counts as a use, or LFU would evict it first
+            old_size, last_access, hits = 0, ts, 1
+            self._total_entries += 1
+            filed = False
+        else:
+            old_ts, old_frozen, old_size, last_access, hits = ENTRY.unpack(rec)
+            filed = not old_frozen and bucket_of(old_ts) == bucket_of(ts)
+        index[k] = ENTRY.pack(ts, frozen, size, max(last_access, ts), hits)
+        self._total_bytes += size - old_size
+        if not frozen and not filed:
+            self._file(index, k, ts)
+
+    def _drop(self, index, k):
+        rec = index.get(k)
+        if rec is not None:
+            self._total_bytes -= ENTRY.unpack(rec)[2]
+            self._total_entries -= 1
+            del index[k]
+
+    def _unindex(self, key):
+        index = self._get_index()
+        self._drop(index, key.encode())
+        deleted = int(index.get(INDEX_DELETED_KEY, b"0")) + 1
+        index[INDEX_DELETED_KEY] = str(deleted).encode()
+
+    def rebuild_index(self):
+        """Index every entry, needed once for caches written without one.
+
+        Unpickles every holder, see migrate().
+        """
+        index = self._open_index()
+        for k in list(index.keys()):
+            if not k.startswith(b"\0"):
+                del index[k]
+        total = 0
+        records = []
+        db = self.shelve.dict
+        for k in db.keys():
+            data = db[k]
+            holder = pickle.loads(data)
+            ts = to_seconds(holder["timestamp"])
+            index[k] = ENTRY.pack(ts, holder["frozen"], len(data), ts, 1)
+            records.append((k, ts, holder["frozen"]))
+            total += len(data)
+        self._file_buckets(records)
+        index[INDEX_DELETED_KEY] = b"0"
+        index[INDEX_BYTES_KEY] = str(total).encode()
+        index[INDEX_ENTRIES_KEY] = str(len(records)).encode()
+        index[INDEX_VERSION_KEY] = INDEX_VERSION
+        self._total_bytes = total
+        self._total_entries = len(records)
+
+    def clear_expired(self, max_timedelta=None, limit=None):
+        """Delete expired entries, oldest first and at most limit of them.
+
+        Only the expiry buckets up to the cutoff are read, so a sweep costs
+        the expired entries plus one bucket, not the size of the cache.
+        Compaction is started once enough entries were deleted since the
+        last one and continued by every call until it completes, see
+        compact().
+        """
+        if max_timedelta is None:
+            max_timedelta = self.max_timedelta
+        if max_timedelta == timedelta.max:
+            return []
+        index = self._get_index()
+        cutoff = to_seconds(datetime.utcnow() - max_timedelta)
+        buckets = self._buckets(index)
+        emptied = []
         res = []
-        keys = self.keys()
+        for n in buckets:
+            if n > bucket_of(cutoff):
+                break
+            if limit is not None and len(res) >= limit:
+                break
+            expired = []
+            keep = []
+            # a key filed twice, e.g. after a freeze and unfreeze, once
+            for k in dict.fromkeys(self._bucket_keys(index, n)):
+                rec = index.get(k)
+                if rec is None:
+                    continue
+                ts, frozen = ENTRY.unpack(rec)[:2]
+                if frozen or bucket_of(ts) != n:
+                    continue
+                if ts < cutoff:
+                    expired.append((ts, k))
+                else:
+                    keep.append(k)
+            expired.sort()
+            if limit is not None:
+                room = limit - len(res)
+                keep.extend(k for _, k in expired[room:])
+                expired = expired[:room]
+            for _, k in expired:
+                key = k.decode()
+                if key in self.shelve:
+                    del self[key]
+                else:
+                    self._drop(index, k)
+                res.append(key)
+            self._set_bucket(index, n, keep)
+            if not keep:
+                emptied.append(n)
+        if emptied:
+            emptied = set(emptied)
+            index[INDEX_BUCKETS_KEY] = array(
+                    "q", [n for n in buckets if n not in emptied]).tobytes()
+        deleted = int(index.get(INDEX_DELETED_KEY, b"0"))
+        if self._compaction() is not None or (
+                deleted and deleted >= self._total_entries
+                * self.compact_ratio):
+            self.compact(self.compact_chunk)
+        return res
+
+    def total_bytes(self):
+        """Size of all pickled holders according to the index."""
+        self._get_index()
+        return self._total_bytes
+
+    def evict(self, max_bytes=None):
+        """Delete unfrozen entries until evict_ratio of max_bytes is used.
+
+        Runs only if the cache is above max_bytes. Victims are the least
+        recently read entries, or the least often read ones (ties broken by
+        recency) under the "lfu" policy. Returns the deleted keys.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        index = self._get_index()
+        self._flush_accesses()
+        if max_bytes is None or self._total_bytes <= max_bytes:
+            return []
+        lfu = self.eviction == "lfu"
+        candidates = []
+        for k in index.keys():
+            if k.startswith(b"\0"):
+                continue
+            ts, frozen, size, last_access, hits = ENTRY.unpack(index[k])
+            if frozen:
+                continue
+            order = (hits, last_access) if lfu else (last_access,)
+            candidates.append((order, size, k))
+        candidates.sort()
+        excess = self._total_bytes - max_bytes * self.evict_ratio
+        victims = []
+        for _, size, k in candidates:
+            if excess <= 0:
+                break
+            victims.append(k.decode())
+            excess -= size
+        self.delete_many(victims)
+        self.evicted.extend(victims)
+        return victims
+
+    def _compaction(self):
+        """The dbm of a compaction in progress, None if there is none."""
+        if self._side is False:
+            path = compact_path(self.db_path)
+            self._side = None
+            if dbm.whichdb(path) is not None:
+                self._side = dbm.open(path, "w")
+        return self._side
+
+    def _unside(self, key):
+        side = self._compaction()
+        if side is not None:
+            k = key.encode(self.shelve.keyencoding)
+            if k in side:
+                del side[k]
+
+    def compact(self, chunk=None):
+        """Reclaim the space of deleted entries, chunk entries at a time.
+
+        Live entries are copied as they are to a new dbm next to the cache,
+        which replaces the cache file once it holds all of them. Until then
+        writes go to both files, so the copy can be spread over several
+        calls, and opens of the cache, each holding the write lock for at
+        most chunk entries. The index, a few dozen bytes per entry, is then
+        rewritten in one go. Returns True once the copy has been swapped in.
+        """
+        side = self._compaction()
+        if side is None:
+            side = self._side = dbm.open(compact_path(self.db_path), "n")
+        db = self.shelve.dict
+        copied = 0
+        for k in db.keys():
+            if k in side:
+                continue
+            if chunk is not None and copied >= chunk:
+                return False
+            side[k] = db[k]
+            copied += 1
+        # still under the write lock, no reader has the files open
+        side.close()
+        self._side = None
+        self.shelve.close()
+        replace_dbm(compact_path(self.db_path), self.db_path)
+        self.shelve = shelve.open(self.db_path, "c")
+        index = self._get_index()
+        index[INDEX_DELETED_KEY] = b"0"
+        self._compact_index()
+        return True
+
+    def _compact_index(self):
+        path = index_path(self.db_path)
+        new = dbm.open(compact_path(path), "n")
+        index = self._index
+        for k in index.keys():
+            new[k] = index[k]
+        new.close()
+        index.close()
+        self._index = None
+        replace_dbm(compact_path(path), path)
+        # the totals are kept in memory
+        self._index = self._open_index()
+
+
+class CacheHandle:
+    """Long-lived access to a cache file with an LRU of unpickled values.
+
+    Values read or written through the handle are kept in memory, at most
+    lru_size of them. Every lookup first reads the generation counter from
+    an mmap of the generation file; when another process has written to the
+    cache since, the LRU is dropped. A hit therefore costs one memory read
+    and never opens the shelve or takes the file lock. Misses and writes
+    open the cache with the usual locking. Returned values are shared
+    between callers and must not be modified.
+
+    Reads are counted in memory and handed to the cache with the next open,
+    which keeps the eviction bookkeeping off the read path. Read-only opens
+    append them to the access log, as do handles that count reads of
+    MAX_PENDING_ACCESSES keys without opening the cache, and close().
+
+    In snapshot mode every write copies the cache, so writes are queued and
+    published together: set_async() returns once publish_batch values are
+    queued or the oldest one is publish_interval seconds old, otherwise a
+    flush is scheduled on the event loop. Queued values are returned by
+    this handle at once and reach other processes with the publish, which
+    runs on an executor thread. With publish_interval None every write is
+    published before set_async() returns. close() publishes what is left.
+    """
+
+    def __init__(self, path, max_timedelta=None, lru_size=1024,
+                 snapshots=False, compression=None, max_bytes=None,
+                 eviction="lru", publish_interval=None, publish_batch=64):
+        if max_timedelta is None:
+            max_timedelta = timedelta.max
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("unknown eviction policy: {}".format(eviction))
+        self.path = path
+        self.snapshots = snapshots
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.codec_stats = CodecStats()
+        # key -> [last read, reads] not yet written to the index
+        self._accesses = {}
+        self.evictions = 0
+        self.max_timedelta = max_timedelta
+        self.lru_size = lru_size
+        self._lru = collections.OrderedDict()
+        self.publish_interval = publish_interval
+        self.publish_batch = publish_batch
+        # key -> holder queued for the next snapshot, and those of the
+        # snapshot being published
+        self._pending = collections.OrderedDict()
+        self._pending_since = None
+        self._inflight = {}
+        self._flush_timer = None
+        self._flush_lock = None
+        self.publishes = 0
+        self._gen_map = open_generation(path)
+        self._generation = self._read_generation()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache(self, mode, lock=None):
+        return Cache(self.path, mode, snapshots=self.snapshots,
+                     compression=self.compression, max_bytes=self.max_bytes,
+                     eviction=self.eviction, lock=lock)
+
+    def _new_cache(self, mode, lock=None):
+        c = self._cache(mode, lock)
+        if self._accesses:
+            c.touch_many(self._accesses)
+            self._accesses = {}
+        return c
+
+    def _close_cache(self, c):
+        c.close()
+        self._closed(c)
+
+    def _closed(self, c):
+        self.codec_stats.add(c.codec_stats)
+        for key in c.evicted:
+            self._lru.pop(key, None)
+        self.evictions += len(c.evicted)
+
+    @contextlib.contextmanager
+    def _open(self, mode):
+        c = self._new_cache(mode)
+        try:
+            yield c
+        finally:
+            self._close_cache(c)
+
+    async def _open_async(self, mode, timeout):
+        lock = await lock_cache_async(self.path, mode, self.snapshots,
+                                      timeout)
+        try:
+            return self._new_cache(mode, lock)
+        except BaseException:
+            if lock is not None:
+                lock.close()
+            raise
+
+    def _touch(self, key, seconds):
+        rec = self._accesses.get(key)
+        if rec is None:
+            self._accesses[key] = [seconds, 1]
+            if len(self._accesses) >= MAX_PENDING_ACCESSES:
+                self._log_accesses()
+        else:
+            rec[0] = seconds
+            rec[1] += 1
+
+    def _log_accesses(self):
+        log_accesses(self.path, self._accesses)
+        self._accesses = {}
+
+    def _read_generation(self):
+        return GENERATION.unpack_from(self._gen_map)[0]
+
+    def _validate(self):
+        gen = self._read_generation()
+        if gen != self._generation:
+            self._lru.clear()
+            self._generation = gen
+
+    def _remember(self, key, holder):
+        lru = self._lru
+        lru[key] = holder
+        lru.move_to_end(key)
+        while len(lru) > self.lru_size:
+            lru.popitem(last=False)
+
+    def close(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._pending and not self._inflight:
+            self.flush()
+        if self._accesses:
+            self._log_accesses()
+        self._lru.clear()
+        if self._gen_map is not None:
+            self._gen_map.close()
+            self._gen_map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stats(self):
+        d = {}
+        d["lru_entries"] = len(self._lru)
+        d["generation"] = self._generation
+        d["hits"] = self.hits
+        d["misses"] = self.misses
+        d["evictions"] = self.evictions
+        d["pending_accesses"] = len(self._accesses)
+        d["pending_writes"] = len(self._pending) + len(self._inflight)
+        d["publishes"] = self.publishes
+        d.update(self.codec_stats.get_stats())
+        return d
+
+    def _queued(self, key):
+        holder = self._pending.get(key)
+        if holder is None:
+            holder = self._inflight.get(key)
+        return holder
+
+    def _lookup(self, key):
+        self._validate()
+        holder = self._queued(key)
+        if holder is None:
+            holder = self._lru.get(key)
+            if holder is not None:
+                self._lru.move_to_end(key)
+        if holder is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return holder
+
+    def _loaded(self, c, key):
+        holder = c.get_holder(key)
+        if holder:
+            self._remember(key, holder)
+        return holder
+
+    def _value(self, key, holder, default, max_timedelta):
+        if max_timedelta is None:
+            max_timedelta = self.max_timedelta
+        if not holder or not is_fresh(holder, max_timedelta):
+            return default
+        if self.max_bytes is not None:
+            self._touch(key, time())
+        return holder["data"]
+
+    def get(self, key, default=None, max_timedelta=None):
+        holder = self._lookup(key)
+        if holder is None:
+            try:
+                with self._open("r") as c:
+                    holder = self._loaded(c, key)
+            except FileNotFoundError:
+                return default
+        return self._value(key, holder, default, max_timedelta)
+
+    async def get_async(self, key, default=None, max_timedelta=None,
+                        timeout=None):
+        """Like get(), but a miss waits for the read lock asynchronously.
+
+        Raises filock.LockTimeout if the lock is not acquired within
+        timeout seconds.
+        """
+        holder = await self._holder_async(key, timeout)
+        return self._value(key, holder, default, max_timedelta)
+
+    async def get_holder_async(self, key, timeout=None):
+        """Holder of key whatever its age, None if there is none.
+
+        For callers that treat fresh and expired values differently with
+        one lookup, see is_fresh(). Counts as a read of key.
+        """
+        holder = await self._holder_async(key, timeout)
+        if not holder:
+            return None
+        if self.max_bytes is not None:
+            self._touch(key, time())
+        return holder
+
+    async def _holder_async(self, key, timeout):
+        holder = self._lookup(key)
+        if holder is None:
+            try:
+                c = await self._open_async("r", timeout)
+            except FileNotFoundError:
+                return None
+            try:
+                holder = self._loaded(c, key)
+            finally:
+                self._close_cache(c)
+        return holder
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        timestamp = datetime.utcnow()
+        if self.snapshots:
+            self._queue(key, self._holder(value, timestamp))
+            self._flush_now()
+            return
+        with self._open("w") as c:
+            gen = self._store(c, key, value, timestamp)
+            bumped = c.dirty
+        self._stored(gen, bumped, key, value, timestamp)
+
+    async def set_async(self, key, value, timeout=None):
+        """Like handle[key] = value, waiting for the write lock
+        asynchronously. Raises filock.LockTimeout on timeout.
+        """
+        timestamp = datetime.utcnow()
+        if self.snapshots:
+            self._queue(key, self._holder(value, timestamp))
+            if self._publish_due():
+                await self.flush_async(timeout)
+            else:
+                self._schedule_flush()
+            return
+        c = await self._open_async("w", timeout)
+        try:
+            gen = self._store(c, key, value, timestamp)
+            bumped = c.dirty
+        finally:
+            self._close_cache(c)
+        self._stored(gen, bumped, key, value, timestamp)
+
+    def _store(self, c, key, value, timestamp):
+        # the write lock is held, so the counter is stable here
+        gen = self._read_generation()
+        c.set_many([(key, value)], timestamp)
+        return gen
+
+    def _wrote(self, gen, bumped):
+        """Catch up with the counter after closing a cache we wrote to.
+
+        gen is the counter read under the write lock, bumped whether
+        closing the cache incremented it.
+        """
+        if gen != self._generation:
+            self._lru.clear()
+        # closing the cache bumped the counter once for our own write, which
+        # does not invalidate what we already hold
+        self._generation = gen + 1 if bumped else gen
+
+    def _stored(self, gen, bumped, key, value, timestamp):
+        self._wrote(gen, bumped)
+        self._remember(key, self._holder(value, timestamp))
+
+    def _holder(self, value, timestamp):
+        return {
+            "data": value,
+            "timestamp": timestamp,
+            "frozen": False,
+        }
+
+    def _queue(self, key, holder):
+        if not self._pending:
+            self._pending_since = monotonic()
+        self._pending[key] = holder
+        self._pending.move_to_end(key)
+
+    def _publish_due(self):
+        if self.publish_interval is None:
+            return True
+        if len(self._pending) >= self.publish_batch:
+            return True
+        return monotonic() - self._pending_since >= self.publish_interval
+
+    def _schedule_flush(self):
+        if self._flush_timer is not None:
+            return
+        delay = self.publish_interval
+        if self._pending_since is not None:
+            delay -= monotonic() - self._pending_since
+        loop = asyncio.get_event_loop()
+        self._flush_timer = loop.call_later(max(delay, 0), self._flush_later)
+
+    def _flush_later(self):
+        self._flush_timer = None
+        asyncio.ensure_future(self._flush_background())
+
+    async def _flush_background(self):
+        try:
+            await self.flush_async()
+        except Exception:
+            L.exception("publishing {} failed:".format(self.path))
+            if self._pending:
+                self._schedule_flush()
+
+    def _flush_now(self):
+        # The cache of a publish in flight shares the process lock with
+        # ours, so the queue is left to the flush that follows it.
+        if self._inflight:
+            self._schedule_flush()
+        else:
+            self.flush()
+
+    def _write_pending(self, c, pending, accesses):
+        """Write queued holders to c, runs on an executor thread."""
+        if accesses:
+            c.touch_many(accesses)
+        for key, holder in pending.items():
+            c.set_many([(key, holder["data"])], holder["timestamp"])
+
+    def _published(self, c, gen, bumped, pending):
+        self._closed(c)
+        self._wrote(gen, bumped)
+        self.publishes += 1
+        for key, holder in pending.items():
+            if key not in c.evicted:
+                self._remember(key, holder)
+
+    def _requeue(self, pending, accesses):
+        # values queued meanwhile are newer
+        pending.update(self._pending)
+        self._pending = pending
+        self._pending_since = monotonic()
+        for key, (seconds, count) in accesses.items():
+            rec = self._accesses.setdefault(key, [seconds, 0])
+            rec[0] = max(rec[0], seconds)
+            rec[1] += count
+
+    def _check_idle(self):
+        if self._inflight:
+            raise RuntimeError(
+                    "a snapshot is being published, await flush_async()")
+
+    def flush(self):
+        """Publish the queued writes now. Returns the number written.
+
+        Raises RuntimeError while flush_async() is publishing.
+        """
+        self._check_idle()
+        pending = self._pending
+        if not pending:
+            return 0
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._pending = collections.OrderedDict()
+        with self._open("w") as c:
+            gen = self._read_generation()
+            self._write_pending(c, pending, {})
+            bumped = c.dirty
+        self._published(c, gen, bumped, pending)
+        return len(pending)
+
+    async def flush_async(self, timeout=None):
+        """Publish the queued writes on an executor thread.
+
+        Waits for the write lock asynchronously and raises
+        filock.LockTimeout on timeout, keeping the writes queued. Returns
+        the number written.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            lock = await lock_cache_async(self.path, "w", self.snapshots,
+                                          timeout)
+            pending, self._pending = self._pending, collections.OrderedDict()
+            accesses, self._accesses = self._accesses, {}
+            self._inflight = pending
+            loop = asyncio.get_event_loop()
+            try:
+                c, gen, bumped = await loop.run_in_executor(
+                        None, self._publish, lock, pending, accesses)
+            except BaseException:
+                self._requeue(pending, accesses)
+                raise
+            finally:
+                self._inflight = {}
+            self._published(c, gen, bumped, pending)
+            return len(pending)
+
+    def _publish(self, lock, pending, accesses):
+        try:
+            c = self._cache("w", lock)
+        except BaseException:
+            lock.close()
+            raise
+        try:
+            # the write lock is held, so the counter is stable here
+            gen = self._read_generation()
+            self._write_pending(c, pending, accesses)
+            bumped = c.dirty
+        finally:
+            c.close()
+        return c, gen, bumped
+
+    def _unqueue(self, keys):
+        """Drop queued writes of keys before deleting them.
+
+        Queued writes of other keys are published before the deletion.
+        """
+        self._check_idle()
+        for key in keys:
+            self._pending.pop(key, None)
+        self.flush()
+
+    def __delitem__(self, key):
+        if self.snapshots:
+            self._unqueue([key])
+        with self._open("w") as c:
+            gen = self._read_generation()
+            del c[key]
+            bumped = c.dirty
+        self._wrote(gen, bumped)
+        self._lru.pop(key, None)
+
+    def get_many(self, keys, default=None, max_timedelta=None):
+        """Like get() for many keys; misses share one open of the cache."""
         if max_timedelta is None:
             max_timedelta = self.max_timedelta
+        self._validate()
         now = datetime.utcnow()
-        for k in keys:
-            holder = self.shelve.get(k)
-            if holder["frozen"]:
+        holders = {}
+        missing = []
+        for key in keys:
+            if key in holders:
                 continue
-            if now - holder["timestamp"] > max_timedelta:
-                del self[k]
-                res.append(k)
-        # reorganize underlying data structure to reclaim space
-        self.shelve.dict.reorganize()
+            holder = self._queued(key)
+            if holder is not None:
+                self.hits += 1
+            elif key in self._lru:
+                holder = self._lru[key]
+                self._lru.move_to_end(key)
+                self.hits += 1
+            else:
+                missing.append(key)
+            holders[key] = holder
+        if missing:
+            self.misses += len(missing)
+            try:
+                with self._open("r") as c:
+                    for key in missing:
+                        holder = c.get_holder(key)
+                        if holder:
+                            holders[key] = holder
+                            self._remember(key, holder)
+            except FileNotFoundError:
+                pass
+        res = {}
+        seconds = to_seconds(now)
+        for key, holder in holders.items():
+            if holder and is_fresh(holder, max_timedelta, now):
+                if self.max_bytes is not None:
+                    self._touch(key, seconds)
+                res[key] = holder["data"]
+            else:
+                res[key] = default
         return res
+
+    def set_many(self, items):
+        if hasattr(items, "items"):
+            items = items.items()
+        items = list(items)
+        timestamp = datetime.utcnow()
+        if self.snapshots:
+            for key, value in items:
+                self._queue(key, self._holder(value, timestamp))
+            self._flush_now()
+            return len(items)
+        with self._open("w") as c:
+            gen = self._read_generation()
+            c.set_many(items, timestamp)
+            bumped = c.dirty
+        self._wrote(gen, bumped)
+        for key, value in items:
+            self._remember(key, self._holder(value, timestamp))
+        return len(items)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if self.snapshots:
+            self._unqueue(keys)
+        with self._open("w") as c:
+            gen = self._read_generation()
+            n = c.delete_many(keys)
+            bumped = c.dirty
+        self._wrote(gen, bumped)
+        for key in keys:
+            self._lru.pop(key, None)
+        return n
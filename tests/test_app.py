@@ -0,0 +1,438 @@
+import asyncio
+import json
+import pickle
+import types
+import weakref
+
+import pytest
+
+pytest.importorskip("zmapi")
+
+import app
+import tcache
+from app import g
+from fixparse import FixMessageView
+from mdbook import OrderBook
+
+
+class Pub:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, parts):
+        self.sent.append(parts)
+
+    def flush(self):
+        pass
+
+
+class Ctl:
+
+    insid_to_tid = {"/FUT/CME/ES/123": "tid1"}
+
+
+@pytest.fixture
+def book(monkeypatch):
+    monkeypatch.setattr(g, "pub", Pub(), raising=False)
+    monkeypatch.setattr(g, "ctl", Ctl(), raising=False)
+    encoders = {name: cls() for name, cls in app.PUB_ENCODERS.items()}
+    monkeypatch.setattr(g, "md_encoders", encoders, raising=False)
+    monkeypatch.setattr(g, "default_pub_encoding", "json", raising=False)
+    monkeypatch.setitem(g.cts_secid_to_insid, "123", "/FUT/CME/ES/123")
+    book = OrderBook(3)
+    for px, size in ((100, 5), (99, 6)):
+        book["0"].append(px, size)
+    sub = app.create_empty_subscription()
+    sub["book"] = book
+    monkeypatch.setitem(g.subscriptions, "123", sub)
+    return book
+
+
+def published(i=-1):
+    msg_type, data = g.pub.sent[i]
+    return msg_type, json.loads(data.decode())
+
+
+def test_conflator_publishes_net_changes(book):
+    conflator = app.Conflator(60)
+    bids = book["0"]
+    for size in (7, 8, 9):
+        conflator.mark("123", "0", bids)
+        conflator.messages_in += 1
+        bids.update(0, size)
+    conflator.mark("123", "0", bids)
+    conflator.messages_in += 1
+    bids.insert(0, 101, 1)
+    conflator.mark("123", "0", bids)
+    conflator.messages_in += 1
+    bids.delete(0)
+    conflator.flush_all()
+    assert len(g.pub.sent) == 1
+    msg_type, d = published()
+    assert msg_type == b"X"
+    # the insert and delete of 101 cancel out
+    assert d["Body"]["MDIncGrp"] == [{
+        "MDUpdateAction": "1", "MDEntryType": "0", "MDEntryPx": 100.0,
+        "MDEntrySize": 9.0, "MDPriceLevel": 0, "ZMTickerID": "tid1",
+    }]
+    stats = conflator.get_stats()
+    assert stats["messages_in"] == 5
+    assert stats["messages_out"] == 1
+    assert stats["messages_collapsed"] == 4
+
+
+def test_conflator_unchanged_book_publishes_nothing(book):
+    conflator = app.Conflator(60)
+    bids = book["0"]
+    conflator.mark("123", "0", bids)
+    bids.update(0, 1)
+    bids.update(0, 5)
+    conflator.flush("123")
+    assert g.pub.sent == []
+
+
+def test_conflator_discard(book):
+    conflator = app.Conflator(60)
+    conflator.mark("123", "0", book["0"])
+    book["0"].delete(1)
+    conflator.discard("123")
+    conflator.flush_all()
+    assert g.pub.sent == []
+
+
+def inc_refresh(trading_status, *entries):
+    pairs = [(35, "X"), (52, "20180520-12:34:56.789"), (48, "123"),
+             (326, trading_status), (268, len(entries))]
+    for entry in entries:
+        pairs.extend(entry)
+    return FixMessageView(b"".join(
+            b"%d=%s\x01" % (tag, str(value).encode())
+            for tag, value in pairs))
+
+
+def test_security_status_published_on_change(book, monkeypatch):
+    monkeypatch.setattr(g, "conflator", None, raising=False)
+    monkeypatch.setattr(g, "seq_no", 1, raising=False)
+    sub = g.subscriptions["123"]
+    sub["initial_snapshot_completed"] = True
+    sub["MDReqGrp"] = "01"
+    reader = app.FIXReader()
+    bid = ((279, 1), (269, 0), (271, 7), (1023, 1))
+    for sts in (1, 1, 1, 2):
+        reader.handle_md_inc_refresh(inc_refresh(sts, bid))
+    topics = [topic for topic, _ in g.pub.sent]
+    assert topics == [b"h", b"X", b"X", b"X", b"h", b"X"]
+    seq_nos = [json.loads(data[1:])["Header"]["MsgSeqNum"]
+               for _, data in g.pub.sent]
+    assert seq_nos == list(range(1, 7))
+    assert sub["security_trading_status"] == \
+        app.CTSTS_TO_ZMTS[2]
+
+def decode_struct(data):
+    enc = app.StructPubEncoder
+    msg_type, version, seq_no, zm_ts, ts, tid_len, num_entries = \
+            enc.HEADER.unpack_from(data)
+    offset = enc.HEADER.size
+    tid = data[offset:offset + tid_len].decode()
+    offset += tid_len
+    entries = []
+    for _ in range(num_entries):
+        ua, et, flags, agg, px, size, lvl = enc.ENTRY.unpack_from(data, offset)
+        offset += enc.ENTRY.size
+        if flags & 8:
+            px = app.DOUBLE.unpack(app.INT64.pack(px))[0]
+        if flags & 16:
+            size = app.DOUBLE.unpack(app.INT64.pack(size))[0]
+        entries.append((ua, et, flags, agg, px, size, lvl))
+    assert offset == len(data)
+    return msg_type, version, seq_no, tid, entries
+
+
+def test_struct_encoder_keeps_fractional_values():
+    d = {
+        "Header": {"MsgSeqNum": 7, "ZMSendingTime": 1},
+        "Body": {"SendingTime": 2, "ZMTickerID": "tid1", "MDFullGrp": [
+            {"MDEntryType": "0", "MDEntryPx": 100.25, "MDEntrySize": 5.0,
+             "MDPriceLevel": 1},
+            {"MDUpdateAction": None, "MDEntryType": "1", "MDEntryPx": 101.0},
+            {"MDEntryType": "4", "MDEntryPx": 3, "AggressorSide": "1"},
+            {"MDEntryType": "B", "MDEntrySize": 2.5},
+        ]},
+    }
+    msg_type, version, seq_no, tid, entries = \
+            decode_struct(app.StructPubEncoder().encode("W", d))
+    assert (msg_type, version, seq_no, tid) == (b"W", 3, 7, "tid1")
+    assert entries == [
+        (b"\0", b"0", 1 | 2 | 4 | 8, -1, 100.25, 5, 1),
+        (b"\0", b"1", 1, -1, 101, 0, 0),
+        (b"\0", b"4", 1, 1, 3, 0, 0),
+        (b"\0", b"B", 2 | 16, -1, 0, 2.5, 0),
+    ]
+
+
+def test_struct_builder_matches_encoder():
+    encoder = app.StructPubEncoder()
+    builder = encoder.inc_builder("tid1")
+    builder.begin(2)
+    builder.add("0", "0", 100.5, 5, 0)
+    builder.add("2", "1", 101, None, 1)
+    builder.add("0", "B", None, 0.5)
+    d = {
+        "Header": {"MsgSeqNum": 3, "ZMSendingTime": 1},
+        "Body": {"SendingTime": 2, "MDIncGrp": [
+            {"MDUpdateAction": "0", "MDEntryType": "0", "MDEntryPx": 100.5,
+             "MDEntrySize": 5, "MDPriceLevel": 0, "ZMTickerID": "tid1"},
+            {"MDUpdateAction": "2", "MDEntryType": "1", "MDEntryPx": 101,
+             "MDPriceLevel": 1, "ZMTickerID": "tid1"},
+            {"MDUpdateAction": "0", "MDEntryType": "B", "MDEntrySize": 0.5,
+             "ZMTickerID": "tid1"},
+        ]},
+    }
+    assert builder.finish(3, 1) == encoder.encode("X", d)
+
+
+def test_publish_in_each_subscribed_encoding(book):
+    g.subscriptions["123"]["pub_encodings"].update(("json", "struct"))
+    conflator = app.Conflator(60)
+    conflator.mark("123", "0", book["0"])
+    book["0"].update(0, 7)
+    conflator.flush("123")
+    sent = dict(g.pub.sent)
+    assert sorted(sent) == [b"X", b"struct.X"]
+    d = json.loads(sent[b"X"].decode())
+    _, _, seq_no, tid, entries = decode_struct(sent[b"struct.X"])
+    assert seq_no == d["Header"]["MsgSeqNum"]
+    assert entries == [(b"1", b"0", 1 | 2 | 4, -1, 100, 7, 0)]
+
+
+def secdef(sec_id, symbol="ES", sub_type=None):
+    pairs = [(35, "d"), (167, "FUT"), (207, "CME"), (55, symbol),
+             (48, sec_id)]
+    if sub_type:
+        pairs.append((762, sub_type))
+    return FixMessageView(b"".join(
+            b"%d=%s\x01" % (tag, value.encode()) for tag, value in pairs))
+
+
+ES = {"SecurityType": "FUT", "SecurityExchange": "CME", "Symbol": "ES"}
+NQ = dict(ES, Symbol="NQ")
+
+
+def sec_ids(msgs):
+    return [msg.gets(48) for msg in msgs]
+
+
+def test_secdef_index_narrows_covered_query():
+    index = app.SecdefIndex(60)
+    assert index.lookup(ES) is None
+    assert index.add(ES, [secdef("1"), secdef("2", sub_type="S")])
+    assert sec_ids(index.lookup(ES)) == ["1", "2"]
+    assert sec_ids(index.lookup(dict(ES, SecuritySubType="S"))) == ["2"]
+    # broader queries are not covered
+    assert index.lookup({"SecurityType": "FUT"}) is None
+
+
+def test_secdef_index_drops_unlisted_definitions():
+    index = app.SecdefIndex(60)
+    index.add(ES, [secdef("1"), secdef("2")])
+    index.add(ES, [secdef("2"), secdef("3")])
+    assert sec_ids(index.lookup(ES)) == ["2", "3"]
+    assert index.get_stats()["definitions"] == 2
+
+
+def test_secdef_index_max_definitions():
+    index = app.SecdefIndex(60, max_definitions=3)
+    index.add(ES, [secdef("1"), secdef("2")])
+    index.add(NQ, [secdef("3", "NQ"), secdef("4", "NQ")])
+    stats = index.get_stats()
+    assert stats["definitions"] == 3
+    assert stats["evicted"] == 1
+    # ES lost a definition, so it is no longer answered locally
+    assert index.lookup(ES) is None
+    assert sec_ids(index.lookup(NQ)) == ["3", "4"]
+
+
+def test_secdef_index_bounds_sources():
+    index = app.SecdefIndex(60)
+    for i in range(index.MAX_SOURCES + 10):
+        index.add(dict(ES, SecurityID=str(i)), [secdef(str(i))])
+    assert len(index._sources) == index.MAX_SOURCES
+
+
+def test_secdef_index_skips_same_table_reloaded():
+    index = app.SecdefIndex(60)
+    table = app.FixTable([secdef("1"), secdef("2")])
+    assert index.add(ES, table)
+    # a cache hit that was unpickled again
+    assert not index.add(ES, pickle.loads(pickle.dumps(table)))
+    assert index.add(ES, app.FixTable([secdef("1")]))
+
+
+def test_secdef_index_keeps_no_tables():
+    index = app.SecdefIndex(60)
+    table = app.FixTable([secdef("1"), secdef("2")])
+    ref = weakref.ref(table)
+    assert index.add(ES, table)
+    assert not index.add(ES, table)
+    assert sec_ids(index.lookup(ES)) == ["1", "2"]
+    del table
+    # neither the rows nor the duplicate check pin the table
+    assert ref() is None
+    assert sec_ids(index.lookup(ES)) == ["1", "2"]
+
+
+def test_listen_topics_until_idle_timeout():
+    reader = app.FIXReader()
+    with pytest.raises(asyncio.TimeoutError):
+        g.loop.run_until_complete(reader.listen_topics_until(
+                ["d"], lambda msg: False, idle_timeout=10))
+    assert not reader._listeners
+
+
+def test_listen_topics_until_waits_while_messages_arrive():
+    reader = app.FIXReader()
+
+    async def send():
+        for i in range(6):
+            await asyncio.sleep(0.005)
+            for listener in reader._listeners["d"]:
+                listener.push(secdef(str(i)))
+
+    async def run():
+        task = asyncio.ensure_future(send())
+        res = await reader.listen_topics_until(
+                ["d"], lambda msg: msg.gets(48) == "5", idle_timeout=20)
+        await task
+        return res
+
+    assert sec_ids(g.loop.run_until_complete(run())) == \
+            ["0", "1", "2", "3", "4", "5"]
+
+
+def test_scheduler_raise_priority():
+    scheduler = app.SecdefScheduler(1000, 10)
+    order = []
+
+    async def waiter(name, priority, fut=None):
+        await scheduler.acquire(priority, fut)
+        order.append(name)
+
+    async def run():
+        await scheduler.acquire(0)
+        fut = g.loop.create_future()
+        tasks = [asyncio.ensure_future(waiter("refresh", 3, fut)),
+                 asyncio.ensure_future(waiter("listing", 2))]
+        await asyncio.sleep(0)
+        scheduler.raise_priority(fut, 1)
+        # raising to a less urgent priority does nothing
+        scheduler.raise_priority(fut, 3)
+        assert scheduler.get_stats()["queue_depth"] == 2
+        scheduler.release()
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        scheduler.release()
+
+    g.loop.run_until_complete(run())
+    assert order == ["refresh", "listing"]
+    assert scheduler.get_stats()["queue_depth"] == 0
+
+
+def test_scheduler_reserves_slot_for_lookups():
+    scheduler = app.SecdefScheduler(1000, 10)
+
+    async def run():
+        # a bulk listing is in flight
+        await scheduler.acquire(2)
+        listing = asyncio.ensure_future(scheduler.acquire(1))
+        await asyncio.wait_for(scheduler.acquire(0), 1)
+        assert scheduler.get_stats()["in_flight"] == 2
+        # the reserved slot is taken, another lookup waits too
+        lookup = asyncio.ensure_future(scheduler.acquire(0))
+        await asyncio.sleep(0)
+        assert not listing.done() and not lookup.done()
+        scheduler.release()
+        await lookup
+        assert not listing.done()
+        scheduler.release()
+        scheduler.release()
+        await listing
+        scheduler.release()
+
+    g.loop.run_until_complete(run())
+    assert scheduler.get_stats()["in_flight"] == 0
+
+
+def test_secdef_queries_are_bounded():
+    warmup = {"SecurityType": "FUT", "SecurityExchange": "CME"}
+    client = app.FIXClient({"SecdefRefreshMaxQueries": 2,
+                            "SecdefWarmup": [warmup]})
+    for data in (warmup, ES, NQ, ES, dict(ES, Symbol="YM")):
+        client._remember_secdef_query(app.dict_to_key(data), data)
+    assert list(client._secdef_queries.values()) == \
+            [ES, dict(ES, Symbol="YM")]
+    assert list(client._secdef_warmup.values()) == [warmup]
+
+
+def test_user_request_raises_refresh_priority():
+    client = app.FIXClient({})
+    scheduler = client.secdef_scheduler
+    key = app.dict_to_key(ES)
+
+    async def run():
+        await scheduler.acquire(0)
+        client._refresh_security_definitions(ES, key)
+        entry = client._secdef_requests[key]
+        await asyncio.sleep(0)
+        assert [x[0] for x in scheduler._queue] == \
+                [app.SECDEF_PRIORITY_BACKGROUND]
+        assert client._secdef_request(ES, key) is entry
+        assert entry[2] == app.secdef_priority(ES)
+        assert min(x[0] for x in scheduler._queue) == entry[2]
+        entry[0].cancel()
+        await asyncio.sleep(0)
+        scheduler.release()
+
+    g.loop.run_until_complete(run())
+    assert key not in client._secdef_requests
+
+
+@pytest.fixture
+def secdefs(tmp_path, monkeypatch):
+    path = str(tmp_path / "secdefs")
+    tcache.ensure_exists(path)
+    handle = tcache.open_handle(path, app.SECDEFS_TTL)
+    monkeypatch.setattr(g, "secdefs", handle, raising=False)
+    monkeypatch.setattr(g, "secdefs_lock_timeout", 1, raising=False)
+    monkeypatch.setattr(g, "secdef_index", app.SecdefIndex(60),
+                        raising=False)
+    yield handle
+    handle.close()
+
+
+def test_secdef_miss_looks_up_cache_once(secdefs, monkeypatch):
+    client = app.FIXClient({})
+    response = [secdef("1")]
+    fetched = []
+
+    def fetch(data, key, priority=None):
+        fetched.append(key)
+        fut = g.loop.create_future()
+        fut.set_result(response)
+        return [fut, 0]
+
+    monkeypatch.setattr(client, "_secdef_request", fetch)
+    res = g.loop.run_until_complete(client.security_definition_request(ES))
+    assert res is response
+    assert fetched == [app.dict_to_key(ES)]
+    assert secdefs.get_stats()["misses"] == 1
+
+
+@pytest.mark.parametrize("page_size", [0, -1, "10", 2.5, True])
+def test_security_list_rejects_bad_page_size(page_size):
+    ctl = types.SimpleNamespace(_sec_list_cursors={})
+    msg = {"Body": {"SecurityType": "FUT", "ZMPageSize": page_size}}
+    with pytest.raises(app.BusinessMessageRejectException):
+        g.loop.run_until_complete(
+                app.MDController.SecurityListRequest(ctl, None, None, msg))
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+import filock
+import filock.core
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# holds a lock on argv[1] in mode argv[2] for argv[3] seconds, or until
+# stdin is closed
+HOLDER = """
+import select, sys, filock
+f = filock.open(sys.argv[1], sys.argv[2])
+print("locked", flush=True)
+select.select([sys.stdin], [], [], float(sys.argv[3]))
+"""
+
+
+@pytest.fixture
+def fn(tmp_path):
+    fn = str(tmp_path / "lock")
+    open(fn, "w").close()
+    return fn
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = filock.LockStats()
+    monkeypatch.setattr(filock.core, "lock_stats", stats)
+    return stats
+
+
+@pytest.fixture
+def hold():
+    """Lock a file from another process, fcntl locks do not exclude the
+    process that takes them.
+    """
+    procs = []
+
+    def hold(fn, mode="w", seconds=60):
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        p = subprocess.Popen(
+                [sys.executable, "-c", HOLDER, fn, mode, str(seconds)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        procs.append(p)
+        assert p.stdout.readline() == b"locked\n"
+        return p
+
+    yield hold
+    for p in procs:
+        p.stdin.close()
+        p.wait()
+
+
+def test_uncontended(fn, stats):
+    f = asyncio.run(filock.open_async(fn, "w", timeout=0))
+    f.close()
+    d = stats.get_stats()
+    assert (d["acquired"], d["contended"], d["timeouts"]) == (1, 0, 0)
+
+
+@pytest.mark.parametrize("thread", [False, True])
+def test_timeout(fn, stats, hold, thread):
+    hold(fn)
+    with pytest.raises(filock.LockTimeout):
+        asyncio.run(filock.open_async(fn, "w", timeout=0.1, thread=thread))
+    d = stats.get_stats()
+    assert (d["acquired"], d["timeouts"]) == (0, 1)
+    assert d["wait_time"] >= 0.1
+
+
+def can_lock(fn):
+    """Whether another process gets a write lock on fn without waiting."""
+    code = "import sys, filock; filock.open(sys.argv[1], 'w', blocking=False)"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, "-c", code, fn], env=env,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+def test_cancelled_thread_releases_its_lock(fn, hold):
+    hold(fn, seconds=0.2)
+
+    async def run():
+        task = asyncio.ensure_future(filock.open_async(fn, "w", thread=True))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # the thread takes the lock once the holder exits, then drops it
+        await asyncio.sleep(0.5)
+        assert can_lock(fn)
+
+    asyncio.run(run())
+
+
+def test_shared_read_locks(fn, stats, hold):
+    hold(fn, "r")
+    f = asyncio.run(filock.open_async(fn, "r", timeout=0))
+    f.close()
+    assert stats.get_stats()["contended"] == 0
+
+
+@pytest.mark.parametrize("thread", [False, True])
+def test_acquired_after_release(fn, stats, hold, thread):
+    hold(fn, seconds=0.2)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        t = asyncio.ensure_future(tick())
+        f = await filock.open_async(fn, "w", timeout=10, thread=thread,
+                                    max_delay=0.02)
+        t.cancel()
+        f.close()
+
+    asyncio.run(run())
+    d = stats.get_stats()
+    assert (d["acquired"], d["contended"], d["timeouts"]) == (1, 1, 0)
+    assert 0.1 < d["max_wait"] < 10
+    # the loop kept running while the lock was contended
+    assert len(ticks) > 5
@@ -0,0 +1,160 @@
+import pickle
+
+from fixparse import FixMessageView, FixFramer
+
+
+def fix_msg(pairs, msg_type=b"X"):
+    body = b"35=" + msg_type + b"\x01" + b"".join(
+            b"%d=%s\x01" % (tag, value) for tag, value in pairs)
+    msg = b"8=FIX.4.4\x019=%d\x01" % len(body) + body
+    return msg + b"10=%03d\x01" % (sum(msg) % 256)
+
+
+INC_REFRESH = fix_msg([
+    (34, b"7"),
+    (52, b"20180102-03:04:05.678"),
+    (268, b"3"),
+    (279, b"0"), (269, b"0"), (270, b"101"), (271, b"5"), (1023, b"1"),
+    (279, b"1"), (269, b"1"), (270, b"102"), (271, b"6"),
+    (279, b"2"), (269, b"0"), (270, b"100"), (1023, b"3"),
+    (555, b"2"),
+    (600, b"A"), (623, b"1"),
+    (600, b"B"), (623, b"2"),
+])
+
+
+def test_field_lookup():
+    msg = FixMessageView(INC_REFRESH)
+    assert msg.get(35) == b"X"
+    assert msg.get(b"34") == b"7"
+    assert msg.gets(35) == "X"
+    assert msg.geti(34) == 7
+    assert msg.getf("270") == 101.0
+    assert msg.get(999) is None
+    assert msg.get(999, default=b"x") == b"x"
+
+
+def test_repeated_tags_without_separator():
+    msg = FixMessageView(INC_REFRESH)
+    assert msg.get(270) == b"101"
+    assert msg.get(270, 2) == b"102"
+    assert msg.get(270, 3) == b"100"
+    assert msg.get(270, 4) is None
+
+
+def test_group_lookup():
+    msg = FixMessageView(INC_REFRESH)
+    assert msg.group_size(279) == 3
+    assert msg.gets(269, 2, 279) == "1"
+    assert msg.geti(270, 3, 279) == 100
+    # a member missing from one instance is not taken from the next
+    assert msg.get(271, 3, 279) is None
+    assert msg.get(1023, 2, 279) is None
+    assert msg.geti(1023, 3, 279) == 3
+    assert msg.get(269, 4, 279) is None
+    assert msg.group_size(600) == 2
+    assert msg.gets(623, 2, 600) == "2"
+
+
+def test_unindexed_separator_scans():
+    msg = FixMessageView(INC_REFRESH)
+    # 269 is not a group delimiter: nth counts its occurrences
+    assert msg.get(270, 2, 269) == b"102"
+    assert msg.group_size(269) == 0
+
+
+def test_pairs_and_encode_round_trip():
+    msg = FixMessageView(INC_REFRESH)
+    assert msg.encode() == INC_REFRESH
+    assert b"".join(t + b"=" + v + b"\x01" for t, v in msg.pairs) \
+            == INC_REFRESH
+
+
+def test_view_into_shared_buffer_and_detach():
+    buf = bytearray(b"junk" + INC_REFRESH + b"more")
+    msg = FixMessageView(buf, 4, 4 + len(INC_REFRESH))
+    assert msg.encode() == INC_REFRESH
+    msg.detach()
+    buf[:] = b"\0" * len(buf)
+    assert msg.geti(270, 2, 279) == 102
+    assert msg.encode() == INC_REFRESH
+
+
+def test_pickle_round_trip():
+    buf = bytearray(INC_REFRESH)
+    msg = pickle.loads(pickle.dumps(FixMessageView(buf)))
+    assert msg.encode() == INC_REFRESH
+    assert msg.gets(269, 2, 279) == "1"
+
+
+def test_values_are_bytes():
+    framer = FixFramer()
+    framer.feed(INC_REFRESH)
+    msg = framer.get_message()
+    value = msg.get(270)
+    assert type(value) is bytes
+    assert {value: 1}[b"101"] == 1
+    assert all(type(v) is bytes for _, v in msg.pairs)
+
+
+def messages(framer):
+    return [msg.detach() for msg in framer]
+
+
+def test_framer_partial_frames():
+    heartbeat = fix_msg([(34, b"8")], b"0")
+    data = INC_REFRESH + heartbeat
+    framer = FixFramer(capacity=16)
+    res = []
+    for i in range(len(data)):
+        framer.feed(data[i:i + 1])
+        res.extend(messages(framer))
+    assert [m.encode() for m in res] == [INC_REFRESH, heartbeat]
+    assert len(framer) == 0
+
+
+def test_framer_buffer_protocol():
+    framer = FixFramer(capacity=32)
+    data = INC_REFRESH * 3
+    pos = 0
+    res = []
+    while pos < len(data):
+        buf = framer.get_buffer(50)
+        chunk = data[pos:pos + len(buf)]
+        buf[:len(chunk)] = chunk
+        framer.buffer_updated(len(chunk))
+        pos += len(chunk)
+        res.extend(messages(framer))
+    assert [m.encode() for m in res] == [INC_REFRESH] * 3
+
+
+def test_framer_resyncs_after_garbage():
+    framer = FixFramer()
+    framer.feed(b"xx8=FIX.4.4\x01XX=1\x01" + b"junk" + INC_REFRESH)
+    assert [m.encode() for m in messages(framer)] == [INC_REFRESH]
+
+
+def test_framer_bad_body_length():
+    framer = FixFramer()
+    framer.feed(b"8=FIX.4.4\x019=abc\x0135=0\x0110=000\x01" + INC_REFRESH)
+    assert [m.encode() for m in messages(framer)] == [INC_REFRESH]
+    # A BodyLength that does not end at a CheckSum is only detected once
+    # that much data has arrived, the messages after it are not lost.
+    bad = INC_REFRESH.replace(b"\x019=", b"\x019=1", 1)
+    framer.feed(bad[:40] + INC_REFRESH)
+    assert messages(framer) == []
+    framer.feed(INC_REFRESH * 10)
+    assert [m.encode() for m in messages(framer)] == [INC_REFRESH] * 11
+
+
+def test_framer_bad_tag():
+    framer = FixFramer()
+    framer.feed(fix_msg([(34, b"1")]).replace(b"\x0134=", b"\x01x4=")
+                + INC_REFRESH)
+    assert [m.encode() for m in messages(framer)] == [INC_REFRESH]
+
+
+def test_framer_long_garbage_run():
+    framer = FixFramer()
+    framer.feed(b"8=FIX.4.4\x01XX\x01" * 20000 + INC_REFRESH)
+    assert [m.encode() for m in messages(framer)] == [INC_REFRESH]
@@ -0,0 +1,124 @@
+import pickle
+from array import array
+
+import pytest
+
+from fixparse import FixMessageView, FixTable
+
+from test_fixparse import fix_msg
+
+
+SECDEFS = [
+    fix_msg([
+        (55, b"ES"), (48, b"1"), (200, b"201812"),
+        (454, b"2"), (455, b"ESZ8"), (456, b"8"), (455, b"ES 1218"),
+        (456, b"97"),
+    ], b"d"),
+    # a spread: legs, a tag the first message does not have, no alt IDs
+    fix_msg([
+        (55, b"ES"), (48, b"2"), (762, b"SP"),
+        (555, b"2"),
+        (600, b"ESZ8"), (623, b"1"), (624, b"1"),
+        (600, b"ESH9"), (624, b"2"),
+    ], b"d"),
+    # repeated tag outside of any group
+    fix_msg([(55, b"NQ"), (48, b"3"), (58, b"a"), (58, b"b")], b"d"),
+]
+
+LOOKUPS = [
+    (55, 1, None), (48, 1, None), (200, 1, None), (762, 1, None),
+    (58, 1, None), (58, 2, None), (58, 3, None), (999, 1, None),
+    (455, 1, 455), (455, 2, 455), (455, 3, 455), (456, 2, 455),
+    (600, 1, 600), (600, 2, 600), (623, 1, 600), (623, 2, 600),
+    (624, 2, 600), (600, 0, 600),
+    # 55 is not a group delimiter, falls back to scanning
+    (48, 1, 55), (58, 2, 55),
+]
+
+
+@pytest.fixture
+def table():
+    return FixTable(FixMessageView(raw) for raw in SECDEFS)
+
+
+def test_rows_match_views(table):
+    assert len(table) == len(SECDEFS)
+    for raw, row in zip(SECDEFS, table):
+        view = FixMessageView(raw)
+        for tag, nth, sep in LOOKUPS:
+            assert row.get(tag, nth, sep) == view.get(tag, nth, sep), \
+                    (tag, nth, sep)
+        for sep in (454, 555, 268):
+            assert row.group_size(sep) == view.group_size(sep)
+        assert row.pairs == view.pairs
+        assert row.encode() == view.encode()
+
+
+def test_typed_getters(table):
+    row = table[1]
+    assert row.gets(762) == "SP"
+    assert row.geti(624, 2, 600) == 2
+    assert row.getf(623, 1, 600) == 1.0
+    assert row.gets(999, default=b"x") == "x"
+    assert row.geti(623, 2, 600) is None
+
+
+def test_indexing(table):
+    assert table[-1].gets(48) == "3"
+    assert [row.gets(48) for row in table[1:]] == ["2", "3"]
+    with pytest.raises(IndexError):
+        table[3]
+    with pytest.raises(IndexError):
+        table[-4]
+
+
+def test_values_are_interned(table):
+    # ES and ESZ8 appear twice but are stored once
+    assert table.strings.count(b"ES") == 1
+    assert table.strings.count(b"ESZ8") == 1
+
+
+def test_pickle_round_trip(table):
+    loaded = pickle.loads(pickle.dumps(table))
+    assert [row.encode() for row in loaded] == [row.encode() for row in table]
+    # appending after a load rebuilds the intern map
+    loaded.append(FixMessageView(SECDEFS[2]))
+    assert loaded[3].gets(48) == "3"
+    assert loaded.strings.count(b"NQ") == 1
+
+
+def test_pickled_row_is_a_view(table):
+    row = pickle.loads(pickle.dumps(table[1]))
+    assert isinstance(row, FixMessageView)
+    assert row.get(600, 2, 600) == b"ESH9"
+
+
+def test_equality(table):
+    assert pickle.loads(pickle.dumps(table)) == table
+    assert FixTable(FixMessageView(raw) for raw in SECDEFS[:2]) != table
+    assert table != list(table)
+
+
+def test_repeats_are_stored_column_wise():
+    raw = fix_msg([(48, b"1"), (58, b"a"), (58, b"b")], b"d")
+    table = FixTable(FixMessageView(raw) for _ in range(1000))
+    offsets, values = table.repeats[58]
+    assert len(table.repeats) == 1
+    assert len(offsets) == 1001 and len(values) == 2000
+    assert table[999].get(58, 2) == b"b"
+
+
+def test_load_old_repeats(table):
+    d = table.__getstate__()
+    # one array per (row, repeated tag), as pickled by older versions
+    d["repeats"] = {
+        (0, 455): array("i", table.repeats[455][1][:2]),
+        (0, 456): array("i", table.repeats[456][1][:2]),
+        (2, 58): array("i", table.repeats[58][1][-2:]),
+    }
+    loaded = FixTable.__new__(FixTable)
+    loaded.__setstate__(d)
+    for raw, row in zip(SECDEFS, loaded):
+        view = FixMessageView(raw)
+        for tag, nth, sep in LOOKUPS:
+            assert row.get(tag, nth, sep) == view.get(tag, nth, sep)
@@ -0,0 +1,214 @@
+import random
+from fractions import Fraction
+
+import pytest
+
+from mdbook import Ladder, OrderBook, TickSize, UNIT_TICK_SIZE
+from mdbook.ticks import decimal_exponent, parse_tick_field
+
+
+def levels(ladder):
+    return list(zip(*ladder.copy_levels()))
+
+
+def test_ladder_insert_overflow():
+    ladder = Ladder(3)
+    assert ladder.insert(0, 100, 1) is None
+    assert ladder.insert(0, 101, 2) is None
+    assert ladder.insert(5, 99, 3) is None
+    assert levels(ladder) == [(101, 2), (100, 1), (99, 3)]
+    # a full ladder pushes out its last level
+    assert ladder.insert(1, 102, 4) == 99
+    assert levels(ladder) == [(101, 2), (102, 4), (100, 1)]
+    # inserting past the capacity drops the new level itself
+    assert ladder.insert(3, 50, 5) == 50
+    assert len(ladder) == 3
+
+
+def test_ladder_update_delete():
+    ladder = Ladder(4)
+    for price in (10, 9, 8):
+        ladder.append(price, price * 10)
+    assert ladder.update(1, 5) == 9
+    assert ladder.update(1) == 9
+    assert ladder.size(1) == 5
+    assert ladder.delete(0) == 10
+    assert levels(ladder) == [(9, 5), (8, 80)]
+    with pytest.raises(IndexError):
+        ladder.delete(2)
+    with pytest.raises(IndexError):
+        ladder.update(-1, 1)
+    with pytest.raises(IndexError):
+        ladder.price(2)
+    ladder.clear()
+    assert len(ladder) == 0
+    assert ladder.append(1) and ladder.append(2) and ladder.append(3)
+    assert ladder.append(4)
+    assert not ladder.append(5)
+
+
+def test_ladder_matches_list_model():
+    rnd = random.Random(1)
+    capacity = 5
+    ladder = Ladder(capacity)
+    model = []
+    for _ in range(5000):
+        op = rnd.random()
+        if op < 0.5 or not model:
+            pos = rnd.randrange(len(model) + 2)
+            price, size = rnd.randrange(1000), rnd.randrange(1, 100)
+            overflow = ladder.insert(pos, price, size)
+            pos = min(pos, len(model))
+            if pos >= capacity:
+                assert overflow == price
+                continue
+            model.insert(pos, (price, size))
+            expected = model.pop()[0] if len(model) > capacity else None
+            assert overflow == expected
+        elif op < 0.75:
+            pos = rnd.randrange(len(model))
+            size = rnd.randrange(1, 100)
+            assert ladder.update(pos, size) == model[pos][0]
+            model[pos] = (model[pos][0], size)
+        else:
+            pos = rnd.randrange(len(model))
+            assert ladder.delete(pos) == model.pop(pos)[0]
+        assert levels(ladder) == model
+
+
+def apply_diff(old, changes):
+    book = list(old)
+    for action, pos, price, size in changes:
+        if action == "0":
+            book.insert(pos, (price, size))
+        elif action == "1":
+            assert book[pos][0] == price
+            book[pos] = (price, size)
+        else:
+            assert book[pos] == (price, size)
+            del book[pos]
+    return book
+
+
+@pytest.mark.parametrize("descending", [True, False])
+def test_ladder_diff(descending):
+    rnd = random.Random(2)
+    for _ in range(500):
+        old = sorted(rnd.sample(range(50), rnd.randrange(8)),
+                     reverse=descending)
+        new = sorted(rnd.sample(range(50), rnd.randrange(8)),
+                     reverse=descending)
+        old = [(px, rnd.randrange(1, 4)) for px in old]
+        new = [(px, rnd.randrange(1, 4)) for px in new]
+        ladder = Ladder(8)
+        for px, size in new:
+            ladder.append(px, size)
+        changes = ladder.diff([px for px, _ in old], [s for _, s in old],
+                              descending)
+        assert apply_diff(old, changes) == new
+        # one change per deleted, inserted or resized level
+        old_px, new_px = dict(old), dict(new)
+        common = old_px.keys() & new_px.keys()
+        assert len(changes) == len(old_px.keys() - common) \
+                + len(new_px.keys() - common) \
+                + sum(1 for px in common if old_px[px] != new_px[px])
+
+
+def make_book():
+    book = OrderBook(3)
+    for px, size in ((101, 1), (100, 2), (99, 3)):
+        book["0"].append(px, size)
+    for px, size in ((102, 4), (103, 5)):
+        book["1"].append(px, size)
+    book.set_stat({"MDEntryType": "4", "MDEntryPx": 100.0})
+    book.set_stat({"MDEntryType": "B", "MDEntrySize": 10.0})
+    book.last_trade = {"MDEntryType": "2", "MDEntryPx": 101.0}
+    return book
+
+
+def test_order_book_snapshot():
+    group = make_book().snapshot()
+    bids = [(e["MDEntryPx"], e["MDEntrySize"], e["MDPriceLevel"])
+            for e in group if e["MDEntryType"] == "0"]
+    assert bids == [(101.0, 1.0, 1), (100.0, 2.0, 2), (99.0, 3.0, 3)]
+    assert [e["MDEntryType"] for e in group] \
+            == ["0", "0", "0", "1", "1", "4", "B", "2"]
+
+
+def test_order_book_snapshot_filters():
+    book = make_book()
+    group = book.snapshot("1B", 1)
+    assert group == [
+        {"MDEntryType": "1", "MDEntryPx": 102.0, "MDEntrySize": 4.0,
+         "MDPriceLevel": 1},
+        {"MDEntryType": "B", "MDEntrySize": 10.0},
+    ]
+    assert len(book.snapshot(depth=10)) == len(book.snapshot())
+    # entries are copies
+    book.snapshot()[-1]["MDEntryPx"] = 0
+    assert book.last_trade["MDEntryPx"] == 101.0
+
+
+def test_order_book_stat_delete():
+    book = make_book()
+    book.set_stat({"MDEntryType": "4"}, "2")
+    assert "4" not in book.stats
+    book.set_stat({"MDEntryType": "7"}, "2")
+    book.set_stat({"MDEntryType": "B", "MDEntrySize": 11.0}, "1")
+    assert book.stats == {"B": {"MDEntryType": "B", "MDEntrySize": 11.0}}
+
+
+def test_order_book_clear():
+    book = make_book()
+    book.price_limits["HighLimitPrice"] = 110
+    book.clear()
+    assert book.snapshot() == []
+    assert book.price_limits == {}
+
+
+def test_parse_tick_field_tables():
+    assert parse_tick_field("3125/100000 RTS(78125/10000000)") == \
+            (Fraction(1, 32), {"RTS": Fraction(1, 128)})
+    assert parse_tick_field(" 0.25 ") == (Fraction(1, 4), {})
+
+
+@pytest.mark.parametrize("x, k", [
+    (Fraction(1), 0),
+    (Fraction(1, 4), 2),
+    (Fraction(1, 32), 5),
+    (Fraction(5, 2), 1),
+    (Fraction(1, 3), None),
+])
+def test_decimal_exponent(x, k):
+    assert decimal_exponent(x) == k
+
+
+def test_tick_size_parse():
+    ts = TickSize.parse("3125/100000 RTS(78125/10000000)",
+                        "31.25 RTS(7.8125)")
+    assert (ts.ratio, ts.amount) == (Fraction(1, 32), Fraction(125, 4))
+    assert (ts.exponent, ts.scale) == (5, 3125)
+    rts = ts.tables["RTS"]
+    assert (rts.ratio, rts.amount) == (Fraction(1, 128), Fraction(125, 16))
+    assert rts.scale == 78125
+    assert TickSize.parse("0.01").tables == {}
+    assert TickSize.parse("0.01").amount is None
+
+
+def test_tick_size_price():
+    ts = TickSize.parse("3125/100000")
+    assert ts.price(b"3") == 9375
+    assert ts.price("-2") == -6250
+    assert ts.price(memoryview(b"1.5")) == 4687.5
+    assert ts.price("0.2") == 625
+    assert ts.price(None) is None
+    assert type(ts.price("0.2")) is int
+
+
+def test_tick_size_without_decimal_scale():
+    ts = TickSize(Fraction(1, 3))
+    assert ts.scale is None
+    # prices pass through unscaled
+    assert ts.price(b"7") == 7
+    assert UNIT_TICK_SIZE.price(b"12") == 12
+    assert UNIT_TICK_SIZE.price("1.5") == 1.5
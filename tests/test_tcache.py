@@ -0,0 +1,475 @@
+import asyncio
+import dbm
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import tcache
+from tcache.core import (GENERATION, access_log_path, generation_path,
+                         read_snapshot)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache")
+
+
+@pytest.fixture
+def cache(path):
+    """Path of an existing empty cache, handles only write to those."""
+    tcache.ensure_exists(path)
+    return path
+
+
+def file_generation(path):
+    with open(generation_path(path), "rb") as f:
+        return GENERATION.unpack(f.read())[0]
+
+
+def test_cache_mapping(path):
+    with tcache.open(path) as c:
+        c["a"] = 1
+        c.update({"b": 2, "c": 3})
+        del c["c"]
+    with tcache.open(path, "r") as c:
+        assert dict(c.items()) == {"a": 1, "b": 2}
+        assert c.get("c") is None
+        with pytest.raises(KeyError):
+            c["c"]
+
+
+def test_read_only_open_of_missing_cache(path):
+    with pytest.raises(FileNotFoundError):
+        tcache.open(path, "r")
+
+
+def test_cache_expiry(path):
+    with tcache.open(path) as c:
+        c["a"] = 1
+    with tcache.open(path, "r", max_timedelta=timedelta(0)) as c:
+        assert c.get("a") is None
+        assert c.get("a", max_timedelta=timedelta(hours=1)) == 1
+
+
+def test_cache_batch_ops(path):
+    with tcache.open(path) as c:
+        assert c.set_many([("a", 1), ("b", 2)]) == 2
+        assert c.set_many({"c": 3}) == 1
+        assert c.set_many([]) == 0
+        assert c.get_holder("a")["timestamp"] == \
+            c.get_holder("b")["timestamp"]
+        assert c.get_many(["a", "x", "a"], default=0) == {"a": 1, "x": 0}
+        assert c.delete_many(["a", "x", "a"]) == 1
+    # one generation bump for the whole batch
+    assert file_generation(path) == 1
+    with tcache.open(path, "r") as c:
+        assert c.get_many("abc") == {"a": None, "b": 2, "c": 3}
+
+
+def test_cache_get_many_expiry(path):
+    with tcache.open(path) as c:
+        c.set_many({"a": 1}, timestamp=age(2))
+        c.set_many({"b": 2})
+        assert c.get_many("ab", max_timedelta=timedelta(hours=1)) == \
+            {"a": None, "b": 2}
+        c.freeze("a")
+        assert c.get_many("ab", max_timedelta=timedelta(hours=1)) == \
+            {"a": 1, "b": 2}
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_compression(path, codec):
+    value = [("XCME", "USD", "ES{}".format(i)) for i in range(100)]
+    with tcache.open(path, compression=codec) as c:
+        c["a"] = value
+        assert c.shelve["a"]["codec"] == codec
+        stats = c.codec_stats.get_stats()
+        assert stats["compressed_values"] == 1
+        assert stats["compression_ratio"] > 1
+    with tcache.open(path, "r") as c:
+        assert c["a"] == value
+        assert c.codec_stats.get_stats()["decompressed_values"] == 1
+
+
+def test_compression_reads_other_codecs(path):
+    with tcache.open(path) as c:
+        c["plain"] = 1
+    with tcache.open(path, compression="zlib") as c:
+        c["zlib"] = 2
+        assert c.get_many(["plain", "zlib"]) == {"plain": 1, "zlib": 2}
+    with tcache.open(path, compression="lzma") as c:
+        assert dict(c.items()) == {"plain": 1, "zlib": 2}
+
+
+def test_unknown_compression(path):
+    with pytest.raises(ValueError):
+        tcache.open(path, compression="snappy")
+
+
+def test_handle_codec_stats(cache):
+    with tcache.open_handle(cache, compression="zlib") as h1, \
+            tcache.open_handle(cache) as h2:
+        h1["a"] = "x" * 1000
+        assert h2.get("a") == "x" * 1000
+        assert h1.get_stats()["compressed_values"] == 1
+        assert h2.get_stats()["decompressed_values"] == 1
+
+
+def test_handle_hits_after_own_writes(cache):
+    with tcache.open_handle(cache) as h:
+        h["a"] = 1
+        h.set_many({"b": 2})
+        assert h.get("a") == 1
+        assert h.get_many(["a", "b", "a"]) == {"a": 1, "b": 2}
+        stats = h.get_stats()
+        assert (stats["hits"], stats["misses"]) == (3, 0)
+        assert stats["generation"] == file_generation(cache) == 2
+
+
+def test_handle_sees_other_writers(cache):
+    with tcache.open_handle(cache) as h1, tcache.open_handle(cache) as h2:
+        h1["a"] = 1
+        assert h2.get("a") == 1
+        assert h2.get("a") == 1
+        assert h2.get_stats()["hits"] == 1
+        h1["a"] = 2
+        assert h2.get("a") == 2
+        del h1["a"]
+        assert h2.get("a") is None
+
+
+def test_handle_delete_keeps_lru(cache):
+    with tcache.open_handle(cache) as h:
+        h.set_many({"a": 1, "b": 2, "c": 3})
+        del h["a"]
+        assert h.delete_many(["b", "x"]) == 1
+        assert h.get_stats()["generation"] == file_generation(cache) == 3
+        assert h.get("c") == 3
+        assert h.get("a") is None
+        stats = h.get_stats()
+        assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_handle_noop_writes_keep_generation(cache):
+    with tcache.open_handle(cache) as h:
+        h["a"] = 1
+        h.set_many([])
+        assert h.delete_many(["x"]) == 0
+        with pytest.raises(KeyError):
+            del h["x"]
+        assert h.get_stats()["generation"] == file_generation(cache) == 1
+        assert h.get("a") == 1
+        assert h.get_stats()["hits"] == 1
+
+
+def test_handle_lru_size(cache):
+    with tcache.open_handle(cache, lru_size=2) as h:
+        h.set_many([("a", 1), ("b", 2)])
+        assert h.get("a") == 1
+        # b is the least recently used one
+        h["c"] = 3
+        assert h.get_stats()["lru_entries"] == 2
+        assert h.get("a") == 1
+        assert h.get("b") == 2
+        stats = h.get_stats()
+        assert (stats["hits"], stats["misses"]) == (2, 1)
+
+
+def test_handle_expiry(cache):
+    with tcache.open_handle(cache, max_timedelta=timedelta(0)) as h:
+        h["a"] = 1
+        assert h.get("a") is None
+        assert h.get("a", max_timedelta=timedelta(hours=1)) == 1
+
+
+def age(hours):
+    return datetime.utcnow() - timedelta(hours=hours)
+
+
+def test_clear_expired_oldest_first(path):
+    with tcache.open(path) as c:
+        c.set_many({"a": 1, "b": 2}, timestamp=age(50))
+        c.set_many({"c": 3}, timestamp=age(30))
+        c.set_many({"d": 4}, timestamp=age(26))
+        c["e"] = 5
+        c.set_many({"f": 6}, timestamp=age(40))
+        c.freeze("f")
+        # rewritten since, no longer expired
+        c["b"] = 2
+    with tcache.Cache(path, compact_ratio=10) as c:
+        assert c.clear_expired(timedelta(hours=24), limit=2) == ["a", "c"]
+        assert c.clear_expired(timedelta(hours=24)) == ["d"]
+        assert c.clear_expired(timedelta(hours=24)) == []
+        assert sorted(c) == ["b", "e", "f"]
+        assert c.total_bytes() > 0
+
+
+def test_clear_expired_reads_only_old_buckets(path):
+    with tcache.open(path) as c:
+        for i in range(50):
+            c[str(i)] = i
+        c.set_many({"old": 0}, timestamp=age(48))
+    with tcache.Cache(path, compact_ratio=10) as c:
+        index = c._get_index()
+        reads = []
+        c._index = ReadCounter(index, reads)
+        assert c.clear_expired(timedelta(hours=24)) == ["old"]
+        c._index = index
+        assert reads.count(b"old") == 2  # the sweep, then the delete
+        assert not [k for k in reads if k.isdigit()]
+
+
+class ReadCounter:
+
+    def __init__(self, db, reads):
+        self._db = db
+        self._reads = reads
+
+    def get(self, k, default=None):
+        self._reads.append(k)
+        return self._db.get(k, default)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __getitem__(self, k):
+        self._reads.append(k)
+        return self._db[k]
+
+    def __setitem__(self, k, v):
+        self._db[k] = v
+
+    def __delitem__(self, k):
+        del self._db[k]
+
+
+def test_compact_in_chunks(path):
+    with tcache.open(path) as c:
+        c.set_many({str(i): "x" * 100 for i in range(20)})
+        c.delete_many(str(i) for i in range(10))
+        assert not c.compact(chunk=4)
+    with tcache.open(path) as c:
+        # writes during the compaction reach the copy as well
+        c["new"] = 1
+        del c["10"]
+        assert not c.compact(chunk=4)
+    size = os.path.getsize(path + ".dat")
+    index_size = os.path.getsize(path + ".exp.dat")
+    with tcache.open(path) as c:
+        assert c.compact(chunk=4)
+        assert c._get_index()[b"\0deleted"] == b"0"
+    assert os.path.getsize(path + ".dat") < size
+    assert os.path.getsize(path + ".exp.dat") < index_size
+    assert not os.path.exists(path + ".compact.dat")
+    assert not os.path.exists(path + ".exp.compact.dat")
+    with tcache.open(path, "r") as c:
+        assert sorted(c) == sorted([str(i) for i in range(11, 20)] + ["new"])
+        assert c["new"] == 1
+
+
+def test_index_grows_linearly(path):
+    # filing a key adds records instead of rewriting its bucket
+    n = 2000
+    with tcache.open(path) as c:
+        c.set_many({str(i): i for i in range(n)})
+    assert os.path.getsize(path + ".exp.dat") < 1100 * n
+
+
+def test_clear_expired_compacts(path):
+    with tcache.open(path) as c:
+        c.set_many({str(i): i for i in range(6)}, timestamp=age(48))
+        c.set_many({str(i): i for i in range(6, 10)})
+    with tcache.Cache(path, compact_ratio=0.5, compact_chunk=2) as c:
+        assert len(c.clear_expired(timedelta(hours=24))) == 6
+        assert os.path.exists(path + ".compact.dat")
+    with tcache.Cache(path, compact_chunk=2) as c:
+        c.clear_expired(timedelta(hours=24))
+        assert not os.path.exists(path + ".compact.dat")
+        assert sorted(c) == [str(i) for i in range(6, 10)]
+
+
+def test_legacy_cache_needs_migration(path):
+    with tcache.open(path) as c:
+        c.set_many({"a": 1}, timestamp=age(48))
+        c.freeze("a")
+        c["b"] = 2
+    for fn in os.listdir(os.path.dirname(path)):
+        if fn.startswith("cache.exp"):
+            os.remove(os.path.join(os.path.dirname(path), fn))
+    with tcache.open(path, "r") as c:
+        assert c["a"] == 1
+    with pytest.raises(tcache.MigrationRequired):
+        with tcache.open(path) as c:
+            c["c"] = 3
+    assert tcache.migrate(path)
+    assert not tcache.migrate(path)
+    with tcache.open(path) as c:
+        c.unfreeze("a")
+        assert c.clear_expired(timedelta(hours=24)) == ["a"]
+        assert c.total_bytes() == c._total_bytes > 0
+        assert c._total_entries == 1
+
+
+def test_migrate_index_version_2(path):
+    with tcache.open(path) as c:
+        c.set_many({"a": 1}, timestamp=age(48))
+        c["b"] = 2
+        index = c._get_index()
+        for n in c._buckets(index):
+            del index[tcache.core.bucket_key(n)]
+        del index[b"\0buckets"]
+        index[b"\0version"] = b"2"
+    with pytest.raises(tcache.MigrationRequired):
+        with tcache.open(path) as c:
+            c.clear_expired(timedelta(hours=24))
+    assert tcache.migrate(path)
+    with tcache.open(path) as c:
+        assert c.clear_expired(timedelta(hours=24)) == ["a"]
+
+
+def test_migrate_index_version_3(path):
+    with tcache.open(path) as c:
+        c.set_many({"a": 1, "b": 2}, timestamp=age(48))
+        c["c"] = 3
+        index = c._get_index()
+        # buckets held their keys in one NUL separated value
+        for n in c._buckets(index):
+            keys = c._bucket_keys(index, n)
+            c._set_bucket(index, n, [])
+            index[tcache.core.bucket_key(n)] = b"\0".join(keys)
+        index[b"\0version"] = b"3"
+    assert tcache.migrate(path)
+    with tcache.open(path) as c:
+        assert sorted(c.clear_expired(timedelta(hours=24))) == ["a", "b"]
+        assert sorted(c) == ["c"]
+
+
+def test_snapshot_handle_batches_writes(path):
+    tcache.ensure_exists(path, snapshots=True)
+    first = read_snapshot(path)[1]
+
+    async def run():
+        h = tcache.open_handle(path, snapshots=True, publish_interval=60,
+                               publish_batch=3)
+        other = tcache.open_handle(path, snapshots=True)
+        await h.set_async("a", 1)
+        await h.set_async("b", 2)
+        assert h.get("a") == 1
+        assert other.get("a") is None
+        stats = h.get_stats()
+        assert (stats["pending_writes"], stats["publishes"]) == (2, 0)
+        await h.set_async("c", 3)
+        assert h.get_stats()["publishes"] == 1
+        assert read_snapshot(path)[1] == first + 1
+        assert other.get_many("abc") == {"a": 1, "b": 2, "c": 3}
+        h.close()
+        other.close()
+
+    asyncio.run(run())
+
+
+def test_snapshot_handle_publishes_later(path):
+    tcache.ensure_exists(path, snapshots=True)
+
+    async def run():
+        h = tcache.open_handle(path, snapshots=True, publish_interval=0.01)
+        await h.set_async("a", 1)
+        await h.set_async("b", 2)
+        await asyncio.sleep(0.2)
+        assert h.get_stats()["publishes"] == 1
+        await h.set_async("c", 3)
+        h.close()
+
+    asyncio.run(run())
+    with tcache.open(path, "r", snapshots=True) as c:
+        assert dict(c.items()) == {"a": 1, "b": 2, "c": 3}
+
+
+def test_snapshot_handle_delete_drops_queued(path):
+    tcache.ensure_exists(path, snapshots=True)
+
+    async def run():
+        with tcache.open_handle(path, snapshots=True,
+                                publish_interval=60) as h:
+            await h.set_async("a", 1)
+            await h.set_async("b", 2)
+            assert h.delete_many(["a"]) == 0
+            assert h.get("a") is None
+            assert h.get_stats()["pending_writes"] == 0
+
+    asyncio.run(run())
+    with tcache.open(path, "r", snapshots=True) as c:
+        assert dict(c.items()) == {"b": 2}
+
+
+def test_snapshots_take_over_plain_cache(path):
+    with tcache.open(path) as c:
+        c["a"] = 1
+    tcache.ensure_exists(path, snapshots=True)
+    assert dbm.whichdb(path) is None
+    assert not tcache.migrate(path, snapshots=True)
+    with tcache.open(path, "r", snapshots=True) as c:
+        assert dict(c.items()) == {"a": 1}
+
+
+def fill(path, **kwargs):
+    """Write a, b and c, oldest first, return the size of one entry."""
+    with tcache.Cache(path, **kwargs) as c:
+        for i, key in enumerate("abc"):
+            c.set_many({key: "x" * 100}, timestamp=age(3 - i))
+        return c.total_bytes() // 3
+
+
+def test_evict_least_recently_read(path):
+    size = fill(path)
+    with tcache.Cache(path, "r", max_bytes=1 << 20) as c:
+        assert c.get("a") == "x" * 100
+    # logged by the reader, folded in by the next writer
+    assert os.path.exists(access_log_path(path))
+    with tcache.Cache(path, evict_ratio=1) as c:
+        assert c.evict(2 * size) == ["b"]
+    assert not os.path.exists(access_log_path(path))
+
+
+def test_evict_least_often_read(path):
+    size = fill(path, eviction="lfu")
+    with tcache.open_handle(path, max_bytes=1 << 20) as h:
+        for _ in range(3):
+            h.get("c")
+        h.get("a")
+    with tcache.Cache(path, eviction="lfu", evict_ratio=1) as c:
+        assert c.evict(size) == ["b", "a"]
+
+
+def test_evict_keeps_frozen(path):
+    size = fill(path)
+    with tcache.Cache(path) as c:
+        c.freeze("a")
+        assert c.evict(size) == ["b", "c"]
+        assert list(c) == ["a"]
+
+
+def test_handle_evicts_over_budget(path):
+    size = fill(path)
+    with tcache.open_handle(path, max_bytes=int(3.5 * size)) as h:
+        assert h.get("a") == "x" * 100
+        h["d"] = "x" * 100
+        assert h.get_stats()["evictions"] == 1
+        assert h.get("b") is None
+        assert h.get("a") == "x" * 100
+
+
+def test_migrate_checks_version_read_only(path, monkeypatch):
+    tcache.ensure_exists(path, snapshots=True)
+    assert not tcache.migrate(path, snapshots=True)
+    with tcache.open(path, snapshots=True) as c:
+        c["a"] = 1
+    num = read_snapshot(path)[1]
+    copies = []
+    monkeypatch.setattr(tcache.core.shutil, "copyfile",
+                        lambda *args: copies.append(args))
+    assert not tcache.migrate(path, snapshots=True)
+    # no writer was opened, so no snapshot was copied or published
+    assert copies == []
+    assert read_snapshot(path)[1] == num
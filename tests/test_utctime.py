@@ -0,0 +1,70 @@
+import random
+from datetime import datetime, timezone
+
+from fixparse import UTCTimestampCodec
+
+
+def reference_ns(s):
+    head, _, frac = s.partition(".")
+    dt = datetime.strptime(head, "%Y%m%d-%H:%M:%S")
+    ns = int(dt.replace(tzinfo=timezone.utc).timestamp()) * 10 ** 9
+    if frac:
+        ns += int(frac.ljust(9, "0"))
+    return ns
+
+
+def test_decode_matches_strptime():
+    codec = UTCTimestampCodec()
+    rnd = random.Random(5)
+    samples = []
+    for _ in range(2000):
+        t = rnd.randrange(1500000000, 1600000000)
+        if samples and rnd.random() < 0.7:
+            # mostly the same second or date as the previous timestamp
+            t = samples[-1] + rnd.choice([0, 0, 1, 3600])
+        samples.append(t)
+    for t in samples:
+        s = datetime.utcfromtimestamp(t).strftime("%Y%m%d-%H:%M:%S")
+        digits = rnd.randrange(10)
+        if digits:
+            s += "." + "".join(rnd.choice("0123456789")
+                               for _ in range(digits))
+        assert codec.decode_ns(s) == reference_ns(s), s
+
+
+def test_decode_bytes_and_none():
+    codec = UTCTimestampCodec()
+    assert codec.decode_ns(None) is None
+    assert codec.decode_ns(b"20180102-03:04:05.678") \
+            == reference_ns("20180102-03:04:05.678")
+
+
+def test_decode_truncates_beyond_nanoseconds():
+    codec = UTCTimestampCodec()
+    assert codec.decode_ns("20180102-03:04:05.123456789123") \
+            == reference_ns("20180102-03:04:05.123456789")
+
+
+def test_decode_across_midnight():
+    codec = UTCTimestampCodec()
+    a = codec.decode_ns("20181231-23:59:59.999")
+    b = codec.decode_ns("20190101-00:00:00.000")
+    assert b - a == 1000000
+
+
+def test_encode_matches_strftime():
+    codec = UTCTimestampCodec()
+    rnd = random.Random(7)
+    t = 1500000000.0
+    for _ in range(2000):
+        t += rnd.choice([0.0001, 0.013, 0.5, 1.7, 86400.0])
+        expected = datetime.utcfromtimestamp(int(t * 1000) / 1000) \
+                .strftime("%Y%m%d-%H:%M:%S.%f")[:-3]
+        assert codec.encode(t) == expected
+
+
+def test_round_trip():
+    codec = UTCTimestampCodec()
+    s = codec.encode(1514862245.678)
+    assert s == "20180102-03:04:05.678"
+    assert codec.decode_ns(s) == 1514862245678000000